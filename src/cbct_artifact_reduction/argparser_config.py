@@ -21,6 +21,14 @@ def create_train_argparser():
         random_masks=True,
         num_epochs=10000,
         data_csv="training_data.csv",
+        frames_directory="processed_data/frames/256x256",  # resampled to image_size on the fly
+        read_ahead=0,  # 0 disables fetching the files of the next indices in the background
+        normalization_stats="",  # created with scripts/compute_slice_stats.py, empty computes the quantiles per sample
+        normalization="slice",  # slice, volume or scanner
+        batch_preprocessing=False,  # normalize whole batches on the training device instead of in the workers
+        data_dtype="float32",  # dtype of the slices and masks, float32 or float16
+        num_workers=0,
+        data_seed=-1,  # seed of the random masks, -1 uses fresh entropy
     )
     defaults.update(script_util.model_and_diffusion_defaults())
     parser = argparse.ArgumentParser()
@@ -38,13 +46,18 @@ def create_sample_argparser():
         clip_denoised=True,
         num_samples=1,
         batch_size=1,
-        use_ddim=False,
+        use_ddim=False,  # sample with DDIM, combine with e.g. --timestep_respacing ddim50
+        eta=0.0,  # noise of the DDIM steps, 0 is deterministic
+        replace_known=False,  # RePaint-style replacement of the known region in every ancestral step
+        resample_steps=1,  # number of times each ancestral step is sampled, needs replace_known
         model_path="",
         num_ensemble=1,
         image_size=256,
         random_masks=True,
         data_csv="sample_data.csv",
+        frames_directory="processed_data/frames/256x256",  # resampled to image_size on the fly
         return_item_info=True,
+        mask_bank="",  # created with scripts/create_masks.py, used for the fixed masks if random_masks is False
     )
     defaults.update(script_util.model_and_diffusion_defaults())  # type: ignore
     parser = argparse.ArgumentParser()
@@ -0,0 +1,155 @@
+import torch as th
+import torch.nn.functional as F
+
+from cbct_artifact_reduction.dataprocessing import scanner_log_scale
+from cbct_artifact_reduction.sliceindex import FOVS, SCANNERS, UNKNOWN_CODE
+
+# torch.quantile refuses inputs with more elements than this
+QUANTILE_MAX_ELEMENTS = 16_000_000
+
+
+def log_scale_table() -> th.Tensor:
+    """Return the divisors of the scanner -log transforms indexed by scanner and fov code. NaN means no transform."""
+    table = th.full((len(SCANNERS), len(FOVS)), float("nan"), dtype=th.float64)
+    for scanner_code, scanner in enumerate(SCANNERS):
+        for fov_code, fov in enumerate(FOVS):
+            scale = scanner_log_scale(scanner, fov)
+            if scale is not None:
+                table[scanner_code, fov_code] = scale
+    return table
+
+
+def as_resolution(resolution: int | tuple[int, int]) -> tuple[int, int]:
+    """Turn an image size like the image_size of the model config into a (height, width) tuple."""
+    if isinstance(resolution, int):
+        return (resolution, resolution)
+    return tuple(int(r) for r in resolution)
+
+
+def batch_quantiles(x: th.Tensor, quantiles: th.Tensor) -> th.Tensor:
+    """Compute quantiles of every row of x of shape (N, M) like th.quantile(x, quantiles, dim=1, keepdim=True).
+
+    th.quantile fails for inputs above QUANTILE_MAX_ELEMENTS, e.g. a batch of 64 slices of 512x512. The rows are
+    therefore processed in chunks that stay below the limit. Rows that are larger than the limit on their own are
+    sorted and interpolated linearly like th.quantile does.
+
+    Returns:
+        th.Tensor: The quantiles of shape (len(quantiles), N, 1).
+    """
+    row_size = x.shape[1]
+    if row_size <= QUANTILE_MAX_ELEMENTS:
+        rows_per_chunk = QUANTILE_MAX_ELEMENTS // max(row_size, 1)
+        return th.cat(
+            [
+                th.quantile(chunk, quantiles, dim=1, keepdim=True)
+                for chunk in x.split(rows_per_chunk)
+            ],
+            dim=1,
+        )
+
+    positions = quantiles.to(x.dtype) * (row_size - 1)
+    sorted_x = th.sort(x, dim=1).values
+    lower = sorted_x[:, positions.floor().long()]
+    upper = sorted_x[:, positions.ceil().long()]
+    return th.lerp(lower, upper, positions - positions.floor()).T[:, :, None]
+
+
+def resize_batch(batch: th.Tensor, resolution: int | tuple[int, int]) -> th.Tensor:
+    """Resample a batch of shape (N, C, H, W) to resolution with bilinear interpolation on the device it is on.
+
+    Downsampling is antialiased, so that e.g. 256x256 slices trained at 128x128 don't alias. Batches that already have
+    the resolution are returned as they are.
+    """
+    resolution = as_resolution(resolution)
+    if tuple(batch.shape[-2:]) == resolution:
+        return batch
+    return F.interpolate(
+        batch, size=resolution, mode="bilinear", align_corners=False, antialias=True
+    )
+
+
+class BatchPreprocessor:
+    """Normalize a collated batch of raw slices on the device it is on.
+
+    Does the same as InpaintingSliceDataset.dataprocessing for every sample of the batch at once: the optional scanner
+    specific -log transform, clipping to the per-sample quantiles and scaling to [0, 1]. The quantiles of all samples
+    are computed along the flattened pixels of all samples at once, see batch_quantiles, so DataLoader workers only
+    have to decode the slices. If a resolution is given, the normalized batch is resampled to it, see resize_batch.
+
+    Usage:
+        dataset = InpaintingSliceDataset(..., batch_preprocessing=True)
+        batch, mask, codes = next(iter(DataLoader(dataset, batch_size=8)))
+        batch = BatchPreprocessor()(batch.to(device), codes["scanner_code"], codes["fov_code"])
+    """
+
+    def __init__(
+        self,
+        lower_quantile: float = 0.001,
+        upper_quantile: float = 0.999,
+        scanner_processing: bool = False,
+        dtype: th.dtype = th.float32,
+        resolution: int | tuple[int, int] | None = None,
+    ) -> None:
+        """Initializes the preprocessor.
+
+        Args:
+            lower_quantile (float): The lower quantile the samples are clipped to.
+            upper_quantile (float): The upper quantile the samples are clipped to.
+            scanner_processing (bool): Whether to apply the scanner specific -log transform first.
+            dtype (th.dtype): The dtype the batch is processed and returned in.
+            resolution (int | tuple[int, int], optional): The resolution to resample the batch to, e.g. the
+                image_size of the model. Defaults to None, which keeps the resolution of the batch.
+        """
+        self.quantiles = th.tensor([lower_quantile, upper_quantile], dtype=dtype)
+        self.scanner_processing = scanner_processing
+        self.dtype = dtype
+        self.log_scales = log_scale_table().to(dtype)
+        self.resolution = None if resolution is None else as_resolution(resolution)
+
+    def scanner_transform(
+        self, x: th.Tensor, scanner_codes: th.Tensor, fov_codes: th.Tensor
+    ) -> th.Tensor:
+        """Apply the -log transform of each sample's scanner and fov to the flattened batch x of shape (N, H*W)."""
+        scanner_codes = scanner_codes.to(x.device, th.long)
+        fov_codes = fov_codes.to(x.device, th.long)
+        known = (scanner_codes != UNKNOWN_CODE) & (fov_codes != UNKNOWN_CODE)
+        scales = th.full((x.shape[0],), float("nan"), dtype=self.dtype, device=x.device)
+        scales[known] = self.log_scales.to(x.device)[
+            scanner_codes[known], fov_codes[known]
+        ]
+        transform = ~th.isnan(scales)
+        if transform.any():
+            x = x.clone()
+            x[transform] = -th.log(x[transform] / scales[transform, None])
+        return x
+
+    def __call__(
+        self,
+        batch: th.Tensor,
+        scanner_codes: th.Tensor | None = None,
+        fov_codes: th.Tensor | None = None,
+    ) -> th.Tensor:
+        """Normalize a batch.
+
+        Args:
+            batch (th.Tensor): Raw slices of shape (N, C, H, W).
+            scanner_codes (th.Tensor, optional): The scanner code of each sample, see SliceIndex. Needed for scanner_processing.
+            fov_codes (th.Tensor, optional): The fov code of each sample, see SliceIndex. Needed for scanner_processing.
+
+        Returns:
+            th.Tensor: The normalized batch with the same shape as batch, or resampled to resolution.
+        """
+        x = batch.to(self.dtype).flatten(1)
+        if self.scanner_processing:
+            assert scanner_codes is not None and fov_codes is not None, (
+                "scanner_processing needs the scanner and fov codes of the batch"
+            )
+            x = self.scanner_transform(x, scanner_codes, fov_codes)
+
+        lower, upper = batch_quantiles(x, self.quantiles.to(x.device))
+        x = th.clamp(x, lower, upper)
+        x = (x - lower) / (upper - lower)
+        x = x.view(batch.shape)
+        if self.resolution is not None:
+            x = resize_batch(x, self.resolution)
+        return x
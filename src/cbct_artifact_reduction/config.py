@@ -17,5 +17,12 @@ LAKEFS_COMMIT: str = config["lakefs"]["commit"]
 LAKEFS_CACHE_PATH: str = config["lakefs"]["cache_path"]
 LAKEFS_VERIFY_SSL: bool = config["lakefs"]["verify_ssl"]
 CACHE_PATH: str = config["lakefs"]["cache_path"]
+# Optional byte budget of the local cache. Unlimited if not set.
+CACHE_MAX_BYTES: int | None = config["lakefs"].get("cache_max_bytes")
+# Optional byte budget of the in-memory cache in front of the local cache, per process. Disabled if not set.
+MEMORY_CACHE_MAX_BYTES: int = config["lakefs"].get("memory_cache_max_bytes") or 0
+# Connection pool size and retry attempts of the S3 client of every process.
+LAKEFS_MAX_POOL_CONNECTIONS: int = config["lakefs"].get("max_pool_connections") or 10
+LAKEFS_MAX_ATTEMPTS: int = config["lakefs"].get("max_attempts") or 10
 
 f.close()
@@ -115,12 +115,11 @@ def get_slices_from_ids(csv_path: str, ids: list[str]):
         list[str]: List of slice paths.
     """
 
-    data_csv = pd.read_csv(csv_path)
-    amount_of_slices = data_csv[data_csv["id"].isin(ids)]["frames"]
+    datatable = utils.get_datatable(csv_path)
     slice_paths = []
 
-    for iter, id in enumerate(ids):
-        num_slices = amount_of_slices.values[iter]
+    for id in ids:
+        num_slices = int(datatable.get_value(id, "frames"))
         for n in range(num_slices):
             slice_paths.append(f"{id}_{n}.nii.gz")
     return slice_paths
@@ -1,3 +1,4 @@
+import gzip
 import mimetypes
 import os
 import tarfile
@@ -15,6 +16,22 @@ def get_filename(filepath: str) -> str:
     return os.path.basename(filepath)
 
 
+# Divisor of the -log transform of the raw values of each scanner and field of view. None matches every field of view.
+SCANNER_LOG_SCALES: dict[tuple[str, str | None], float] = {
+    ("planmeca", "small"): 3591 * 2.27,
+    ("planmeca", "large"): 4326 * 2.27,
+    ("axeos", None): 2 * 10**16,
+}
+
+
+def scanner_log_scale(scanner: str | None, fov: str | None) -> float | None:
+    """Return the divisor of the -log transform of a scanner and field of view, or None if there is no transform."""
+    scale = SCANNER_LOG_SCALES.get((scanner, fov))
+    if scale is None:
+        scale = SCANNER_LOG_SCALES.get((scanner, None))
+    return scale
+
+
 def create_binary_threshold_mask(np_array, threshold):
     """Function used to threshold a numpy array."""
     return np.where(np_array > threshold, 1, 0)
@@ -41,6 +58,18 @@ def min_max_normalize(img: np.ndarray):
     return normalized_img
 
 
+def clip_and_scale(img: np.ndarray, lower: float, upper: float):
+    """Clip the image to [lower, upper] and scale it to [0, 1] in place on a single copy.
+
+    With the quantiles of img as bounds, this gives the same result as min_max_normalize(remove_outliers(img)), but
+    without computing the quantiles and without the intermediate arrays."""
+
+    out = np.clip(img, lower, upper).astype(np.result_type(img, np.float32), copy=False)
+    out -= lower
+    out *= 1 / (upper - lower)
+    return out
+
+
 def guess_extensions(filename: str):
     mimetypes.add_type("image/nifti", ".nii")
     mimetypes.add_type("file/archive", ".gz")
@@ -62,7 +91,28 @@ def extract_tar_gz(tar_gz_path: str, output_path: str):
     file.close()
 
 
-def numpy_to_nifti(np_array: np.ndarray, output_path: str):
+def save_nifti(
+    nib_object: nib.nifti1.Nifti1Image,
+    output_path: str,
+    compresslevel: int | None = None,
+):
+    """Save a nifti image as .nii or .nii.gz, depending on the extension of output_path.
+
+    Uncompressed .nii files are the fastest to read and can be memory-mapped. compresslevel sets the gzip level of
+    .nii.gz files from 0 (stored) to 9, None keeps the default of nibabel, which is 1. The image is streamed into
+    the gzip file, so memory-mapped images are never loaded completely."""
+    output_path = str(output_path)
+    if compresslevel is None or not output_path.endswith(".gz"):
+        nib.nifti1.save(nib_object, output_path)
+        return
+    with gzip.GzipFile(output_path, "wb", compresslevel=compresslevel, mtime=0) as f:
+        nib_object.to_stream(f)
+
+
+def numpy_to_nifti(
+    np_array: np.ndarray, output_path: str, compresslevel: int | None = None
+):
+    """Save a numpy array as a nifti file, see save_nifti for the compression."""
     assert not os.path.exists(
         output_path
     ), f"output path {output_path} does already exist"
@@ -70,7 +120,7 @@ def numpy_to_nifti(np_array: np.ndarray, output_path: str):
     # Load the data
     data = nib.nifti1.Nifti1Image(np_array, np.eye(4), dtype=np_array.dtype)
     # Save the data
-    nib.nifti1.Nifti1Image.to_filename(data, output_path)
+    save_nifti(data, output_path, compresslevel)
 
 
 def tif_to_nifti(input_path: str, output_path: str):
@@ -91,49 +141,97 @@ def resize_single_file(
     new_dimensions: tuple[int, int],
     output_file_path: str,
     preserve_range: bool = False,
+    compresslevel: int | None = None,
 ):
-    """Resize a single nifti file to new dimensions."""
+    """Resize a single nifti file to new dimensions. The output is compressed like in save_nifti."""
     np_array = single_nifti_to_numpy(nifti_path)
     resized_array = skTrans.resize(
         np_array, new_dimensions, preserve_range=preserve_range
     )
     resized_nifti = nib.nifti1.Nifti1Image(resized_array, affine=None)
-    nib.nifti1.save(
-        resized_nifti,
-        output_file_path,
-    )
+    save_nifti(resized_nifti, output_file_path, compresslevel)
+
+
+def nifti_to_numpy(nib_object: nib.nifti1.Nifti1Image, dtype=np.float64):
+    """Read the scaled data of a nifti image as dtype with as few copies as possible.
 
+    The data is read straight from the dataobj proxy, which applies the scaling of the header. Uncompressed files
+    whose data is already stored as dtype are returned as a memory map without copying them."""
+    np_array = np.asanyarray(nib_object.dataobj)
+    return np_array.astype(dtype, copy=False)
 
-def single_nifti_to_numpy(nifti_path: str):
-    """Convert a single nifti file to a numpy array."""
+
+def single_nifti_to_numpy(nifti_path: str, dtype=np.float64):
+    """Convert a single nifti file to a numpy array of the given float dtype."""
     assert os.path.exists(nifti_path), f"{nifti_path} does not exist"
     nib_object = nib.nifti1.Nifti1Image.from_filename(nifti_path)
-    data = nib_object.get_fdata()
-    np_array = np.array(data)
-    return np_array
+    return nifti_to_numpy(nib_object, dtype)
+
+
+def nifti_bytes_to_numpy(data: bytes, dtype=np.float64):
+    """Convert the contents of a .nii or .nii.gz file to a numpy array without writing it to disk."""
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    nib_object = nib.nifti1.Nifti1Image.from_bytes(data)
+    return nifti_to_numpy(nib_object, dtype)
 
 
-def nifti_vol_to_frames(nifti_path: str, output_dir: str, overwrite: bool = False):
+def iter_frame_chunks(image: nib.nifti1.Nifti1Image, chunk_frames: int = 64):
+    """Read the frames of a 3d nifti volume lazily, chunk_frames frames at a time.
+
+    Open the image with nib.load(path, keep_file_open=True), so that a compressed file is decompressed once from start
+    to end instead of from the start for every chunk.
+
+    Yields:
+        tuple[int, np.ndarray]: The index of the first frame of the chunk and the frames [:, :, start:start + chunk_frames].
+    """
+    num_frames = image.shape[2]
+    for start in range(0, num_frames, chunk_frames):
+        yield start, np.asanyarray(image.dataobj[:, :, start : start + chunk_frames])
+
+
+def nifti_vol_to_frames(
+    nifti_path: str,
+    output_dir: str,
+    overwrite: bool = False,
+    chunk_frames: int = 64,
+    extension: str = ".nii.gz",
+    compresslevel: int | None = None,
+):
     """Extract frames from a 3d nifti volume and save them as individual 2d nifti files.
-    Input dimensions would be NxMxT, where T is the number of frames."""
+    Input dimensions would be NxMxT, where T is the number of frames. Only chunk_frames frames are in memory at a time,
+    see iter_frame_chunks. The frames are saved as <volume>_<frame><extension>, extension is .nii.gz or .nii and
+    compresslevel the gzip level, see save_nifti."""
 
     assert os.path.exists(nifti_path), f"{nifti_path} does not exist"
     assert os.path.exists(output_dir), f"{output_dir} does not exist"
-    image = nib.nifti1.Nifti1Image.from_filename(nifti_path)
-    np_array = np.array(image.dataobj)
+    image = nib.load(nifti_path, keep_file_open=True)
 
     base_filename = filename_without_extension(os.path.basename(nifti_path))
-    for i in range(np_array.shape[2]):
-        if not overwrite and os.path.exists(
-            os.path.join(output_dir, f"{base_filename}_{i}.nii.gz")
-        ):
-            print(f"Skipping {base_filename}_{i}.nii.gz as it already exists")
-            continue
-        frame = np_array[:, :, i]
-        nib_frame = nib.nifti1.Nifti1Image(frame, image.affine)
-        nib.nifti1.save(
-            nib_frame, os.path.join(output_dir, f"{base_filename}_{i}.nii.gz")
-        )
+    for start, chunk in iter_frame_chunks(image, chunk_frames):
+        for offset in range(chunk.shape[2]):
+            i = start + offset
+            frame_filename = f"{base_filename}_{i}{extension}"
+            if not overwrite and os.path.exists(
+                os.path.join(output_dir, frame_filename)
+            ):
+                print(f"Skipping {frame_filename} as it already exists")
+                continue
+            frame = chunk[:, :, offset]
+            nib_frame = nib.nifti1.Nifti1Image(frame, image.affine)
+            save_nifti(
+                nib_frame, os.path.join(output_dir, frame_filename), compresslevel
+            )
+
+
+def nifti_to_npy(nifti_path: str, output_path: str, dtype=np.float32):
+    """Save a nifti volume as an uncompressed .npy file that can be memory-mapped with np.load(mmap_mode="r").
+
+    The array is stored in Fortran order like in the nifti file, so each frame [:, :, i] is contiguous on disk."""
+    assert os.path.exists(nifti_path), f"{nifti_path} does not exist"
+    nib_object = nib.nifti1.Nifti1Image.from_filename(nifti_path)
+    np_array = np.asfortranarray(nib_object.get_fdata(dtype=dtype))
+    np.save(output_path, np_array)
 
 
 class DataFolder:
@@ -182,45 +280,118 @@ class NiftiDataFolder(DataFolder):
     def resize_all_files(
         self,
         output_folder_path: str,
-        new_dimensions: tuple[int, int],
+        new_dimensions: tuple[int, int] | list[tuple[int, int]],
         overwrite_files: bool = False,
         preserve_range: bool = False,
-    ):
-        """Resize all nifti files in the data folder to new dimensions. Takes in the output folder path, whether to overwrite files, the new dimensions and whether to preserve the range."""
-
-        if not os.path.exists(output_folder_path):
-            os.makedirs(output_folder_path)
-
-        for count, f_path in enumerate(self.data_path_list):
-            resized_nifti_path = os.path.join(
-                output_folder_path, os.path.basename(f_path)
-            )
-            if not overwrite_files and os.path.exists(resized_nifti_path):
-                print(
-                    f"Resized {get_filename(f_path)} already exists at destination. Skipping."
+        backend: str = "skimage",
+        num_workers: int | None = None,
+        files_per_task: int = 1,
+        extension: str | None = None,
+        compresslevel: int | None = None,
+    ) -> dict[str, float]:
+        """Resize all nifti files in the data folder to new dimensions in parallel, see volumeresize.resize_all_volumes.
+
+        Args:
+            output_folder_path (str): The directory the resized files are written to.
+            new_dimensions (tuple[int, int] | list[tuple[int, int]]): The new dimensions. With a list of dimensions,
+                every file is decoded once and written to <output_folder_path>/<H>x<W> for each of them.
+            overwrite_files (bool): Whether to resize files again that are already in the manifest.
+            preserve_range (bool): Passed on to skimage.transform.resize.
+            backend (str): One of "skimage", "torch" or "pil", see volumeresize.resize_frames.
+            num_workers (int, optional): The number of processes. Defaults to the number of CPUs.
+            files_per_task (int): The number of files per task, more files per task is faster for small files.
+            extension (str, optional): ".nii" or ".nii.gz" for the resized files. Defaults to the extension of each
+                source file.
+            compresslevel (int, optional): The gzip level of .nii.gz files, see save_nifti.
+
+        Returns:
+            dict[str, float]: The resize statistics.
+        """
+        # volumeresize imports this module
+        from cbct_artifact_reduction.volumeresize import resize_all_volumes
+
+        if isinstance(new_dimensions, list):
+            output_dirs = {
+                tuple(dimensions): os.path.join(
+                    output_folder_path, f"{dimensions[0]}x{dimensions[1]}"
                 )
-                continue
+                for dimensions in new_dimensions
+            }
+        else:
+            output_dirs = {tuple(new_dimensions): output_folder_path}
+
+        return resize_all_volumes(
+            self.data_path_list,
+            output_dirs,
+            backend=backend,
+            preserve_range=preserve_range,
+            num_workers=num_workers,
+            files_per_task=files_per_task,
+            overwrite=overwrite_files,
+            extension=extension,
+            compresslevel=compresslevel,
+        )
+
+    def split_all_volumes_into_frames(
+        self,
+        output_folder_path: str,
+        output_format: str = "nifti",
+        num_workers: int | None = None,
+        overwrite: bool = False,
+        extension: str = ".nii.gz",
+        compresslevel: int | None = None,
+    ) -> dict[str, float]:
+        """Split all nifti volumes in the data folder into frames in parallel, see frameextraction.extract_all_frames.
+
+        Args:
+            output_folder_path (str): The directory the frames are written to.
+            output_format (str): One of "nifti" (one 2d nifti file per frame), "npy" (one memory-mappable .npy file per
+                volume) or "shards" (shards for the ShardSliceDataset).
+            num_workers (int, optional): The number of processes. Defaults to the number of CPUs.
+            overwrite (bool): Whether to extract volumes again that are already listed in the manifest.
+            extension (str): ".nii.gz" or ".nii" for the frames of the "nifti" format.
+            compresslevel (int, optional): The gzip level of .nii.gz frames, see save_nifti.
+
+        Returns:
+            dict[str, float]: The extraction statistics.
+        """
+        # frameextraction imports this module
+        from cbct_artifact_reduction.frameextraction import (
+            FRAME_WRITERS,
+            extract_all_frames,
+        )
 
-            # Resized file doesn't exist or overwrite is True
-            resize_single_file(
-                f_path,
-                new_dimensions,
-                resized_nifti_path,
-                preserve_range=preserve_range,
+        assert output_format in FRAME_WRITERS, (
+            f"output_format must be one of {tuple(FRAME_WRITERS)}"
+        )
+        if output_format == "nifti":
+            writer = FRAME_WRITERS[output_format](
+                output_folder_path, extension=extension, compresslevel=compresslevel
             )
-            print(
-                f"Resized file {count+1}/{len(self.data_path_list)}. Saved at {resized_nifti_path}"
+        else:
+            assert extension == ".nii.gz" and compresslevel is None, (
+                "extension and compresslevel only apply to the nifti format"
             )
+            writer = FRAME_WRITERS[output_format](output_folder_path)
+        return extract_all_frames(
+            self.data_path_list,
+            writer,
+            num_workers=num_workers,
+            overwrite=overwrite,
+        )
 
-    def split_all_volumes_into_frames(self, output_folder_path: str):
-        """Split all nifti volumes in the data folder into frames and save them as individual 2d nifti files."""
+    def convert_all_volumes_to_npy(self, output_folder_path: str, dtype=np.float32):
+        """Save all nifti volumes in the data folder as uncompressed .npy files, e.g. for the VolumeSliceDataset."""
         if not os.path.exists(output_folder_path):
             os.makedirs(output_folder_path)
 
         for count, f_path in enumerate(self.data_path_list):
-            nifti_vol_to_frames(f_path, output_folder_path)
+            base_filename = filename_without_extension(os.path.basename(f_path))
+            nifti_to_npy(
+                f_path, os.path.join(output_folder_path, f"{base_filename}.npy"), dtype
+            )
             print(
-                f"Split volume {count+1}/{len(self.data_path_list)}. Saved at {output_folder_path}"
+                f"Converted volume {count+1}/{len(self.data_path_list)}. Saved at {output_folder_path}"
             )
 
 
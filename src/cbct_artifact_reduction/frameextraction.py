@@ -0,0 +1,351 @@
+import json
+import os
+import shutil
+import time
+import warnings
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nibabel as nib
+import numpy as np
+from nibabel.filebasedimages import ImageFileError
+
+from cbct_artifact_reduction.dataprocessing import (
+    filename_without_extension,
+    iter_frame_chunks,
+    save_nifti,
+)
+from cbct_artifact_reduction.sliceindex import mmap_npz, save_npz
+from cbct_artifact_reduction.sliceshard import (
+    SHARD_INDEX_FILENAME,
+    SliceShardWriter,
+    shard_filename,
+)
+
+MANIFEST_FILENAME = "manifest.jsonl"
+SHARD_VOLUME_DIRECTORY = "volumes"
+
+
+class NiftiFrameWriter:
+    """Write every frame as its own 2d nifti file '<volume id>_<frame>.nii.gz', like nifti_vol_to_frames.
+
+    With extension .nii the frames are stored uncompressed, compresslevel sets the gzip level, see save_nifti.
+    """
+
+    format = "nifti"
+
+    def __init__(
+        self,
+        output_dir: str,
+        extension: str = ".nii.gz",
+        compresslevel: int | None = None,
+    ) -> None:
+        self.output_dir = output_dir
+        self.extension = extension
+        self.compresslevel = compresslevel
+
+    def write_volume(
+        self, volume_id: str, image: nib.nifti1.Nifti1Image, chunk_frames: int
+    ) -> int:
+        num_frames = 0
+        for start, chunk in iter_frame_chunks(image, chunk_frames):
+            for offset in range(chunk.shape[2]):
+                save_nifti(
+                    nib.nifti1.Nifti1Image(chunk[:, :, offset], image.affine),
+                    os.path.join(
+                        self.output_dir,
+                        f"{volume_id}_{start + offset}{self.extension}",
+                    ),
+                    self.compresslevel,
+                )
+                num_frames += 1
+        return num_frames
+
+    def finalize(self, volume_ids: list[str]):
+        pass
+
+
+class NpyFrameWriter:
+    """Write every volume as one uncompressed '<volume id>.npy' file in Fortran order, like nifti_to_npy.
+
+    The file is filled chunk by chunk through a memory map, so the volume is never in memory as a whole. The result can
+    be used with the VolumeSliceDataset.
+    """
+
+    format = "npy"
+
+    def __init__(self, output_dir: str, dtype: np.dtype | type = np.float32) -> None:
+        self.output_dir = output_dir
+        self.dtype = np.dtype(dtype)
+
+    def write_volume(
+        self, volume_id: str, image: nib.nifti1.Nifti1Image, chunk_frames: int
+    ) -> int:
+        npy_path = os.path.join(self.output_dir, f"{volume_id}.npy")
+        tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+        np_array = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=self.dtype, shape=image.shape, fortran_order=True
+        )
+        for start, chunk in iter_frame_chunks(image, chunk_frames):
+            np_array[:, :, start : start + chunk.shape[2]] = chunk
+        np_array.flush()
+        del np_array
+        os.replace(tmp_path, npy_path)
+        return image.shape[2]
+
+    def finalize(self, volume_ids: list[str]):
+        pass
+
+
+class ShardFrameWriter:
+    """Pack the frames into shards for the ShardSliceDataset.
+
+    Every volume is packed into its own shards with a SliceShardWriter in volumes/<volume id>, so volumes can be packed
+    in parallel and again on their own. finalize links the shards of all volumes into the output directory and writes
+    the index of all slices.
+    """
+
+    format = "shards"
+
+    def __init__(
+        self,
+        output_dir: str,
+        shard_size: int = 1024,
+        dtype: np.dtype | type = np.float32,
+    ) -> None:
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+
+    def _volume_dir(self, volume_id: str) -> str:
+        return os.path.join(self.output_dir, SHARD_VOLUME_DIRECTORY, volume_id)
+
+    def write_volume(
+        self, volume_id: str, image: nib.nifti1.Nifti1Image, chunk_frames: int
+    ) -> int:
+        with SliceShardWriter(
+            self._volume_dir(volume_id), shard_size=self.shard_size, dtype=self.dtype
+        ) as writer:
+            for start, chunk in iter_frame_chunks(image, chunk_frames):
+                for offset in range(chunk.shape[2]):
+                    writer.add(chunk[:, :, offset], int(volume_id), start + offset)
+        return image.shape[2]
+
+    def finalize(self, volume_ids: list[str]):
+        """Link the shards of the volumes into the output directory, sorted by volume id, and write index.npz."""
+        for filename in os.listdir(self.output_dir):
+            if filename.startswith("shard_") and filename.endswith(".npz"):
+                os.remove(os.path.join(self.output_dir, filename))
+
+        columns: dict[str, list[np.ndarray]] = {}
+        shard_lengths = []
+        for volume_id in sorted(volume_ids, key=int):
+            volume_dir = self._volume_dir(volume_id)
+            index = mmap_npz(os.path.join(volume_dir, SHARD_INDEX_FILENAME))
+            shard_offsets = index.pop("shard_offsets")
+            for name, column in index.items():
+                columns.setdefault(name, []).append(np.array(column))
+            for shard_number in range(len(shard_offsets) - 1):
+                link_path = os.path.join(
+                    self.output_dir, shard_filename(len(shard_lengths))
+                )
+                shard_path = os.path.join(volume_dir, shard_filename(shard_number))
+                try:
+                    os.link(shard_path, link_path)
+                except OSError:
+                    shutil.copyfile(shard_path, link_path)
+                shard_lengths.append(
+                    shard_offsets[shard_number + 1] - shard_offsets[shard_number]
+                )
+
+        save_npz(
+            os.path.join(self.output_dir, SHARD_INDEX_FILENAME),
+            shard_offsets=np.concatenate([[0], np.cumsum(shard_lengths)]).astype(
+                np.int64
+            ),
+            **{name: np.concatenate(column) for name, column in columns.items()},
+        )
+
+
+FRAME_WRITERS = {
+    NiftiFrameWriter.format: NiftiFrameWriter,
+    NpyFrameWriter.format: NpyFrameWriter,
+    ShardFrameWriter.format: ShardFrameWriter,
+}
+
+
+# The errors of a missing, truncated or corrupt volume, which fail that volume only
+EXTRACTION_ERRORS = (OSError, EOFError, ValueError, zlib.error, ImageFileError)
+
+
+def source_signature(volume_path: str) -> dict:
+    """Return the size and modification time of a volume, a volume that changed is extracted again."""
+    stat = os.stat(volume_path)
+    return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def read_manifest(manifest_path: str) -> dict[str, dict]:
+    """Read the entries of the volumes that were extracted completely, by volume id.
+
+    A line that was cut off by a crash is ignored, its volume is extracted again.
+    """
+    entries = {}
+    if not os.path.exists(manifest_path):
+        return entries
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry["volume_id"]] = entry
+    return entries
+
+
+def is_current(entry: dict | None, volume_path: str, output_format: str) -> bool:
+    """Check that a manifest entry was written for the same output format and an unchanged source file."""
+    return (
+        entry is not None
+        and entry["format"] == output_format
+        and all(
+            entry.get(key) == value
+            for key, value in source_signature(volume_path).items()
+        )
+    )
+
+
+def append_manifest(manifest_path: str, entry: dict):
+    """Append an entry to the manifest. A line that was cut off by a crash is ended first, so the entry stays on its own
+    line.
+    """
+    with open(manifest_path, "ab+") as f:
+        line = json.dumps(entry) + "\n"
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = "\n" + line
+        f.write(line.encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def extract_volume(volume_path: str, writer, chunk_frames: int = 64) -> dict:
+    """Extract the frames of a single volume with writer. Runs in the worker processes of extract_all_frames.
+
+    Returns:
+        dict: The manifest entry of the volume.
+    """
+    volume_id = filename_without_extension(os.path.basename(volume_path))
+    signature = source_signature(volume_path)
+    image = nib.load(volume_path, keep_file_open=True)
+    num_frames = writer.write_volume(volume_id, image, chunk_frames)
+    return {
+        "volume_id": volume_id,
+        "format": writer.format,
+        "frames": num_frames,
+        **signature,
+    }
+
+
+def extract_all_frames(
+    volume_paths: list[str],
+    writer,
+    num_workers: int | None = None,
+    chunk_frames: int = 64,
+    overwrite: bool = False,
+    verbose: bool = True,
+) -> dict[str, float]:
+    """Extract the frames of many 3d nifti volumes in parallel, one task per volume.
+
+    Frames are read lazily through the nibabel proxy, chunk_frames at a time, so a worker never holds a whole volume.
+    Every extracted volume is appended to manifest.jsonl in the output directory. A rerun skips the volumes that are in
+    the manifest with the same output format and an unchanged source file, without looking at the frames.
+
+    Args:
+        volume_paths (list[str]): The paths of the volumes.
+        writer (NiftiFrameWriter | NpyFrameWriter | ShardFrameWriter): Writes the frames of a volume, see
+            FRAME_WRITERS. Any object with a format, write_volume(volume_id, image, chunk_frames) and
+            finalize(volume_ids) works, it is pickled into the worker processes.
+        num_workers (int, optional): The number of processes. 0 extracts in this process. Defaults to the number of
+            CPUs.
+        chunk_frames (int): The number of frames that are read at once.
+        overwrite (bool): Whether to extract the volumes in the manifest again.
+        verbose (bool): Whether to print the progress.
+
+    A volume that fails is reported with a warning and left out of the manifest, the other volumes are still extracted
+    and recorded, so a rerun only extracts the failed volumes again.
+
+    Returns:
+        dict[str, float]: The number of extracted, skipped and failed volumes, the number of extracted frames and the
+            time it took in seconds.
+    """
+    os.makedirs(writer.output_dir, exist_ok=True)
+    manifest_path = os.path.join(writer.output_dir, MANIFEST_FILENAME)
+    manifest = read_manifest(manifest_path)
+
+    volume_ids = []
+    pending = []
+    for volume_path in volume_paths:
+        volume_id = filename_without_extension(os.path.basename(volume_path))
+        volume_ids.append(volume_id)
+        if not overwrite and is_current(
+            manifest.get(volume_id), volume_path, writer.format
+        ):
+            continue
+        pending.append(volume_path)
+
+    if verbose and len(pending) < len(volume_paths):
+        print(f"Skipping {len(volume_paths) - len(pending)} volumes in the manifest")
+
+    start_time = time.perf_counter()
+    num_frames = 0
+    failed = []
+
+    def record(count: int, entry: dict):
+        nonlocal num_frames
+        append_manifest(manifest_path, entry)
+        num_frames += entry["frames"]
+        if verbose:
+            print(
+                f"Split volume {entry['volume_id']} into {entry['frames']} frames ({count}/{len(pending)})"
+            )
+
+    def fail(volume_path: str, error: Exception):
+        failed.append(filename_without_extension(os.path.basename(volume_path)))
+        warnings.warn(f"Could not extract the frames of {volume_path}: {error!r}")
+
+    if num_workers == 0:
+        for count, volume_path in enumerate(pending, start=1):
+            try:
+                entry = extract_volume(volume_path, writer, chunk_frames)
+            except EXTRACTION_ERRORS as error:
+                fail(volume_path, error)
+                continue
+            record(count, entry)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {
+                executor.submit(
+                    extract_volume, volume_path, writer, chunk_frames
+                ): volume_path
+                for volume_path in pending
+            }
+            for count, future in enumerate(as_completed(futures), start=1):
+                try:
+                    entry = future.result()
+                except EXTRACTION_ERRORS as error:
+                    fail(futures[future], error)
+                    continue
+                record(count, entry)
+
+    writer.finalize([volume_id for volume_id in volume_ids if volume_id not in failed])
+    seconds = time.perf_counter() - start_time
+    if verbose and num_frames:
+        print(f"Extracted {num_frames} frames in {seconds:.1f}s")
+    return {
+        "volumes": len(pending) - len(failed),
+        "failed": len(failed),
+        "skipped": len(volume_paths) - len(pending),
+        "frames": num_frames,
+        "seconds": seconds,
+    }
@@ -168,6 +168,58 @@ class GaussianDiffusion:
             / (1.0 - self.alphas_cumprod)
         )
 
+        # further arrays that are indexed by timestep, see SCHEDULE_ARRAYS
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        self.log_betas = np.log(betas)
+        # fixedlarge variance, with the first term clipped like above
+        self.large_variance = np.append(self.posterior_variance[1], betas[1:])
+        self.large_log_variance = np.log(self.large_variance)
+        self.recip_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.posterior_mean_coef2_over_coef1 = (
+            self.posterior_mean_coef2 / self.posterior_mean_coef1
+        )
+
+        # All SCHEDULE_ARRAYS as one float32 [K x T] tensor per device, created
+        # on first use, so that sampling doesn't copy them to the device.
+        self._schedule_tables = {}
+
+    def _schedule_table(self, device):
+        """
+        Get the SCHEDULE_ARRAYS as a float32 [K x T] tensor on the given
+        device, copied there only the first time.
+        """
+        table = self._schedule_tables.get(device)
+        if table is None:
+            table = th.from_numpy(
+                np.stack([getattr(self, name) for name in SCHEDULE_ARRAYS])
+            ).to(device=device, dtype=th.float32)
+            self._schedule_tables[device] = table
+        return table
+
+    def _extract(self, names, timesteps, broadcast_shape):
+        """
+        Extract the values of one or more schedule arrays for a batch of
+        indices, with a single gather from the cached device table.
+
+        Same as _extract_into_tensor(getattr(self, name), ...) for every name,
+        without copying the arrays to the device.
+
+        :param names: a name in SCHEDULE_ARRAYS, or a sequence of them.
+        :param timesteps: a tensor of indices into the arrays to extract.
+        :param broadcast_shape: a larger shape of K dimensions with the batch
+                                dimension equal to the length of timesteps.
+        :return: a tensor of shape [batch_size, 1, ...] with K dims for a
+                 single name, otherwise a tuple of them.
+        """
+        values = self._schedule_table(timesteps.device)[:, timesteps]
+        shape = (len(timesteps),) + (1,) * (len(broadcast_shape) - 1)
+        if isinstance(names, str):
+            return values[SCHEDULE_INDEX[names]].view(shape).expand(broadcast_shape)
+        return tuple(
+            values[SCHEDULE_INDEX[name]].view(shape).expand(broadcast_shape)
+            for name in names
+        )
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -176,13 +228,16 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+        sqrt_alpha_bar, variance, log_variance = self._extract(
+            (
+                "sqrt_alphas_cumprod",
+                "one_minus_alphas_cumprod",
+                "log_one_minus_alphas_cumprod",
+            ),
+            t,
+            x_start.shape,
         )
+        mean = sqrt_alpha_bar * x_start
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -199,11 +254,12 @@ class GaussianDiffusion:
         if noise is None:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
-        return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
-            * noise
+        sqrt_alpha_bar, sqrt_one_minus_alpha_bar = self._extract(
+            ("sqrt_alphas_cumprod", "sqrt_one_minus_alphas_cumprod"),
+            t,
+            x_start.shape,
         )
+        return sqrt_alpha_bar * x_start + sqrt_one_minus_alpha_bar * noise
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
         """
@@ -213,14 +269,19 @@ class GaussianDiffusion:
 
         """
         assert x_start.shape == x_t.shape
-        posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        coef1, coef2, posterior_variance, posterior_log_variance_clipped = (
+            self._extract(
+                (
+                    "posterior_mean_coef1",
+                    "posterior_mean_coef2",
+                    "posterior_variance",
+                    "posterior_log_variance_clipped",
+                ),
+                t,
+                x_t.shape,
+            )
         )
+        posterior_mean = coef1 * x_start + coef2 * x_t
         assert (
             posterior_mean.shape[0]
             == posterior_variance.shape[0]
@@ -270,29 +331,27 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
+                min_log, max_log = self._extract(
+                    ("posterior_log_variance_clipped", "log_betas"), t, x.shape
                 )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
                 model_variance = th.exp(model_log_variance)
         else:
-            model_variance, model_log_variance = {
-                # for fixedlarge, we set the initial (log-)variance like so
-                # to get a better decoder log likelihood.
-                ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
-                ),
-                ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
-                ),
-            }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance, model_log_variance = self._extract(
+                {
+                    # for fixedlarge, we set the initial (log-)variance like so
+                    # to get a better decoder log likelihood.
+                    ModelVarType.FIXED_LARGE: ("large_variance", "large_log_variance"),
+                    ModelVarType.FIXED_SMALL: (
+                        "posterior_variance",
+                        "posterior_log_variance_clipped",
+                    ),
+                }[self.model_var_type],
+                t,
+                x.shape,
+            )
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -331,26 +390,26 @@ class GaussianDiffusion:
 
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
-        return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+        sqrt_recip_alpha_bar, sqrt_recipm1_alpha_bar = self._extract(
+            ("sqrt_recip_alphas_cumprod", "sqrt_recipm1_alphas_cumprod"), t, x_t.shape
         )
+        return sqrt_recip_alpha_bar * x_t - sqrt_recipm1_alpha_bar * eps
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
-        return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
-            )
-            * x_t
+        recip_coef1, coef2_over_coef1 = self._extract(
+            ("recip_posterior_mean_coef1", "posterior_mean_coef2_over_coef1"),
+            t,
+            x_t.shape,
         )
+        # (xprev - coef2*x_t) / coef1
+        return recip_coef1 * xprev - coef2_over_coef1 * x_t
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
-        return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        sqrt_recip_alpha_bar, sqrt_recipm1_alpha_bar = self._extract(
+            ("sqrt_recip_alphas_cumprod", "sqrt_recipm1_alphas_cumprod"), t, x_t.shape
+        )
+        return (sqrt_recip_alpha_bar * x_t - pred_xstart) / sqrt_recipm1_alpha_bar
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -382,7 +441,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -548,7 +607,19 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        in_place=False,
+        replace_known=False,
+        resample_steps=1,
     ):
+        """
+        Inpaint the masked region with ancestral sampling.
+
+        :param in_place: see p_sample_loop_progressive_inpainting().
+        :param replace_known: see p_sample_loop_progressive_inpainting().
+        :param resample_steps: see p_sample_loop_progressive_inpainting().
+        :return: a tuple of the inpainted images and the initial
+                 [noise, masked image, mask] input.
+        """
         if device is None:
             device = next(model.parameters()).device
 
@@ -570,6 +641,9 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
             device=device,
             progress=progress,
+            in_place=in_place,
+            replace_known=replace_known,
+            resample_steps=resample_steps,
         ):
             final = sample
         if final is not None:
@@ -588,6 +662,9 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        in_place=False,
+        replace_known=False,
+        resample_steps=1,
     ):
         """
         Generate samples from the model and yield intermediate samples from
@@ -596,10 +673,28 @@ class GaussianDiffusion:
         Arguments are the same as p_sample_loop().
         Returns a generator over dicts, where each dict is the return value of
         p_sample().
+
+        :param in_place: if True, the model input is a single preallocated
+                         [sample, masked image, mask] buffer, and every new
+                         sample is written into its first channel instead of
+                         concatenating a new 3-channel tensor per step. noise
+                         must hold the 3 channels and isn't modified.
+        :param replace_known: if True, the known region of every sample, where
+                              mask is 0, is replaced by the masked image
+                              diffused to the noise level of that sample, as
+                              in RePaint (Lugmayr et al., 2022).
+        :param resample_steps: the number of times each step is sampled. Before
+                               a step is sampled again, its sample is diffused
+                               back by one step, so the known and generated
+                               regions can harmonize. Needs replace_known.
         """
         if device is None:
             device = next(model.parameters()).device
         assert isinstance(shape, (tuple, list))
+        assert resample_steps >= 1
+        assert replace_known or resample_steps == 1, (
+            "resampling only makes sense with replace_known"
+        )
         if noise is not None:
             img = noise
         else:
@@ -608,6 +703,11 @@ class GaussianDiffusion:
             ::-1
         ]  # Reverse the list of timesteps 0, 1, 2,..., 100 -> 100, 99, 98,..., 0
 
+        if in_place:
+            assert img.shape[1] == 3, (
+                "noise must hold the noise, the masked image and the mask"
+            )
+            img = img.float().clone()
         masked_image = img[:, 1:2, ...]
         mask = img[:, 2:3, ...]
 
@@ -618,21 +718,43 @@ class GaussianDiffusion:
             indices = tqdm(indices)
 
         for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
-            if img.shape[1] != 3:
-                img = th.cat((img, masked_image, mask), dim=1).float()
-            with th.no_grad():
-                out = self.p_sample_inpainting(
-                    model,
-                    img,
-                    t,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    cond_fn=cond_fn,
-                    model_kwargs=model_kwargs,
-                )
-                yield out
-                img = out["sample"]  # This is the reduced noise image and has 1 channel
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
+            # The last step gives x_0, which can't be diffused back
+            repeats = resample_steps if i > 0 else 1
+            for r in range(repeats):
+                if img.shape[1] != 3:
+                    img = th.cat((img, masked_image, mask), dim=1).float()
+                with th.no_grad():
+                    out = self.p_sample_inpainting(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        cond_fn=cond_fn,
+                        model_kwargs=model_kwargs,
+                    )
+                    # This is the reduced noise image and has 1 channel
+                    sample = out["sample"]
+                    if replace_known:
+                        if i > 0:
+                            known = self.q_sample(masked_image, t - 1)
+                        else:
+                            known = masked_image
+                        sample = mask * sample + (1 - mask) * known
+                        out["sample"] = sample
+                    if r < repeats - 1:
+                        # Diffuse x_{t-1} back to x_t and sample the step again
+                        beta = self._extract("betas", t, sample.shape)
+                        resample_noise = th.randn_like(sample)
+                        sample = (
+                            th.sqrt(1 - beta) * sample + th.sqrt(beta) * resample_noise
+                        )
+                    if in_place:
+                        img[:, 0:1, ...].copy_(sample)
+                    else:
+                        img = sample
+            yield out
 
     def p_sample_loop_progressive(
         self,
@@ -670,7 +792,7 @@ class GaussianDiffusion:
             indices = tqdm(indices)
 
         for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -715,8 +837,9 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar, alpha_bar_prev = self._extract(
+            ("alphas_cumprod", "alphas_cumprod_prev"), t, x.shape
+        )
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -758,11 +881,16 @@ class GaussianDiffusion:
         )
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
-        eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
-            - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        sqrt_recip_alpha_bar, sqrt_recipm1_alpha_bar, alpha_bar_next = self._extract(
+            (
+                "sqrt_recip_alphas_cumprod",
+                "sqrt_recipm1_alphas_cumprod",
+                "alphas_cumprod_next",
+            ),
+            t,
+            x.shape,
+        )
+        eps = (sqrt_recip_alpha_bar * x - out["pred_xstart"]) / sqrt_recipm1_alpha_bar
 
         # Equation 12. reversed
         mean_pred = (
@@ -841,7 +969,7 @@ class GaussianDiffusion:
             indices = tqdm(indices)
 
         for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
             with th.no_grad():
                 out = self.ddim_sample(
                     model,
@@ -856,6 +984,175 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def ddim_sample_inpainting(
+        self,
+        model,
+        x,
+        t,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        eta=0.0,
+    ):
+        """
+        Sample x_{t-1} from the model using DDIM, for an input of the
+        [noisy image, masked image, mask] channels.
+
+        Same usage as p_sample_inpainting(). Only the first channel is denoised,
+        so the sample has a single channel.
+        """
+        out = self.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        x_t = x[:, 0:1, ...]
+        if cond_fn is not None:
+            out = self.condition_score(cond_fn, out, x_t, t, model_kwargs=model_kwargs)
+
+        eps = self._predict_eps_from_xstart(x_t, t, out["pred_xstart"])
+
+        alpha_bar, alpha_bar_prev = self._extract(
+            ("alphas_cumprod", "alphas_cumprod_prev"), t, x_t.shape
+        )
+        sigma = (
+            eta
+            * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+            * th.sqrt(1 - alpha_bar / alpha_bar_prev)
+        )
+        # Equation 12.
+        noise = th.randn_like(x_t)
+        mean_pred = (
+            out["pred_xstart"] * th.sqrt(alpha_bar_prev)
+            + th.sqrt(1 - alpha_bar_prev - sigma**2) * eps
+        )
+        nonzero_mask = (
+            (t != 0).float().view(-1, *([1] * (len(x_t.shape) - 1)))
+        )  # no noise when t == 0
+        sample = mean_pred + nonzero_mask * sigma * noise
+        return {"sample": sample, "pred_xstart": out["pred_xstart"]}
+
+    def ddim_sample_loop_inpainting(
+        self,
+        model,
+        masked_image,
+        mask,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        eta=0.0,
+        in_place=False,
+    ):
+        """
+        Inpaint the masked region using DDIM.
+
+        Same usage as p_sample_loop_inpainting(). Use it with a SpacedDiffusion,
+        e.g. with timestep_respacing="ddim50", to sample with 50 instead of all
+        steps of the diffusion the model was trained with.
+
+        :param eta: the amount of noise added in each step, 0 is deterministic
+                    and 1 is as stochastic as ancestral sampling.
+        :param in_place: see p_sample_loop_progressive_inpainting().
+        :return: a tuple of the inpainted images and the initial
+                 [noise, masked image, mask] input.
+        """
+        if device is None:
+            device = next(model.parameters()).device
+
+        masked_image = masked_image.to(device)
+        mask = mask.to(device)
+        noise = th.randn(*masked_image.shape, device=device)
+        x_noisy = th.cat((noise, masked_image, mask), dim=1).float()
+
+        final = None
+        for sample in self.ddim_sample_loop_progressive_inpainting(
+            model,
+            masked_image.shape,
+            noise=x_noisy,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            eta=eta,
+            in_place=in_place,
+        ):
+            final = sample
+        if final is not None:
+            return final["sample"], x_noisy
+        else:
+            return final, x_noisy
+
+    def ddim_sample_loop_progressive_inpainting(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        eta=0.0,
+        in_place=False,
+    ):
+        """
+        Use DDIM to inpaint and yield intermediate samples from each timestep
+        of DDIM.
+
+        Same usage as p_sample_loop_progressive_inpainting(). noise must hold
+        the [noise, masked image, mask] channels.
+
+        :param in_place: see p_sample_loop_progressive_inpainting().
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        assert noise is not None and noise.shape[1] == 3, (
+            "noise must hold the noise, the masked image and the mask"
+        )
+        img = noise.float().clone() if in_place else noise
+        indices = list(range(self.num_timesteps))[::-1]
+
+        masked_image = img[:, 1:2, ...]
+        mask = img[:, 2:3, ...]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        for i in indices:
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
+            if img.shape[1] != 3:
+                img = th.cat((img, masked_image, mask), dim=1).float()
+            with th.no_grad():
+                out = self.ddim_sample_inpainting(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                    eta=eta,
+                )
+                yield out
+                if in_place:
+                    img[:, 0:1, ...].copy_(out["sample"])
+                else:
+                    img = out["sample"]
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -1051,6 +1348,31 @@ class GaussianDiffusion:
         }
 
 
+# The arrays of GaussianDiffusion that are indexed by timestep, see _extract().
+SCHEDULE_ARRAYS = (
+    "betas",
+    "log_betas",
+    "alphas_cumprod",
+    "alphas_cumprod_prev",
+    "alphas_cumprod_next",
+    "one_minus_alphas_cumprod",
+    "sqrt_alphas_cumprod",
+    "sqrt_one_minus_alphas_cumprod",
+    "log_one_minus_alphas_cumprod",
+    "sqrt_recip_alphas_cumprod",
+    "sqrt_recipm1_alphas_cumprod",
+    "posterior_variance",
+    "posterior_log_variance_clipped",
+    "posterior_mean_coef1",
+    "posterior_mean_coef2",
+    "recip_posterior_mean_coef1",
+    "posterior_mean_coef2_over_coef1",
+    "large_variance",
+    "large_log_variance",
+)
+SCHEDULE_INDEX = {name: i for i, name in enumerate(SCHEDULE_ARRAYS)}
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
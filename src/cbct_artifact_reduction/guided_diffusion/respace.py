@@ -84,6 +84,8 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        # timestep_map as a tensor per device and dtype, see _WrappedModel
+        self._timestep_map_tensors = {}
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -105,7 +107,11 @@ class SpacedDiffusion(GaussianDiffusion):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model,
+            self.timestep_map,
+            self.rescale_timesteps,
+            self.original_num_steps,
+            self._timestep_map_tensors,
         )
 
     def _scale_timesteps(self, t):
@@ -114,14 +120,28 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(
+        self,
+        model,
+        timestep_map,
+        rescale_timesteps,
+        original_num_steps,
+        map_tensors=None,
+    ):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # shared by all wrappers of a diffusion, so the map is copied to each
+        # device only once instead of in every step
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        key = (ts.device, ts.dtype)
+        map_tensor = self.map_tensors.get(key)
+        if map_tensor is None:
+            map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+            self.map_tensors[key] = map_tensor
         new_ts = map_tensor[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
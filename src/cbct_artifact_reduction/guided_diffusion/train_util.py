@@ -39,6 +39,7 @@ class TrainLoop:
         weight_decay=0.0,
         lr_anneal_steps=0,
         step=0,
+        batch_preprocessor=None,
     ):
         self.model = model
         self.diffusion = diffusion
@@ -59,6 +60,8 @@ class TrainLoop:
         self.schedule_sampler = schedule_sampler or UniformSampler(diffusion)
         self.weight_decay = weight_decay
         self.lr_anneal_steps = lr_anneal_steps
+        # Normalizes raw batches on the device, see cbct_artifact_reduction.batchprocessing
+        self.batch_preprocessor = batch_preprocessor
 
         self.step = step
         self.resume_step = 0
@@ -157,11 +160,20 @@ class TrainLoop:
             or self.step + self.resume_step < self.lr_anneal_steps
         ):
             try:
-                batch, cond = next(self.data)
+                batch, cond, *extra = next(self.data)
             except StopIteration:
                 print("Epoch done")
                 return self.step
 
+            if self.batch_preprocessor is not None:
+                codes = extra[0] if extra else {}
+                batch = self.batch_preprocessor(
+                    batch.to(dist_util.dev()),
+                    codes.get("scanner_code"),
+                    codes.get("fov_code"),
+                )
+                cond = cond.to(dist_util.dev())
+
             batch = batch.float()
             cond = cond.float()
 
@@ -41,11 +41,93 @@ def generateCoordinates(x_loc, x_scale, y_loc, y_scale, random_state=None):
     return abs(floor(x)), abs(floor(y))
 
 
+def _slab_interval(offset: np.ndarray, slope: np.ndarray, half_width: np.ndarray):
+    """Return the interval of t with |offset + t * slope| <= half_width, elementwise. Empty intervals have lo > hi."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = (-half_width - offset) / slope
+        b = (half_width - offset) / slope
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b)
+    # A slab parallel to the rows contains either the whole row or nothing
+    flat = np.abs(slope) < 1e-9
+    inside = np.abs(offset) <= half_width
+    lo = np.where(flat, np.where(inside, -np.inf, np.inf), lo)
+    hi = np.where(flat, np.where(inside, np.inf, -np.inf), hi)
+    return lo, hi
+
+
+def rasterize_implants(
+    resolution: tuple[int, int],
+    heights: np.ndarray,
+    widths: np.ndarray,
+    angles: np.ndarray,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    owners: np.ndarray | None = None,
+    n: int | None = None,
+) -> np.ndarray:
+    """Rasterize rotated rectangles analytically, vectorized over all rectangles.
+
+    Keeps the pixels whose center is at least half a pixel inside the rectangle, with its bounding box placed like
+    ImplantMaskCreator.generate_mask does. This nearly matches rotating a rectangle of ones with ndimage.rotate: the
+    spline interpolation of ndimage.rotate drops a few more pixels at the corners and along rectangles that are one
+    pixel wide, so the rasterized masks can have some extra pixels on their edge. In every row, the pixels form one
+    interval of columns, which is computed from the two slabs that make up the oriented box and filled with a
+    cumulative sum.
+
+    Args:
+        resolution (tuple[int, int]): The resolution of the masks.
+        heights (np.ndarray): The height of each rectangle before rotating it.
+        widths (np.ndarray): The width of each rectangle before rotating it.
+        angles (np.ndarray): The counter-clockwise rotation of each rectangle in degrees.
+        xs (np.ndarray): The column of the center of each rectangle.
+        ys (np.ndarray): The row of the center of each rectangle.
+        owners (np.ndarray, optional): The mask each rectangle is drawn into. Defaults to one mask per rectangle.
+        n (int, optional): The number of masks. Defaults to one mask per rectangle.
+
+    Returns:
+        np.ndarray: Boolean masks of shape (n, *resolution).
+    """
+    if owners is None:
+        owners = np.arange(len(heights))
+        n = len(heights)
+    theta = np.deg2rad(angles)[:, None]
+    cos, sin = np.cos(theta), np.sin(theta)
+    heights = np.asarray(heights)[:, None]
+    widths = np.asarray(widths)[:, None]
+    # Shape of the bounding box of the rotated rectangle, computed like in ndimage.rotate
+    rotated_height = (heights * np.abs(cos) + widths * np.abs(sin) + 0.5).astype(int)
+    rotated_width = (heights * np.abs(sin) + widths * np.abs(cos) + 0.5).astype(int)
+    center_0 = np.asarray(ys)[:, None] - rotated_height // 2 + rotated_height / 2
+    center_1 = np.asarray(xs)[:, None] - rotated_width // 2 + rotated_width / 2
+
+    eps = 1e-6
+    dy = np.arange(resolution[0]) + 0.5 - center_0
+    lo_0, hi_0 = _slab_interval(dy * cos, sin, heights / 2 - 0.5 + eps)
+    lo_1, hi_1 = _slab_interval(-dy * sin, cos, widths / 2 - 0.5 + eps)
+    # Column j is inside if its center j + 0.5 - center_1 lies in both intervals
+    with np.errstate(invalid="ignore"):
+        start = np.ceil(np.maximum(lo_0, lo_1) + center_1 - 0.5)
+        end = np.floor(np.minimum(hi_0, hi_1) + center_1 - 0.5)
+    start = np.clip(start, 0, resolution[1])
+    end = np.clip(end, -1, resolution[1] - 1)
+    implant, row = np.nonzero(start <= end)
+
+    edges = np.zeros((n, resolution[0], resolution[1] + 1), dtype=np.int16)
+    np.add.at(edges, (owners[implant], row, start[implant, row].astype(int)), 1)
+    np.add.at(edges, (owners[implant], row, end[implant, row].astype(int) + 1), -1)
+    return np.cumsum(edges[..., :-1], axis=2) > 0
+
+
 class ImplantMaskCreator:
-    """Create random masks for implant regions."""
+    """Create random masks for implant regions.
+
+    Masks are returned with the given dtype, e.g. the dtype of the slices they are used with, so that no casts are
+    needed later on."""
 
-    def __init__(self, resolution: tuple[int, int]) -> None:
+    def __init__(self, resolution: tuple[int, int], dtype=int) -> None:
         self.resolution = resolution
+        self.dtype = np.dtype(dtype)
 
     def generate_mask(self, random_state=None) -> np.ndarray:
         h = generateRandomHeight(
@@ -102,7 +184,8 @@ class ImplantMaskCreator:
     def generate_mask_with_n_implants(self, n: int, random_state=None) -> np.ndarray:
         mask = np.zeros(self.resolution, dtype=int)
         for _ in range(n):
-            if random_state is not None:
+            # Integer seeds are chained through a hash, generators are passed on as they are
+            if isinstance(random_state, (int, np.integer)):
                 random_state = int.from_bytes(
                     hashlib.sha256(str(random_state).encode("utf-8")).digest()[:4],
                     "little",
@@ -111,23 +194,84 @@ class ImplantMaskCreator:
             implant = self.generate_mask(random_state=random_state)
             mask = mask + implant
 
-        mask = np.clip(mask, 0, 1)
+        mask = np.clip(mask, 0, 1).astype(self.dtype, copy=False)
         return mask
 
+    def sample_implant_parameters(
+        self, num_implants: int, rng: np.random.Generator
+    ) -> dict[str, np.ndarray]:
+        """Draw the height, width, rotation and position of implants from the same distributions as generate_mask."""
+        normal = rng.standard_normal((4, num_implants))
+        uniform = rng.random(num_implants)
+
+        heights = np.abs(
+            np.floor(self.resolution[1] / 2 + self.resolution[0] / 32 * normal[0])
+        )
+        widths = np.abs(
+            np.floor(self.resolution[1] * 7 / 110 + self.resolution[1] / 64 * normal[1])
+        )
+        return {
+            "heights": np.maximum(heights, 1).astype(int),
+            "widths": np.maximum(widths, 1).astype(int),
+            "angles": np.floor(20 * normal[2]),
+            "xs": np.abs(np.floor(self.resolution[0] * uniform)).astype(int),
+            "ys": np.abs(np.floor(self.resolution[1] // 2 + 0.1 * normal[3])).astype(
+                int
+            ),
+        }
+
+    def generate_batch(
+        self,
+        n: int,
+        lower: int,
+        upper: int,
+        rng: np.random.Generator | int | None = None,
+    ) -> np.ndarray:
+        """Generate n masks with a random amount of implants each, without scipy.
+
+        Masks follow the same distribution as generate_mask_with_random_amount_of_implants without a random_state.
+        All parameters are drawn at once from rng and all implants are rasterized together, see rasterize_implants.
+
+        Args:
+            n (int): The number of masks.
+            lower (int): The lower bound for the number of implants per mask.
+            upper (int): The exclusive upper bound for the number of implants per mask.
+            rng (np.random.Generator | int, optional): The generator or seed to draw from, e.g. the generator of the
+                current thread from a ThreadLocalRNG. Defaults to a fresh generator.
+
+        Returns:
+            np.ndarray: Boolean masks of shape (n, *resolution).
+        """
+        rng = np.random.default_rng(rng)
+        counts = rng.integers(lower, upper, size=n)
+        parameters = self.sample_implant_parameters(int(counts.sum()), rng)
+        return rasterize_implants(
+            self.resolution, **parameters, owners=np.repeat(np.arange(n), counts), n=n
+        )
+
     def generate_mask_with_random_amount_of_implants(
         self, lower, upper, random_state=None
     ) -> np.ndarray:
         """Generate a mask with a random amount of implants.
 
+        The global numpy RNG is never used or reseeded, so this is safe to call from several threads.
+
         Args:
             lower (int): The lower bound for the number of implants.
             upper (int): The upper bound for the number of implants.
+            random_state (int | np.random.Generator, optional): An integer seed always gives the same mask. A
+                generator is drawn from. Defaults to a fresh generator.
 
         Returns:
             np.ndarray: The generated mask.
         """
-        np.random.seed(random_state)
-        n = np.random.randint(lower, upper)
+        if random_state is None or isinstance(random_state, np.random.Generator):
+            rng = np.random.default_rng(random_state)
+            n = rng.integers(lower, upper)
+            return self.generate_mask_with_n_implants(n, random_state=rng)
+
+        # A private RandomState draws the same amount as seeding the global RNG did, so fixed masks stay the same
+        n = np.random.RandomState(random_state).randint(lower, upper)
         return self.generate_mask_with_n_implants(n, random_state=random_state)
 
 
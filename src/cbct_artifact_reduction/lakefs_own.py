@@ -1,16 +1,32 @@
+import bisect
+import functools
 import hashlib
+import io
 import os
+import threading
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
 import lakefs
+from boto3.exceptions import S3TransferFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
 from lakefs.client import Client
+from tqdm import tqdm
 
 import cbct_artifact_reduction.config as cfg
+from cbct_artifact_reduction.localcache import LocalFileCache, MemoryCache
+from cbct_artifact_reduction.sliceindex import SliceIndex
 
 REPO = "cbct-pig-jaws"
 BRANCH = "processed_data"
 
+CONTENT_DIRECTORY = "objects"
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
 
 class CustomLakeFSClient:
     def __init__(self, repo: str) -> None:
@@ -45,18 +61,259 @@ class CustomLakeFSClient:
         )
 
 
+class LakeFSError(Exception):
+    """Base class of errors while accessing LakeFS through the S3 gateway."""
+
+    def __init__(self, object_name: str | None, message: str) -> None:
+        super().__init__(message)
+        self.object_name = object_name
+
+
+class ObjectNotFoundError(LakeFSError):
+    """The object does not exist in the repository."""
+
+
+class ThrottlingError(LakeFSError):
+    """LakeFS kept rejecting requests because of too many requests, even after retrying."""
+
+
+class DownloadError(LakeFSError):
+    """Any other error while downloading an object, e.g. connection or permission problems."""
+
+
+NOT_FOUND_ERROR_CODES = {"404", "NoSuchKey", "NotFound"}
+THROTTLING_ERROR_CODES = {
+    "429",
+    "503",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequests",
+    "RequestLimitExceeded",
+}
+
+
+def translate_error(error: Exception, object_name: str | None) -> LakeFSError:
+    """Map a botocore exception to the matching LakeFSError."""
+    if isinstance(error, LakeFSError):
+        return error
+    if isinstance(error, ClientError):
+        code = str(error.response.get("Error", {}).get("Code", ""))
+        if code in NOT_FOUND_ERROR_CODES:
+            return ObjectNotFoundError(object_name, f"{object_name} not found: {error}")
+        if code in THROTTLING_ERROR_CODES:
+            return ThrottlingError(
+                object_name, f"Throttled while downloading {object_name}: {error}"
+            )
+    return DownloadError(object_name, f"Could not download {object_name}: {error}")
+
+
+def _suffix(object_name: str) -> str:
+    """Return the last two extensions of an object name, e.g. '.nii.gz'."""
+    return "." + ".".join(object_name.split(".")[-2:])
+
+
+def validate_etag(checksum: str, etag: str, object_name: str):
+    """Check the md5 of a downloaded object against its ETag.
+
+    The ETag of an object that was uploaded in a single part is the md5 of its content. ETags of multipart uploads
+    contain a '-' and are not an md5 of the content, they are not checked.
+
+    Raises:
+        DownloadError: If the checksum differs from the ETag.
+    """
+    if "-" in etag:
+        return
+    if checksum != etag:
+        raise DownloadError(
+            object_name,
+            f"checksum {checksum} of the downloaded object does not match ETag {etag}",
+        )
+
+
+def create_s3_client(
+    max_pool_connections: int = 10, max_attempts: int = 10, retry_mode: str = "adaptive"
+):
+    """Create a boto3 S3 client for the LakeFS S3 gateway.
+
+    Args:
+        max_pool_connections (int): Size of the connection pool, should be at least the number of threads that use the client.
+        max_attempts (int): Maximum number of attempts per request, including the first one.
+        retry_mode (str): The botocore retry mode. 'adaptive' backs off exponentially and rate limits the client
+            when LakeFS throttles.
+    """
+    return boto3.client(
+        "s3",
+        endpoint_url=cfg.LAKEFS_HOST,
+        aws_access_key_id=cfg.LAKEFS_USERNAME,
+        aws_secret_access_key=cfg.LAKEFS_PASSWORD,
+        verify=cfg.LAKEFS_SSL_CA_CERT,
+        config=BotoConfig(
+            max_pool_connections=max_pool_connections,
+            retries={"max_attempts": max_attempts, "mode": retry_mode},
+        ),
+    )
+
+
+class LatencyHistogram:
+    """Histogram of request latencies with fixed, roughly logarithmic buckets."""
+
+    BUCKETS_MS: tuple[float, ...] = (
+        1,
+        2,
+        5,
+        10,
+        20,
+        50,
+        100,
+        200,
+        500,
+        1000,
+        2000,
+        5000,
+        10000,
+        float("inf"),
+    )
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(self.BUCKETS_MS)
+        self.count = 0
+        self.total_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        bucket = bisect.bisect_left(self.BUCKETS_MS, seconds * 1000)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total_seconds += seconds
+
+    def quantile(self, q: float) -> float:
+        """Return the upper bound in milliseconds of the bucket that contains the q-quantile."""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return 0.0
+        cumulative = 0
+        for upper, bucket_count in zip(self.BUCKETS_MS, counts):
+            cumulative += bucket_count
+            if cumulative >= q * count:
+                return upper
+        return self.BUCKETS_MS[-1]
+
+    def summary(self) -> dict:
+        """Return count, mean and approximate p50/p95/p99 in milliseconds and the count per bucket."""
+        with self._lock:
+            count = self.count
+            mean_ms = 1000 * self.total_seconds / count if count else 0.0
+            buckets = {
+                f"<={upper}ms": n for upper, n in zip(self.BUCKETS_MS, self.counts)
+            }
+        return {
+            "count": count,
+            "mean_ms": mean_ms,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
 class CustomBoto3Client:
+    """Access the LakeFS S3 gateway with a local cache.
+
+    The underlying boto3 client is created lazily and again in every process that uses this object, so DataLoader
+    workers and DDP ranks each get their own connection pool instead of sharing sockets that were opened before fork.
+
+    Cache entries are keyed by the LakeFS commit (branch) and the object name, so switching commits never serves files
+    of another commit. The content of each entry is stored once per ETag in the 'objects' directory of the cache and
+    hardlinked into the entries, so an object that did not change between two commits is not downloaded again.
+    """
+
     def __init__(self, repo: str) -> None:
         self.repo = repo
-        self.client = boto3.client(
-            "s3",
-            endpoint_url=cfg.LAKEFS_HOST,
-            aws_access_key_id=cfg.LAKEFS_USERNAME,
-            aws_secret_access_key=cfg.LAKEFS_PASSWORD,
-            verify=cfg.LAKEFS_SSL_CA_CERT,
-        )
+        self.max_pool_connections = cfg.LAKEFS_MAX_POOL_CONNECTIONS
+        self.max_attempts = cfg.LAKEFS_MAX_ATTEMPTS
         self.branch = cfg.LAKEFS_COMMIT
+        self.cache_max_bytes = cfg.CACHE_MAX_BYTES
         self.cache_path = cfg.CACHE_PATH
+        self.memory_cache = (
+            MemoryCache(cfg.MEMORY_CACHE_MAX_BYTES)
+            if cfg.MEMORY_CACHE_MAX_BYTES
+            else None
+        )
+        self.request_latency = LatencyHistogram()
+
+        self._client = None
+        self._client_pid: int | None = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The boto3 client of the current process."""
+        if self._client is None or self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = create_s3_client(
+                        self.max_pool_connections, self.max_attempts
+                    )
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_client"] = None
+        state["_client_pid"] = None
+        del state["_client_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._client_lock = threading.Lock()
+
+    def latency_stats(self) -> dict:
+        """Return the latency histogram of the downloads of this process."""
+        return self.request_latency.summary()
+
+    @property
+    def cache_path(self) -> str:
+        return self.cache.cache_path
+
+    @cache_path.setter
+    def cache_path(self, cache_path: str) -> None:
+        self.content_cache = (
+            LocalFileCache(os.path.join(cache_path, CONTENT_DIRECTORY))
+            if cache_path
+            else None
+        )
+        self.cache = LocalFileCache(
+            cache_path, self.cache_max_bytes, content_cache=self.content_cache
+        )
+
+    def cache_stats(self) -> dict[str, int]:
+        """Return the hit, miss and eviction counters of the local cache of this process.
+
+        'deduplicated' counts misses that were served by linking the unchanged content of another commit.
+        """
+        stats = self.cache.stats()
+        stats["deduplicated"] = self.content_cache.hits if self.content_cache else 0
+        return stats
+
+    def memory_cache_stats(self) -> dict[str, int] | None:
+        """Return the counters of the in-memory cache of this process, None if it is disabled."""
+        if self.memory_cache is None:
+            return None
+        return self.memory_cache.stats()
 
     def list_files_in_folder(self, folder: str):
         paginator = self.client.get_paginator("list_objects_v2")
@@ -71,34 +328,254 @@ class CustomBoto3Client:
 
         return filenames
 
+    def list_object_names(self, prefix: str) -> list[str]:
+        """List the names of all objects whose name starts with prefix, e.g. 'processed_data/frames/256x256/'."""
+        paginator = self.client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(Bucket=self.repo, Prefix=prefix)
+        return [obj["Key"] for page in pages for obj in page.get("Contents", [])]
+
+    def local_filename(self, object_name: str) -> str:
+        """Return the name of the file in the local cache that holds object_name at the current commit."""
+        key = f"{self.branch}:{object_name}"
+        return hashlib.md5(key.encode("utf-8")).hexdigest() + _suffix(object_name)
+
+    def _fetch_object(
+        self, object_name: str, local_path: str, config: TransferConfig | None = None
+    ):
+        """Write object_name to local_path, linking the content from the content cache if its ETag is known.
+
+        The object is requested with a single GET. Its ETag comes with the response headers, so the body is only read
+        if the content is not cached yet. The md5 of the body is computed while writing it and checked against the
+        ETag, see validate_etag. Objects above the multipart threshold of a config with several threads are
+        downloaded in parallel parts instead. Those parts can't be tied to the ETag of the GET, so these objects are
+        not deduplicated.
+        """
+        if self.content_cache is None:
+            self.download_file(object_name, local_path, config=config)
+            return
+
+        try:
+            response = self.client.get_object(Bucket=self.repo, Key=object_name)
+        except (BotoCoreError, ClientError) as e:
+            raise translate_error(e, object_name) from e
+        etag = response["ETag"].strip('"')
+        body = response["Body"]
+        if (
+            config is not None
+            and config.max_concurrency > 1
+            and response["ContentLength"] >= config.multipart_threshold
+        ):
+            body.close()
+            self.download_file(object_name, local_path, config=config)
+            return
+
+        def download(tmp_path: str):
+            print(f"Cache miss. Download object {object_name}")
+            start = time.perf_counter()
+            md5 = hashlib.md5()
+            try:
+                with open(tmp_path, "wb") as f:
+                    for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                        md5.update(chunk)
+                        f.write(chunk)
+            except BotoCoreError as e:
+                raise translate_error(e, object_name) from e
+            finally:
+                self.request_latency.record(time.perf_counter() - start)
+            # get_linked removes the temporary file if the check fails
+            validate_etag(md5.hexdigest(), etag, object_name)
+
+        try:
+            self.content_cache.get_linked(
+                etag + _suffix(object_name), local_path, download
+            )
+        finally:
+            body.close()
+
+    def is_cached(self, object_name: str) -> bool:
+        return os.path.exists(self.cache.path_for(self.local_filename(object_name)))
+
+    def download_file(
+        self, object_name: str, local_path: str, config: TransferConfig | None = None
+    ):
+        """Download object_name to local_path without using the cache.
+
+        Raises:
+            ObjectNotFoundError: If the object does not exist.
+            ThrottlingError: If LakeFS still throttles after all retries.
+            DownloadError: For any other error.
+        """
+        start = time.perf_counter()
+        try:
+            self.client.download_file(self.repo, object_name, local_path, Config=config)
+        except (BotoCoreError, ClientError, S3TransferFailedError) as e:
+            raise translate_error(e, object_name) from e
+        finally:
+            self.request_latency.record(time.perf_counter() - start)
+
+    def prefetch(
+        self,
+        object_names: list[str],
+        max_workers: int = 8,
+        max_concurrency: int = 1,
+        show_progress: bool = True,
+    ) -> dict:
+        """Download all objects that are not in the local cache yet with a pool of threads.
+
+        Objects that are already cached are skipped, so an interrupted prefetch can simply be started again.
+
+        Args:
+            object_names (list[str]): The objects to cache.
+            max_workers (int): Number of objects that are downloaded at the same time.
+            max_concurrency (int): Number of boto3 transfer threads per object, only helps for large objects.
+            show_progress (bool): Whether to show a progress bar with the throughput.
+
+        Returns:
+            dict: The amount of requested, already cached, downloaded and failed objects, the failed object names,
+                the downloaded bytes and the duration in seconds. 'deduplicated' of the downloaded objects were linked
+                from an unchanged object of another commit instead of being downloaded.
+        """
+        if max_workers * max_concurrency > self.max_pool_connections:
+            warnings.warn(
+                f"{max_workers * max_concurrency} download threads share {self.max_pool_connections} connections, "
+                "increase lakefs.max_pool_connections in config.yaml"
+            )
+        object_names = list(dict.fromkeys(object_names))
+        missing = [name for name in object_names if not self.is_cached(name)]
+        deduplicated_before = self.cache_stats()["deduplicated"]
+        transfer_config = TransferConfig(
+            max_concurrency=max_concurrency, use_threads=max_concurrency > 1
+        )
+
+        failed = []
+        downloaded_bytes = 0
+        start = time.perf_counter()
+        with (
+            ThreadPoolExecutor(max_workers=max_workers) as executor,
+            tqdm(
+                total=len(missing), unit="file", disable=not show_progress
+            ) as progress,
+        ):
+            futures = {
+                executor.submit(
+                    self.cache.get,
+                    self.local_filename(name),
+                    functools.partial(self._fetch_object, name, config=transfer_config),
+                ): name
+                for name in missing
+            }
+            for future in as_completed(futures):
+                try:
+                    downloaded_bytes += os.path.getsize(future.result())
+                except (LakeFSError, OSError) as e:
+                    failed.append(futures[future])
+                    warnings.warn(str(e))
+                progress.update(1)
+                elapsed = time.perf_counter() - start
+                progress.set_postfix(MBps=f"{downloaded_bytes / 1e6 / elapsed:.1f}")
+
+        return {
+            "requested": len(object_names),
+            "cached": len(object_names) - len(missing),
+            "downloaded": len(missing) - len(failed),
+            "deduplicated": self.cache_stats()["deduplicated"] - deduplicated_before,
+            "failed": len(failed),
+            "failed_object_names": failed,
+            "bytes": downloaded_bytes,
+            "seconds": time.perf_counter() - start,
+        }
+
+    def prefetch_prefix(self, prefix: str, **kwargs) -> dict:
+        """Prefetch all objects whose name starts with prefix. See prefetch for the arguments."""
+        return self.prefetch(self.list_object_names(prefix), **kwargs)
+
+    def prefetch_specification(
+        self,
+        data_specification_path: str,
+        slice_directory_path: str,
+        extension: str = ".nii.gz",
+        **kwargs,
+    ) -> dict:
+        """Prefetch all slices listed in a data specification csv like training_data.csv. See prefetch for the arguments."""
+        index = SliceIndex.from_specification(data_specification_path)
+        object_names = [
+            os.path.join(slice_directory_path, index.filename(idx, extension))
+            for idx in range(len(index))
+        ]
+        return self.prefetch(object_names, **kwargs)
+
     def get_file(self, object_name, file_obj=None):
         """Load the file from the S3 storage to the local disk or directly into the ram. If caching is activated, a
-        local cache is used"""
+        local cache is used. If file_obj is given, the object is written into it and file_obj is returned, see also
+        get_bytes.
+
+        Downloads go to a temporary file that is renamed into the cache, and concurrent calls for the same object
+        from other processes wait for the first download instead of starting their own. Objects whose ETag, taken from
+        the response of the GET, is already cached are linked instead of downloaded, see _fetch_object. If
+        cache_max_bytes is set, the least recently used files are evicted.
+
+        Raises:
+            ObjectNotFoundError: If the object does not exist.
+            ThrottlingError: If LakeFS still throttles after all retries.
+            DownloadError: For any other error, including a download that does not match its ETag."""
         local_path = None
 
         if file_obj is None:
             # download the file into the local cache if it is not already in the cache
-            suffix = "." + ".".join(object_name.split(".")[-2:])
-            local_filename = (
-                hashlib.md5(object_name.encode("utf-8")).hexdigest() + suffix
+            local_path = self.cache.get(
+                self.local_filename(object_name),
+                functools.partial(self._fetch_object, object_name),
             )
-            local_path = os.path.join(self.cache_path, local_filename)
-
-            if not os.path.exists(local_path):
-                try:
-                    print(f"Cache miss. Download object {object_name}")
-                    self.client.download_file(self.repo, object_name, local_path)
-                except:
-                    local_path = None
-                    warnings.warn(
-                        "An error occurred during downloading the file from lakefs"
-                    )
         else:
             # download the object to a file buffer
-            self.client.download_fileobj(self.repo, object_name, file_obj)
+            start = time.perf_counter()
+            try:
+                self.client.download_fileobj(self.repo, object_name, file_obj)
+            except (BotoCoreError, ClientError, S3TransferFailedError) as e:
+                raise translate_error(e, object_name) from e
+            finally:
+                self.request_latency.record(time.perf_counter() - start)
+            file_obj.seek(0)
+            return file_obj
 
         return local_path
 
+    def get_bytes(self, object_name: str) -> bytes:
+        """Load the contents of an object into memory without writing it to disk.
+
+        The in-memory cache is checked first, then the local cache on disk. On a miss of both, the object is
+        downloaded into a buffer and only kept in the in-memory cache. Meant for small objects like 2d slices.
+
+        Raises:
+            ObjectNotFoundError: If the object does not exist.
+            ThrottlingError: If LakeFS still throttles after all retries.
+            DownloadError: For any other error.
+        """
+        local_filename = self.local_filename(object_name)
+        if self.memory_cache is not None:
+            data = self.memory_cache.get(local_filename)
+            if data is not None:
+                return data
+
+        data = None
+        if self.cache_path:
+            local_path = self.cache.path_for(local_filename)
+            try:
+                with open(local_path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                # Mark the entry as recently used like a hit of get_file does
+                self.cache._touch(local_path)
+                self.cache._count(hits=1)
+        if data is None:
+            data = self.get_file(object_name, io.BytesIO()).getvalue()
+
+        if self.memory_cache is not None:
+            self.memory_cache.put(local_filename, data)
+        return data
+
 
 if __name__ == "__main__":
     # customLakeFSClient = CustomLakeFSClient(REPO)
@@ -0,0 +1,421 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from contextlib import contextmanager
+
+LOCK_DIRECTORY = ".locks"
+NUM_LOCK_STRIPES = 256
+TMP_SUFFIX = ".tmp"
+
+
+class LocalFileCache:
+    """A directory of cached files with an optional byte budget, shared safely between processes.
+
+    Files are downloaded to a temporary file and renamed into place, so a file in the cache is always complete. Only
+    one process or thread fetches a given key at a time, the others wait for it and then use the cached file. Keys are
+    mapped to one of NUM_LOCK_STRIPES lock files, so unrelated keys rarely wait for each other.
+
+    If max_bytes is set, the least recently used files are removed once the cache grows beyond it. Hits update the
+    modification time of a file, which is used as its last access time.
+
+    A second LocalFileCache can be attached as content_cache to store each distinct file content once. Entries of this
+    cache are then hardlinks into the content cache, see get_linked, and content files that are no longer linked from
+    any entry are removed together with the evicted entries. Content files that are not linked, e.g. because the file
+    system doesn't support hardlinks and the entries are copies, count against max_bytes as well.
+
+    Attributes:
+        cache_path (str): The directory of the cache.
+        max_bytes (int | None): The byte budget of the cache. None means unlimited.
+        hits (int): Number of get calls of this process that found the file in the cache.
+        misses (int): Number of get calls of this process that had to fetch the file.
+        evictions (int): Number of files this process removed from the cache.
+        evicted_bytes (int): Size of the files this process removed from the cache.
+        content_cache (LocalFileCache | None): The cache the entries of this cache are hardlinked from, if any.
+    """
+
+    def __init__(
+        self,
+        cache_path: str,
+        max_bytes: int | None = None,
+        rescan_interval: int = 256,
+        content_cache: "LocalFileCache | None" = None,
+    ) -> None:
+        """Initializes the cache.
+
+        Args:
+            cache_path (str): The directory of the cache. Is created on the first miss if it doesn't exist.
+            max_bytes (int, optional): The byte budget of the cache. Defaults to None, which means unlimited.
+            rescan_interval (int): Other processes add files as well, so the size of the cache is measured again after
+                this many misses.
+            content_cache (LocalFileCache, optional): A cache whose files are linked into this cache. Unlinked files
+                are pruned from it whenever this cache evicts files.
+        """
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self.content_cache = content_cache
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+        self._approx_bytes: int | None = None
+        self._misses_since_scan = 0
+        self._counter_lock = threading.Lock()
+
+    def path_for(self, local_filename: str) -> str:
+        return os.path.join(self.cache_path, local_filename)
+
+    @contextmanager
+    def lock(self, local_filename: str, blocking: bool = True):
+        """Hold the exclusive lock of a cache entry.
+
+        Args:
+            local_filename (str): The name of the entry.
+            blocking (bool): Whether to wait for the lock. If False, the context yields False instead of waiting when
+                another process or thread holds the lock.
+
+        Yields:
+            bool: Whether the lock is held.
+        """
+        stripe = int(hashlib.md5(local_filename.encode("utf-8")).hexdigest(), 16)
+        lock_directory = os.path.join(self.cache_path, LOCK_DIRECTORY)
+        os.makedirs(lock_directory, exist_ok=True)
+        lock_path = os.path.join(lock_directory, f"{stripe % NUM_LOCK_STRIPES}.lock")
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(
+                    lock_file,
+                    fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB,
+                )
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, local_filename: str, fetch: Callable[[str], None]) -> str:
+        """Return the path of a cached file and fetch it first if it is not in the cache.
+
+        Args:
+            local_filename (str): The name of the file in the cache.
+            fetch (Callable[[str], None]): Writes the file to the path it is given. Exceptions are propagated and
+                leave the cache unchanged.
+
+        Returns:
+            str: The path of the file in the cache.
+        """
+        local_path = self.path_for(local_filename)
+        if self._touch(local_path):
+            self._count(hits=1)
+            return local_path
+
+        with self.lock(local_filename):
+            # Another process might have fetched the file while we were waiting for the lock.
+            if self._touch(local_path):
+                self._count(hits=1)
+                return local_path
+
+            tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}"
+            try:
+                fetch(tmp_path)
+                os.replace(tmp_path, local_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        self._count(misses=1)
+        self._account(self._charged_size(local_path), protected=local_path)
+        return local_path
+
+    def get_linked(
+        self, local_filename: str, link_path: str, fetch: Callable[[str], None]
+    ) -> bool:
+        """Hardlink a cached file to link_path and fetch it first if it is not in the cache.
+
+        The link is created while holding the lock of the entry, so prune_unlinked can't remove the file in between.
+        If the file system doesn't support hardlinks, the file is copied instead.
+
+        Args:
+            local_filename (str): The name of the file in the cache.
+            link_path (str): The path of the link to create. Must not exist.
+            fetch (Callable[[str], None]): Writes the file to the path it is given, see get.
+
+        Returns:
+            bool: Whether the file was already in the cache.
+        """
+        local_path = self.path_for(local_filename)
+        with self.lock(local_filename):
+            hit = self._touch(local_path)
+            if not hit:
+                tmp_path = (
+                    f"{local_path}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}"
+                )
+                try:
+                    fetch(tmp_path)
+                    os.replace(tmp_path, local_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            try:
+                os.link(local_path, link_path)
+            except OSError:
+                shutil.copyfile(local_path, link_path)
+
+        self._count(hits=int(hit), misses=int(not hit))
+        return hit
+
+    def unlinked_size(self) -> int:
+        """Return the size of the files that are not hardlinked from anywhere else in bytes, see prune_unlinked."""
+        if not os.path.isdir(self.cache_path):
+            return 0
+        total = 0
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink == 1:
+                total += stat.st_size
+        return total
+
+    def prune_unlinked(self) -> int:
+        """Remove the files that are not hardlinked from anywhere else.
+
+        Returns:
+            int: The number of removed files.
+        """
+        if not os.path.isdir(self.cache_path):
+            return 0
+        removed = 0
+        for entry in self.entries():
+            with self.lock(entry.name):
+                try:
+                    if os.stat(entry.path).st_nlink > 1:
+                        continue
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+            removed += 1
+        return removed
+
+    def _touch(self, local_path: str) -> bool:
+        try:
+            os.utime(local_path)
+        except FileNotFoundError:
+            return False
+        except PermissionError:
+            # The file belongs to another user, it is still a valid cache entry.
+            pass
+        return True
+
+    def _charged_size(self, local_path: str) -> int:
+        """Return the bytes a new entry adds to the cache, twice its size if it is a copy of a content file."""
+        stat = os.stat(local_path)
+        if self.content_cache is not None and stat.st_nlink == 1:
+            return 2 * stat.st_size
+        return stat.st_size
+
+    def _count(self, hits: int = 0, misses: int = 0):
+        with self._counter_lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _account(self, size: int, protected: str | None = None):
+        if self.max_bytes is None:
+            return
+        with self._counter_lock:
+            self._misses_since_scan += 1
+            rescan = (
+                self._approx_bytes is None
+                or self._misses_since_scan >= self.rescan_interval
+            )
+            if not rescan:
+                self._approx_bytes += size
+                rescan = self._approx_bytes > self.max_bytes
+        if rescan:
+            self.evict(protected=protected)
+
+    def entries(self) -> list[os.DirEntry]:
+        """Return the complete files in the cache."""
+        with os.scandir(self.cache_path) as it:
+            return [
+                entry
+                for entry in it
+                if entry.is_file()
+                and not entry.name.startswith(".")
+                and not entry.name.endswith(TMP_SUFFIX)
+            ]
+
+    def size(self) -> int:
+        """Return the size of all files in the cache in bytes."""
+        total = 0
+        for entry in self.entries():
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def evict(self, protected: str | None = None) -> int:
+        """Remove least recently used files until the cache fits into max_bytes.
+
+        Every file is removed while holding the lock of its entry. Entries whose lock is held by someone else and
+        entries that were used after the cache was scanned are skipped, so the cache can stay above max_bytes until the
+        next eviction.
+
+        Args:
+            protected (str, optional): A path that is never removed, e.g. the file that was just fetched.
+
+        Returns:
+            int: The number of removed files.
+        """
+        entries = []
+        total = 0
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        unlinked = self.content_cache.unlinked_size() if self.content_cache else 0
+        total += unlinked
+
+        removed = 0
+        if self.max_bytes is not None and total > self.max_bytes:
+            if unlinked:
+                self.content_cache.prune_unlinked()
+                total -= unlinked
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == protected:
+                    continue
+                # Entries that are being fetched or replaced right now are skipped instead of waited for
+                with self.lock(os.path.basename(path), blocking=False) as locked:
+                    if not locked:
+                        continue
+                    try:
+                        if os.stat(path).st_mtime != mtime:
+                            # Used since the scan, it is no longer the least recently used
+                            continue
+                        os.remove(path)
+                    except FileNotFoundError:
+                        # Already evicted by another process
+                        pass
+                    else:
+                        removed += 1
+                        with self._counter_lock:
+                            self.evictions += 1
+                            self.evicted_bytes += size
+                total -= size
+
+        with self._counter_lock:
+            self._approx_bytes = total
+            self._misses_since_scan = 0
+        if removed and self.content_cache is not None:
+            self.content_cache.prune_unlinked()
+        return removed
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_counter_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._counter_lock = threading.Lock()
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit, miss and eviction counters of this process."""
+        with self._counter_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+
+class MemoryCache:
+    """A size-bounded in-memory cache of file contents with LRU eviction.
+
+    Meant as a tier in front of LocalFileCache for small objects. Every process has its own MemoryCache.
+
+    Attributes:
+        max_bytes (int): The byte budget of the cache.
+        hits (int): Number of get calls that found the key.
+        misses (int): Number of get calls that didn't find the key.
+        evictions (int): Number of entries removed to stay within max_bytes.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        """Store data under key. Data larger than max_bytes is not stored."""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self.size,
+            }
+
+    def __getstate__(self):
+        # The cached contents stay in the process that fetched them.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_entries"] = OrderedDict()
+        state["size"] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,104 @@
+import hashlib
+
+import numpy as np
+
+from cbct_artifact_reduction.implantmaskcreator import ImplantMaskCreator
+from cbct_artifact_reduction.sliceindex import mmap_npz, save_npz
+
+
+def bank_index(key: str, size: int) -> int:
+    """Map a key, e.g. a slice filename, to a position in a bank of size masks. Doesn't depend on any RNG state."""
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") % size
+
+
+class MaskBank:
+    """A fixed set of precomputed implant masks, stored bit-packed in an uncompressed .npz file.
+
+    Each mask takes one bit per pixel, 1000 masks of 256x256 take 8 MB. The bank is memory-mapped, so looking up a
+    mask reads and unpacks a single row and DataLoader workers share the bank through the page cache.
+
+    Attributes:
+        packed (np.ndarray): The masks packed along the last axis with np.packbits, shape (K, H, ceil(W / 8)).
+        resolution (tuple[int, int]): The resolution of the masks.
+        npz_path (str | None): The file the bank is memory-mapped from.
+    """
+
+    def __init__(self, packed: np.ndarray, resolution: tuple[int, int]) -> None:
+        self.packed = packed
+        self.resolution = resolution
+        self.npz_path: str | None = None
+
+    @classmethod
+    def create(
+        cls,
+        size: int,
+        resolution: tuple[int, int],
+        lower: int = 1,
+        upper: int = 4,
+        seed: int = 0,
+        batch_size: int = 256,
+    ) -> "MaskBank":
+        """Generate a bank of masks with lower to upper - 1 implants each with ImplantMaskCreator.generate_batch.
+
+        Args:
+            size (int): The number of masks.
+            resolution (tuple[int, int]): The resolution of the masks.
+            lower (int): The lower bound for the number of implants per mask.
+            upper (int): The exclusive upper bound for the number of implants per mask.
+            seed (int): The seed of the generator, the same seed and batch_size give the same bank.
+            batch_size (int): How many masks are generated at once.
+        """
+        creator = ImplantMaskCreator(resolution)
+        rng = np.random.default_rng(seed)
+        packed = np.concatenate(
+            [
+                np.packbits(
+                    creator.generate_batch(
+                        min(batch_size, size - start), lower, upper, rng
+                    ),
+                    axis=-1,
+                )
+                for start in range(0, size, batch_size)
+            ]
+        )
+        return cls(packed, tuple(resolution))
+
+    @classmethod
+    def load(cls, npz_path: str) -> "MaskBank":
+        """Memory-map a bank that was written with save."""
+        arrays = mmap_npz(npz_path)
+        bank = cls(arrays["packed"], tuple(int(r) for r in arrays["resolution"]))
+        bank.npz_path = npz_path
+        return bank
+
+    def save(self, npz_path: str):
+        save_npz(
+            npz_path,
+            packed=np.asarray(self.packed),
+            resolution=np.array(self.resolution, dtype=np.int64),
+        )
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        """Unpack the idx-th mask as a bool array."""
+        return np.unpackbits(self.packed[idx], axis=-1, count=self.resolution[1]).view(
+            bool
+        )
+
+    def mask_for(self, key: str) -> np.ndarray:
+        """Return the mask that belongs to key, always the same one for the same key and bank."""
+        return self[bank_index(key, len(self))]
+
+    def __getstate__(self):
+        # Memory-mapped banks are mapped again in the unpickling process instead of being copied.
+        if self.npz_path is not None:
+            return {"npz_path": self.npz_path}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if set(state) == {"npz_path"}:
+            state = MaskBank.load(state["npz_path"]).__dict__
+        self.__dict__.update(state)
@@ -3,15 +3,24 @@ import os
 import re
 
 import numpy as np
+import torch
 from torch.utils.data.dataset import Dataset
 
 import cbct_artifact_reduction.implantmaskcreator as imc
+from cbct_artifact_reduction.batchprocessing import as_resolution, resize_batch
 from cbct_artifact_reduction.dataprocessing import (
+    clip_and_scale,
     min_max_normalize,
+    nifti_bytes_to_numpy,
     remove_outliers,
+    scanner_log_scale,
     single_nifti_to_numpy,
 )
 from cbct_artifact_reduction.lakefs_own import CustomBoto3Client
+from cbct_artifact_reduction.maskbank import MaskBank
+from cbct_artifact_reduction.rng import ThreadLocalRNG
+from cbct_artifact_reduction.sliceindex import SliceIndex
+from cbct_artifact_reduction.slicestats import NORMALIZATIONS, SliceStats
 from cbct_artifact_reduction.utils import lookup_num_in_datatable
 
 
@@ -55,6 +64,16 @@ class InpaintingSliceDataset(Dataset):
         slice_directory_path: str,
         random_masks: bool = True,
         return_info: bool = False,
+        use_index_sidecar: bool = True,
+        in_memory: bool = False,
+        normalization_stats_path: str | None = None,
+        normalization: str = "slice",
+        batch_preprocessing: bool = False,
+        dtype: np.dtype | type = np.float32,
+        mask_bank_path: str | None = None,
+        seed: int | None = None,
+        resolution: int | tuple[int, int] | None = None,
+        slice_extension: str = ".nii.gz",
     ) -> None:
         """Initializes the dataset.
 
@@ -64,6 +83,29 @@ class InpaintingSliceDataset(Dataset):
             relative_slice_directory_path (str): The relative path to the remote/local directory containing the slices.
             random_masks (bool): Whether to generate random masks or use the random generated masks with the hash of the file name.
             return_info (bool): Whether to return the info of the slices or not.
+            use_index_sidecar (bool): Whether to store the slice index in a memory-mapped .npz file next to the data specification file.
+            in_memory (bool): Whether to decode the slices from memory with lakefs_loader.get_bytes instead of going through files on disk.
+            normalization_stats_path (str, optional): The path to the statistics computed with
+                scripts/compute_slice_stats.py. If given, the slices are normalized with the precomputed quantiles
+                instead of computing them for every sample.
+            normalization (str): One of "slice", "volume" or "scanner". Whether to clip the slices to their own
+                quantiles or to the quantiles of their volume or scanner. The latter two need normalization_stats_path.
+            batch_preprocessing (bool): Whether to return the raw slices together with their scanner and fov codes
+                instead of normalizing them, so that whole batches can be normalized with BatchPreprocessor.
+            dtype (np.dtype): The float dtype the slices and masks are returned in, float32 or float16. Slices are
+                read and normalized in float32 at least, raw values don't fit into float16.
+            mask_bank_path (str, optional): The path to a mask bank created with scripts/create_masks.py. If given and
+                random_masks is False, the fixed mask of each slice is looked up in the bank by its filename instead
+                of being generated.
+            seed (int, optional): The seed of the random masks. Every thread and, with worker_init_fn, every DataLoader
+                worker and DDP rank draws from its own stream. Defaults to fresh entropy from the OS.
+            resolution (int | tuple[int, int], optional): The resolution of the returned slices and masks, e.g. the
+                image_size of the model. Slices are resampled to it on the fly with resize_batch after normalizing
+                them, masks are generated at it directly. With batch_preprocessing, the raw slices keep their size
+                and BatchPreprocessor resamples the whole batch. Defaults to None, which keeps the size of the stored
+                slices.
+            slice_extension (str): The extension of the slice files, .nii.gz or .nii. Uncompressed slices are read
+                without decompressing them, see nifti_vol_to_frames.
         """
 
         super().__init__()
@@ -72,34 +114,117 @@ class InpaintingSliceDataset(Dataset):
         self.relative_slice_directory_path = slice_directory_path
         self.random_masks = random_masks
         self.return_info = return_info
+        self.use_index_sidecar = use_index_sidecar
+        self.in_memory = in_memory
+        self.batch_preprocessing = batch_preprocessing
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in (np.float16, np.float32, np.float64), (
+            "dtype must be a float dtype"
+        )
+        self.read_dtype = np.promote_types(self.dtype, np.float32)
+        assert not (batch_preprocessing and return_info), (
+            "batch_preprocessing returns the scanner codes instead of the item info"
+        )
 
-        self.data_extension = ".nii.gz"
+        assert slice_extension in (".nii.gz", ".nii"), (
+            "slice_extension must be .nii.gz or .nii"
+        )
+        self.data_extension = slice_extension
         self.dataset = self.prepare_dataset()
-        # TODO: Don't hardcode the resolution
-        self.mask_creator = imc.ImplantMaskCreator((256, 256))
 
-    def prepare_dataset(self) -> list[SingleDataPoint]:
-        """Create a list of SingleDataPoint objects containing the slices and masks that are specified in data_specification_path.
+        assert normalization in NORMALIZATIONS, (
+            f"normalization must be one of {NORMALIZATIONS}"
+        )
+        self.normalization = normalization
+        self.normalization_stats = None
+        if normalization_stats_path is not None:
+            self.normalization_stats = SliceStats.load(normalization_stats_path)
+            assert self.normalization_stats.matches(self.dataset), (
+                f"{normalization_stats_path} was computed for different slices"
+            )
+        else:
+            assert normalization == "slice", (
+                f"{normalization} normalization needs normalization_stats_path"
+            )
+        self.resolution = None if resolution is None else as_resolution(resolution)
+        self._mask_creators: dict[tuple[int, int], imc.ImplantMaskCreator] = {}
+        self.rng = ThreadLocalRNG(seed)
+        self.mask_bank = None
+        if mask_bank_path is not None:
+            self.mask_bank = MaskBank.load(mask_bank_path)
+            assert (
+                self.resolution is None or self.mask_bank.resolution == self.resolution
+            ), (
+                f"The masks in {mask_bank_path} have resolution {self.mask_bank.resolution}"
+            )
+
+    def prepare_dataset(self) -> SliceIndex:
+        """Create a columnar index of the slices that are specified in data_specification_path.
+
+        If use_index_sidecar is set, the index is stored in a .npz file next to data_specification_path and
+        memory-mapped on later runs.
 
         Returns:
-            list[SingleDataPoint]: A list of SingleDataPoint objects containing the filepaths of the slices and masks.
+            SliceIndex: The volume ids, frame indices and scanner/fov codes of all slices.
         """
-        dataset = []
-        with open(self.data_specification_path, "r") as f:
-            next(f, None)  # Skip the header row
-            for line in f:
-                slice_filename = line.strip()
-
-                relative_slice_path = os.path.join(
-                    self.relative_slice_directory_path, slice_filename
-                )
-                # TODO: Don't hardcode the id length. Specify it somewhere or use regex or some function.
-                id = extract_number_before_underscore(slice_filename)
-                data_info = lookup_num_in_datatable(id)
+        if self.use_index_sidecar:
+            return SliceIndex.from_specification_cached(self.data_specification_path)
+        return SliceIndex.from_specification(self.data_specification_path)
+
+    def mask_creator(self, resolution: tuple[int, int]) -> imc.ImplantMaskCreator:
+        """Return the mask creator for masks of the given resolution."""
+        creator = self._mask_creators.get(resolution)
+        if creator is None:
+            creator = imc.ImplantMaskCreator(resolution, dtype=self.dtype)
+            self._mask_creators[resolution] = creator
+        return creator
+
+    def reseed(self, seed: int | np.random.SeedSequence | None = None):
+        """Replace the random streams of the dataset, see rng.worker_init_fn."""
+        self.rng.reseed(seed)
+
+    def get_datapoint(self, idx: int) -> SingleDataPoint:
+        """Rebuild the path and info of the idx-th slice from the index."""
+        relative_slice_path = os.path.join(
+            self.relative_slice_directory_path,
+            self.dataset.filename(idx, self.data_extension),
+        )
+        data_info = lookup_num_in_datatable(int(self.dataset.volume_ids[idx]))
+        return SingleDataPoint(relative_slice_path, data_info)
+
+    def remote_paths(self, idx: int) -> list[str]:
+        """Return the LakeFS objects that load_slice needs for the idx-th slice, e.g. to fetch them ahead of time."""
+        return [
+            os.path.join(
+                self.relative_slice_directory_path,
+                self.dataset.filename(idx, self.data_extension),
+            )
+        ]
+
+    def load_slice(self, idx: int) -> tuple[np.ndarray, dict | None, str]:
+        """Load the idx-th slice from LakeFS or the local cache.
 
-                dataset.append(SingleDataPoint(relative_slice_path, data_info))
+        Args:
+            idx (int): The index of the slice.
 
-        return dataset
+        Returns:
+            tuple[np.ndarray, dict | None, str]: The slice, its item info and where it was loaded from.
+        """
+        item = self.get_datapoint(idx)
+        if self.in_memory:
+            data = self.lakefs_loader.get_bytes(item.relative_slice_path)
+            return (
+                nifti_bytes_to_numpy(data, self.read_dtype),
+                item.data_info,
+                item.relative_slice_path,
+            )
+
+        slice_path = self.lakefs_loader.get_file(item.relative_slice_path)
+        return (
+            single_nifti_to_numpy(slice_path, self.read_dtype),
+            item.data_info,
+            slice_path,
+        )
 
     def __getitem__(
         self, idx: int
@@ -115,44 +240,75 @@ class InpaintingSliceDataset(Dataset):
             tuple[np.ndarray, np.ndarray]: A tuple containing the slice and mask at the given index.
             OR
             tuple[np.ndarray, np.ndarray, dict]: A tuple containing the slice, mask and item info at the given index.
+            OR
+            tuple[np.ndarray, np.ndarray, dict]: With batch_preprocessing, the raw slice, the mask and the scanner and
+                fov code of the slice.
         """
 
         assert 0 <= idx < self.__len__(), f"Index {idx} out of bounds"
 
-        item = self.dataset[idx]
-        item_info = item.data_info
-
-        slice_path = self.lakefs_loader.get_file(item.relative_slice_path)
-
-        assert slice_path is not None, (
-            f"File {item.relative_slice_path} not found on lakeFS"
-        )
+        slice_np_array, item_info, slice_path = self.load_slice(idx)
+        resolution = self.resolution or slice_np_array.shape
+        mask_creator = self.mask_creator(resolution)
 
+        # TODO: Don't hardcode the amount of implants. Specify it somewhere.
         if self.random_masks:
-            slice_hash = None
+            mask_np_array = mask_creator.generate_batch(
+                1, 1, 4, rng=self.rng.generator
+            )[0]
+        elif self.mask_bank is not None:
+            assert self.mask_bank.resolution == resolution, (
+                f"The mask bank has resolution {self.mask_bank.resolution}, the slices {resolution}"
+            )
+            mask_np_array = self.mask_bank.mask_for(self.dataset.filename(idx))
         else:
+            # The fixed mask of a slice is seeded with its filename, so it is the same for every mode and cache path.
             slice_hash = int.from_bytes(
-                hashlib.sha256(slice_path.encode("utf-8")).digest()[:4], "little"
+                hashlib.sha256(self.dataset.filename(idx).encode("utf-8")).digest()[:4],
+                "little",
+            )
+            mask_np_array = mask_creator.generate_mask_with_random_amount_of_implants(
+                1, 4, random_state=slice_hash
             )
+        mask_np_array = mask_np_array.astype(self.dtype, copy=False)
 
-        slice_np_array = single_nifti_to_numpy(slice_path)
-        # TODO: Don't hardcode the amount of implants. Specify it somewhere.
-        mask_np_array = self.mask_creator.generate_mask_with_random_amount_of_implants(
-            1, 4, random_state=slice_hash
-        )
+        if self.batch_preprocessing:
+            codes = {
+                "scanner_code": int(self.dataset.scanner_codes[idx]),
+                "fov_code": int(self.dataset.fov_codes[idx]),
+            }
+            return (
+                slice_np_array.astype(self.read_dtype, copy=False)[np.newaxis, ...],
+                mask_np_array[np.newaxis, ...],
+                codes,
+            )
+
+        bounds = None
+        if self.normalization_stats is not None:
+            bounds = self.normalization_stats.bounds(idx, self.normalization)
 
         if item_info is not None:
             try:
                 scanner = item_info["scanner"][0]
                 fov = item_info["fov"][0]
                 processed_slice_np_array = self.dataprocessing(
-                    slice_np_array, scanner, fov
+                    slice_np_array, scanner, fov, bounds=bounds
                 )
             except KeyError:
                 print(f"No scanner information for item at slice_path: {slice_path}")
-                processed_slice_np_array = self.dataprocessing(slice_np_array)
+                processed_slice_np_array = self.dataprocessing(
+                    slice_np_array, bounds=bounds
+                )
         else:
-            processed_slice_np_array = self.dataprocessing(slice_np_array)
+            processed_slice_np_array = self.dataprocessing(
+                slice_np_array, bounds=bounds
+            )
+
+        if self.resolution is not None:
+            processed_slice_np_array = self.resize(processed_slice_np_array)
+        processed_slice_np_array = processed_slice_np_array.astype(
+            self.dtype, copy=False
+        )
 
         if self.return_info:
             if item_info is None:
@@ -167,12 +323,18 @@ class InpaintingSliceDataset(Dataset):
                 np.newaxis, ...
             ]
 
+    def resize(self, np_array: np.ndarray) -> np.ndarray:
+        """Resample a single slice to the resolution of the dataset with resize_batch."""
+        tensor = torch.from_numpy(np.ascontiguousarray(np_array))[None, None]
+        return resize_batch(tensor, self.resolution)[0, 0].numpy()
+
     def dataprocessing(
         self,
         np_array: np.ndarray,
         scanner: str | None = None,
         fov: str | None = None,
         scanner_processing: bool = False,
+        bounds: tuple[float, float] | None = None,
     ) -> np.ndarray:
         """Preprocesses the numpy array by normalizing it and removing outliers. Addiotionally, if scanner and fov are provided, the array is preprocessed accordingly.
 
@@ -181,20 +343,25 @@ class InpaintingSliceDataset(Dataset):
             scanner (str, optional): The scanner used for the slice. Defaults to None.
             fov (str, optional): The field of view of the slice. Defaults to None.
             scanner_processing (bool, optional): Whether to apply scanner specific preprocessing. Defaults to False.
+            bounds (tuple[float, float], optional): Precomputed lower and upper quantile of the raw slice. If given, the
+                slice is clipped and scaled in one pass instead of computing its quantiles. Ignored with
+                scanner_processing, because the bounds don't apply to the transformed values. Defaults to None.
         Returns:
             np.ndarray: The preprocessed numpy array.
         """
         if scanner_processing:
             if scanner is not None and fov is not None:
-                if scanner == "planmeca" and fov == "small":
-                    np_array = -np.log(np_array / (3591 * 2.27))
-                elif scanner == "planmeca" and fov == "large":
-                    np_array = -np.log(np_array / (4326 * 2.27))
-                elif scanner == "axeos":
-                    np_array = -np.log(np_array / (2 * 10**16))
+                scale = scanner_log_scale(scanner, fov)
+                if scale is not None:
+                    np_array = -np.log(np_array / scale)
                 else:
                     # TODO: Add more preprocessing for other scanners. Waiting for the details from Susanne.
                     print(f"No extra preprocessing for scanner {scanner} and fov {fov}")
+            # The precomputed bounds belong to the untransformed slice
+            bounds = None
+
+        if bounds is not None:
+            return clip_and_scale(np_array, *bounds)
 
         outliers_removed = remove_outliers(np_array)
         normalized = min_max_normalize(outliers_removed)
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from torch.utils.data import Sampler
+
+from cbct_artifact_reduction.pigjawdataset import InpaintingSliceDataset
+
+
+class ReadAheadSampler(Sampler[int]):
+    """Wrap a sampler and fetch the files of the next indices into the local cache in the background.
+
+    The DataLoader iterates its sampler in the main process, ahead of the workers. This sampler takes the indices from
+    the wrapped sampler in exactly the same order, e.g. the permutation of a RandomSampler, and keeps the files of the
+    next lookahead indices downloading with a pool of threads while the workers consume the current ones. A worker
+    that asks for a file that is still being downloaded waits for that download instead of starting a second one.
+
+    Usage:
+        sampler = ReadAheadSampler(RandomSampler(dataset), dataset, lookahead=256)
+        dataloader = DataLoader(dataset, batch_size=8, sampler=sampler)
+    """
+
+    def __init__(
+        self,
+        sampler: Sampler[int],
+        dataset: InpaintingSliceDataset,
+        lookahead: int = 256,
+        max_workers: int = 8,
+    ) -> None:
+        """Initializes the sampler.
+
+        Args:
+            sampler (Sampler[int]): The sampler that defines the order of the indices.
+            dataset (InpaintingSliceDataset): The dataset that maps indices to LakeFS objects with remote_paths.
+            lookahead (int): How many indices ahead of the DataLoader the files are fetched.
+            max_workers (int): Number of download threads.
+        """
+        self.sampler = sampler
+        self.dataset = dataset
+        self.lookahead = lookahead
+        self.max_workers = max_workers
+
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        with self._stats_lock:
+            self.yielded = 0
+            self.submitted = 0
+            self.completed = 0
+            self.cancelled = 0
+            self.late = 0
+            self.stall_seconds = 0.0
+            self._window: deque[tuple[int, list[str], list[Future]]] = deque()
+
+    def __len__(self) -> int:
+        return len(self.sampler)
+
+    def _fetch(self, object_name: str):
+        self.dataset.lakefs_loader.get_file(object_name)
+
+    def _on_done(self, future: Future):
+        with self._stats_lock:
+            if future.cancelled():
+                self.cancelled += 1
+            else:
+                self.completed += 1
+
+    def _submit(
+        self,
+        executor: ThreadPoolExecutor,
+        idx: int,
+        in_flight: dict[str, Future],
+        window_refs: Counter,
+    ):
+        object_names = self.dataset.remote_paths(idx)
+        futures = []
+        for object_name in object_names:
+            window_refs[object_name] += 1
+            future = in_flight.get(object_name)
+            if future is None:
+                future = executor.submit(self._fetch, object_name)
+                future.add_done_callback(self._on_done)
+                in_flight[object_name] = future
+                with self._stats_lock:
+                    self.submitted += 1
+            futures.append(future)
+        with self._stats_lock:
+            self._window.append((idx, object_names, futures))
+
+    @staticmethod
+    def _release(
+        object_names: list[str],
+        in_flight: dict[str, Future],
+        window_refs: Counter,
+        released: set[str],
+    ):
+        """Forget the downloads of a handed out index once they are done and no index in the window needs them.
+
+        in_flight only dedupes the downloads of the lookahead window, so it doesn't keep a future for every file of an
+        epoch. A file that is needed again later is fetched again, which is a local cache hit.
+        """
+        for object_name in object_names:
+            window_refs[object_name] -= 1
+            if window_refs[object_name] == 0:
+                del window_refs[object_name]
+                released.add(object_name)
+        for object_name in list(released):
+            if window_refs[object_name]:
+                released.discard(object_name)
+            elif in_flight[object_name].done():
+                del in_flight[object_name]
+                released.discard(object_name)
+
+    def _record_stall(self, futures: list[Future]):
+        """Measure how long the files of a handed out index are still being downloaded."""
+        pending = [future for future in futures if not future.done()]
+        if not pending:
+            return
+        handed_out = time.perf_counter()
+        remaining = [len(pending)]
+
+        def on_done(_):
+            with self._stats_lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self.stall_seconds += time.perf_counter() - handed_out
+
+        with self._stats_lock:
+            self.late += 1
+        for future in pending:
+            future.add_done_callback(on_done)
+
+    def __iter__(self) -> Iterator[int]:
+        self._reset_stats()
+        order = iter(self.sampler)
+        in_flight: dict[str, Future] = {}
+        window_refs: Counter = Counter()
+        released: set[str] = set()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        exhausted = False
+        try:
+            for idx in order:
+                self._submit(executor, idx, in_flight, window_refs)
+                if len(self._window) >= self.lookahead:
+                    break
+
+            while self._window:
+                with self._stats_lock:
+                    idx, object_names, futures = self._window.popleft()
+                    self.yielded += 1
+                self._record_stall(futures)
+                self._release(object_names, in_flight, window_refs, released)
+                idx_next = next(order, None)
+                if idx_next is not None:
+                    self._submit(executor, idx_next, in_flight, window_refs)
+                yield idx
+            exhausted = True
+        finally:
+            # The workers still need the files of the last handed out indices, only an early stop cancels downloads.
+            executor.shutdown(wait=False, cancel_futures=not exhausted)
+
+    def stats(self) -> dict:
+        """Return how far the read-ahead is ahead of the DataLoader and how long it was behind.
+
+        Returns:
+            dict: 'yielded' indices handed to the DataLoader, 'ahead' indices queued behind the last handed out one,
+                'submitted', 'completed' and 'cancelled' downloads, 'in_flight' downloads that are not finished yet,
+                'late' indices that were handed out before their files were cached and 'stall_seconds', the total time
+                those files were still downloading after being handed out. This is an upper bound on how long workers
+                stalled.
+        """
+        with self._stats_lock:
+            return {
+                "yielded": self.yielded,
+                "ahead": len(self._window),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "in_flight": self.submitted - self.completed - self.cancelled,
+                "late": self.late,
+                "stall_seconds": self.stall_seconds,
+            }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_stats_lock"]
+        state["_window"] = deque()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
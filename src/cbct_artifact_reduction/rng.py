@@ -0,0 +1,80 @@
+import threading
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import get_worker_info
+
+
+def get_rank() -> int:
+    """Return the DDP rank of this process, 0 if torch.distributed is not initialized."""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+
+class ThreadLocalRNG:
+    """Hand every thread its own numpy Generator, all spawned from one SeedSequence.
+
+    Generators are created on first use in a thread, so a dataset that holds a ThreadLocalRNG can be used from a
+    thread pool without sharing or reseeding any global state. The same seed gives the same streams, as long as the
+    threads ask for their generators in the same order.
+
+    Usage:
+        rng = ThreadLocalRNG(seed=0)
+        mask = mask_creator.generate_batch(1, 1, 4, rng=rng.generator)
+    """
+
+    def __init__(self, seed: int | np.random.SeedSequence | None = None) -> None:
+        """Initializes the streams.
+
+        Args:
+            seed (int | np.random.SeedSequence, optional): The seed of all streams. An integer seed gives every DDP
+                rank different streams. Defaults to fresh entropy from the OS.
+        """
+        self.reseed(seed)
+
+    def reseed(self, seed: int | np.random.SeedSequence | None = None):
+        """Replace all streams by new ones derived from seed, see __init__."""
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed, spawn_key=(get_rank(),))
+        self.seed_sequence = seed
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def generator(self) -> np.random.Generator:
+        """The generator of the current thread."""
+        generator = getattr(self._local, "generator", None)
+        if generator is None:
+            with self._lock:
+                child = self.seed_sequence.spawn(1)[0]
+            generator = np.random.default_rng(child)
+            self._local.generator = generator
+        return generator
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+
+def worker_init_fn(worker_id: int):
+    """Give the dataset of a DataLoader worker its own random streams.
+
+    The streams are derived from the seed torch assigns to the worker, which differs per worker and epoch and is
+    reproducible with torch.manual_seed or the generator of the DataLoader, and from the DDP rank, so no two workers
+    of any rank draw the same masks. Datasets opt in by implementing reseed(seed_sequence).
+
+    Usage:
+        DataLoader(dataset, num_workers=8, worker_init_fn=worker_init_fn)
+    """
+    info = get_worker_info()
+    seed_sequence = np.random.SeedSequence(info.seed, spawn_key=(get_rank(), worker_id))
+    if hasattr(info.dataset, "reseed"):
+        info.dataset.reseed(seed_sequence)
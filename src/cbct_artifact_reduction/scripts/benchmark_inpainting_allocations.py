@@ -0,0 +1,148 @@
+import time
+
+import numpy as np
+import torch
+from cbct_artifact_reduction.argparser_config import create_sample_argparser
+from cbct_artifact_reduction.guided_diffusion import dist_util
+from cbct_artifact_reduction.guided_diffusion.script_util import (
+    args_to_dict,
+    create_model_and_diffusion,
+    model_and_diffusion_defaults,
+)
+from cbct_artifact_reduction.implantmaskcreator import ImplantMaskCreator
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+
+class AllocationCounter(TorchDispatchMode):
+    """Count the tensors the aten ops allocate while the mode is active, on any device.
+
+    Also counts the copies from the host to another device and the ops on float64 tensors, which only come from the
+    numpy schedule arrays of the diffusion.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.allocations = 0
+        self.bytes = 0
+        self.cat_calls = 0
+        self.host_to_device = 0
+        self.float64_ops = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if func is torch.ops.aten.cat.default:
+            self.cat_calls += 1
+        inputs = [
+            x for x in tree_flatten((args, kwargs))[0] if isinstance(x, torch.Tensor)
+        ]
+        if any(x.dtype == torch.float64 for x in inputs):
+            self.float64_ops += 1
+        outputs = [x for x in tree_flatten(out)[0] if isinstance(x, torch.Tensor)]
+        if any(x.device.type == "cpu" for x in inputs) and any(
+            x.device.type != "cpu" for x in outputs
+        ):
+            self.host_to_device += 1
+        # Views and in-place ops return tensors that alias their inputs
+        if all(ret.alias_info is None for ret in func._schema.returns):
+            for tensor in tree_flatten(out)[0]:
+                if isinstance(tensor, torch.Tensor):
+                    self.allocations += 1
+                    self.bytes += tensor.untyped_storage().nbytes()
+        return out
+
+
+def create_benchmark_argparser():
+    parser = create_sample_argparser()
+    parser.description = (
+        "Count the tensors the ancestral inpainting loop allocates per step, with a new 3-channel input per step and "
+        "with the preallocated buffer, with and without replacing the known region."
+    )
+    parser.add_argument(
+        "--benchmark_steps",
+        type=int,
+        default=10,
+        help="The number of sampling steps, used as timestep_respacing.",
+    )
+    return parser
+
+
+def main():
+    args = create_benchmark_argparser().parse_args()
+    dist_util.setup_dist()
+    device = dist_util.dev()
+
+    args.timestep_respacing = str(args.benchmark_steps)
+    model, diffusion = create_model_and_diffusion(
+        **args_to_dict(args, model_and_diffusion_defaults().keys())
+    )
+    # The allocations don't depend on the weights, an untrained model works as well
+    if args.model_path:
+        model.load_state_dict(
+            dist_util.load_state_dict(args.model_path, map_location="cpu")
+        )
+    model.to(device)
+    if args.use_fp16:
+        model.convert_to_fp16()
+    model.eval()
+
+    masks = ImplantMaskCreator((args.image_size, args.image_size)).generate_batch(
+        args.batch_size, 1, 4, np.random.default_rng(0)
+    )
+    mask = torch.from_numpy(masks[:, None]).float().to(device)
+    masked_image = torch.rand(mask.shape, device=device) * (1 - mask)
+
+    variants = [
+        ("concatenate", {"in_place": False}),
+        ("in-place buffer", {"in_place": True}),
+        ("in-place + known region", {"in_place": True, "replace_known": True}),
+        (
+            f"in-place + resample {args.resample_steps}",
+            {
+                "in_place": True,
+                "replace_known": True,
+                "resample_steps": args.resample_steps,
+            },
+        ),
+    ]
+    # Warm up, so that the first variant isn't slower because of one-time initialization
+    diffusion.p_sample_loop_inpainting(model, masked_image, mask, device=device)
+
+    print(
+        f"{'variant':<28}{'model calls':>12}{'allocs/step':>13}{'MB/step':>10}{'cat/step':>10}{'h2d/step':>10}{'f64/step':>10}{'s/step':>9}"
+    )
+    for name, kwargs in variants:
+        # The model calls are counted by wrapping the forward pass, the loop itself by the dispatch mode
+        calls = 0
+
+        def counted_model(x, t, **model_kwargs):
+            nonlocal calls
+            calls += 1
+            with torch.utils._python_dispatch._disable_current_modes():
+                return model(x, t, **model_kwargs)
+
+        counter = AllocationCounter()
+        start = time.perf_counter()
+        with counter:
+            diffusion.p_sample_loop_inpainting(
+                counted_model,
+                masked_image,
+                mask,
+                clip_denoised=True,
+                device=device,
+                **kwargs,
+            )
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - start
+
+        steps = args.benchmark_steps
+        print(
+            f"{name:<28}{calls:>12}{counter.allocations / steps:>13.1f}"
+            f"{counter.bytes / steps / 2**20:>10.2f}{counter.cat_calls / steps:>10.2f}"
+            f"{counter.host_to_device / steps:>10.2f}{counter.float64_ops / steps:>10.2f}{seconds / steps:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
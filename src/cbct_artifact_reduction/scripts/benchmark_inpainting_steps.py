@@ -0,0 +1,128 @@
+import os
+import time
+
+import cbct_artifact_reduction.config as cfg
+import cbct_artifact_reduction.pigjawdataset as dataset
+import torch
+from cbct_artifact_reduction import lakefs_own
+from cbct_artifact_reduction.argparser_config import create_sample_argparser
+from cbct_artifact_reduction.guided_diffusion import dist_util
+from cbct_artifact_reduction.guided_diffusion.script_util import (
+    args_to_dict,
+    create_gaussian_diffusion,
+    create_model_and_diffusion,
+    model_and_diffusion_defaults,
+    str2bool,
+)
+from torch.utils.data import DataLoader
+
+
+def create_benchmark_argparser():
+    parser = create_sample_argparser()
+    parser.description = "Compare the inpainting quality and speed of DDIM with a few steps against ancestral sampling with all steps."
+    parser.add_argument(
+        "--steps",
+        type=str,
+        default="25,50,100",
+        help="Comma-separated DDIM step counts, each one is sampled with timestep_respacing ddim<steps>.",
+    )
+    parser.add_argument("--num_batches", type=int, default=4)
+    parser.add_argument(
+        "--ancestral", type=str2bool, default=True, help="Also sample with all steps."
+    )
+    return parser
+
+
+def masked_errors(sample, ground_truth, mask):
+    """Return the MSE and the PSNR of a batch within the masks, with a data range of 1."""
+    squared_error = ((sample - ground_truth) ** 2 * mask).flatten(1).sum(1)
+    mse = squared_error / mask.flatten(1).sum(1).clamp(min=1)
+    return mse, 10 * torch.log10(1 / mse.clamp(min=1e-10))
+
+
+def main():
+    args = create_benchmark_argparser().parse_args()
+    dist_util.setup_dist()
+    device = dist_util.dev()
+
+    model, _ = create_model_and_diffusion(
+        **args_to_dict(args, model_and_diffusion_defaults().keys())
+    )
+    model.load_state_dict(
+        dist_util.load_state_dict(args.model_path, map_location="cpu")
+    )
+    model.to(device)
+    if args.use_fp16:
+        model.convert_to_fp16()
+    model.eval()
+
+    # The held-out slices with their fixed masks, so every sampler inpaints the same regions
+    client = lakefs_own.CustomBoto3Client(f"{cfg.LAKEFS_DATA_REPOSITORY}")
+    held_out = dataset.InpaintingSliceDataset(
+        client,
+        os.path.join(cfg.ROOT_DIR, args.data_csv),
+        args.frames_directory,
+        random_masks=False,
+        mask_bank_path=args.mask_bank or None,
+        resolution=args.image_size,
+    )
+    batches = []
+    for batch in DataLoader(held_out, batch_size=args.batch_size, shuffle=False):
+        batches.append(batch)
+        if len(batches) == args.num_batches:
+            break
+
+    diffusion_args = args_to_dict(
+        args,
+        [
+            "learn_sigma",
+            "sigma_small",
+            "noise_schedule",
+            "use_kl",
+            "predict_xstart",
+            "rescale_timesteps",
+            "rescale_learned_sigmas",
+        ],
+    )
+    samplers = [(f"ddim{steps}", int(steps)) for steps in args.steps.split(",")]
+    if args.ancestral:
+        samplers.append(("ancestral", args.diffusion_steps))
+
+    print(f"{'sampler':<12}{'steps':>6}{'s/slice':>10}{'MSE':>12}{'PSNR':>8}")
+    for name, steps in samplers:
+        diffusion = create_gaussian_diffusion(
+            steps=args.diffusion_steps,
+            timestep_respacing=name if name != "ancestral" else "",
+            **diffusion_args,
+        )
+        if name == "ancestral":
+            sample_fn = diffusion.p_sample_loop_inpainting
+        else:
+            sample_fn = diffusion.ddim_sample_loop_inpainting
+
+        torch.manual_seed(0)
+        mses, psnrs = [], []
+        num_slices = 0
+        start = time.perf_counter()
+        for ground_truth, mask in batches:
+            ground_truth, mask = ground_truth.to(device), mask.to(device)
+            kwargs = {} if name == "ancestral" else {"eta": args.eta}
+            sample, _ = sample_fn(
+                model, ground_truth * (1 - mask), mask, clip_denoised=True, **kwargs
+            )
+            mse, psnr = masked_errors(sample, ground_truth, mask)
+            mses.append(mse)
+            psnrs.append(psnr)
+            num_slices += len(ground_truth)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        seconds = (time.perf_counter() - start) / num_slices
+
+        print(
+            f"{name:<12}{steps:>6}{seconds:>10.3f}"
+            f"{torch.cat(mses).mean().item():>12.6f}{torch.cat(psnrs).mean().item():>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
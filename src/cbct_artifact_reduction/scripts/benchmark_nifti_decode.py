@@ -0,0 +1,102 @@
+import argparse
+import os
+import tempfile
+import time
+
+import cbct_artifact_reduction.dataprocessing as dp
+import nibabel as nib
+import numpy as np
+from cbct_artifact_reduction.utils import ROOT_DIR
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def create_benchmark_argparser():
+    parser = argparse.ArgumentParser(
+        description="Compare the size and decode throughput of a nifti file stored with different compressions."
+    )
+    parser.add_argument(
+        "--input",
+        type=str,
+        default=os.path.join(ROOT_DIR, "sample_data", "80_0.nii.gz"),
+        help="A frame or volume to store in every variant.",
+    )
+    parser.add_argument("--gzip_levels", type=str, default="0,1,3,6,9")
+    parser.add_argument("--zstd_levels", type=str, default="1,3,9")
+    parser.add_argument("--repeats", type=int, default=20)
+    return parser
+
+
+def time_decode(decode, repeats: int) -> float:
+    """Return the fastest of repeats decodes in seconds. The files are in the page cache after the first one."""
+    decode()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        decode()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    args = create_benchmark_argparser().parse_args()
+    np_array = np.asarray(nib.load(args.input).dataobj)
+    nib_object = nib.nifti1.Nifti1Image(np_array, np.eye(4))
+    raw_bytes = nib_object.to_bytes()
+    print(f"{args.input}: shape {np_array.shape}, {np_array.dtype}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        variants = {"uncompressed .nii": os.path.join(tmp_dir, "frame.nii")}
+        dp.save_nifti(nib_object, variants["uncompressed .nii"])
+        for level in map(int, args.gzip_levels.split(",")):
+            variants[f"gzip level {level}"] = os.path.join(
+                tmp_dir, f"frame_{level}.nii.gz"
+            )
+            dp.save_nifti(nib_object, variants[f"gzip level {level}"], level)
+
+        results = []
+        for name, path in variants.items():
+            # np.array reads memory-mapped .nii files completely
+            seconds = time_decode(
+                lambda path=path: np.array(dp.single_nifti_to_numpy(path, np.float32)),
+                args.repeats,
+            )
+            results.append((name, os.path.getsize(path), seconds))
+
+        if zstandard is None:
+            print("zstandard is not installed, skipping the zstd sidecars")
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+            for level in map(int, args.zstd_levels.split(",")):
+                path = os.path.join(tmp_dir, f"frame_{level}.nii.zst")
+                with open(path, "wb") as f:
+                    f.write(zstandard.ZstdCompressor(level=level).compress(raw_bytes))
+
+                def decode_zstd(path=path):
+                    with open(path, "rb") as f:
+                        data = decompressor.decompress(f.read())
+                    return dp.nifti_bytes_to_numpy(data, np.float32)
+
+                results.append(
+                    (
+                        f"zstd level {level}",
+                        os.path.getsize(path),
+                        time_decode(decode_zstd, args.repeats),
+                    )
+                )
+
+    print(
+        f"{'variant':<20}{'size (kB)':>12}{'ratio':>8}{'decode (ms)':>14}{'MB/s':>10}"
+    )
+    for name, size, seconds in results:
+        print(
+            f"{name:<20}{size / 1e3:>12.1f}{len(raw_bytes) / size:>8.2f}"
+            f"{seconds * 1e3:>14.3f}{np_array.nbytes / seconds / 1e6:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import argparse
+import os
+
+import cbct_artifact_reduction.config as cfg
+import cbct_artifact_reduction.lakefs_own as lakefs_own
+import cbct_artifact_reduction.pigjawdataset as dataset
+from cbct_artifact_reduction.slicestats import SliceStats, stats_path
+
+
+def create_stats_argparser():
+    parser = argparse.ArgumentParser(
+        description="Precompute the normalization statistics of all slices of a data specification csv."
+    )
+    parser.add_argument("--data_csv", type=str, default="training_data.csv")
+    parser.add_argument(
+        "--slice_directory", type=str, default="processed_data/frames/256x256"
+    )
+    parser.add_argument("--output", type=str, default="")
+    parser.add_argument("--lower_quantile", type=float, default=0.001)
+    parser.add_argument("--upper_quantile", type=float, default=0.999)
+    return parser
+
+
+def main():
+    args = create_stats_argparser().parse_args()
+    client = lakefs_own.CustomBoto3Client(f"{cfg.LAKEFS_DATA_REPOSITORY}")
+    data_specification_path = os.path.join(cfg.ROOT_DIR, args.data_csv)
+    inpaintingSliceDataset = dataset.InpaintingSliceDataset(
+        client, data_specification_path, args.slice_directory
+    )
+
+    stats = SliceStats.compute(
+        inpaintingSliceDataset, args.lower_quantile, args.upper_quantile
+    )
+    output_path = args.output or stats_path(data_specification_path)
+    stats.save(output_path)
+    print(f"Saved the statistics of {len(stats.slice_stats)} slices to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+import os
+
+import cbct_artifact_reduction.utils as utils
+from cbct_artifact_reduction.dataprocessing import NiftiDataFolder
+
+# Define the input and output directories
+data_input_path = os.path.join(utils.OUTPUT_DIR, "resized", "256x256")
+data_output_path = os.path.join(utils.OUTPUT_DIR, "volumes", "256x256")
+
+# Create a NiftiDataFolder object for the input directory
+df = NiftiDataFolder(data_input_path)
+df.convert_all_volumes_to_npy(data_output_path)
@@ -1,32 +1,29 @@
 import os
 
-import cbct_artifact_reduction.dataprocessing as dp
-import cbct_artifact_reduction.implantmaskcreator as imc
 import matplotlib.pyplot as plt
 import numpy as np
+from cbct_artifact_reduction.maskbank import MaskBank
 from cbct_artifact_reduction.utils import OUTPUT_DIR
 
 RES = 256
-output_folder_path = os.path.join(OUTPUT_DIR, "masks", f"{RES}x{RES}")
+output_folder_path = os.path.join(OUTPUT_DIR, "masks")
+mask_bank_path = os.path.join(output_folder_path, f"mask_bank_{RES}x{RES}.npz")
 
 if not os.path.exists(output_folder_path):
     os.makedirs(output_folder_path)
 
 
 def create_masks():
-    imcTest = imc.ImplantMaskCreator((RES, RES))
-
+    """Write a bank of 1000 masks with 1 to 3 implants, see MaskBank."""
     n = 1000
 
-    for i in range(n):
-        amount_implants = np.random.randint(1, 4)
-        mask = imcTest.generate_mask_with_n_implants(amount_implants)
-        dp.numpy_to_nifti(mask, os.path.join(output_folder_path, f"mask_{i}.nii.gz"))
-        print(f"Generated mask {i + 1}/{n}")
+    mask_bank = MaskBank.create(n, (RES, RES), lower=1, upper=4, seed=0)
+    mask_bank.save(mask_bank_path)
+    print(f"Generated {n} masks. Saved at {mask_bank_path}")
 
 
 if __name__ == "__main__":
-    imcTest = imc.ImplantMaskCreator((RES, RES))
-    mask = imcTest.generate_mask_with_n_implants(10)
-    plt.imshow(mask)
+    create_masks()
+    mask_bank = MaskBank.load(mask_bank_path)
+    plt.imshow(np.hstack([mask_bank[i] for i in range(4)]))
     plt.show()
@@ -0,0 +1,69 @@
+from cbct_artifact_reduction.argparser_config import create_sample_argparser
+from cbct_artifact_reduction.guided_diffusion import dist_util
+from cbct_artifact_reduction.guided_diffusion.script_util import (
+    args_to_dict,
+    create_model_and_diffusion,
+    model_and_diffusion_defaults,
+    str2bool,
+)
+from cbct_artifact_reduction.volumeinference import VolumeInpainter
+
+
+def create_inpaint_volume_argparser():
+    parser = create_sample_argparser()
+    parser.description = "Inpaint the masked voxels of a whole nifti volume, batch_size slices at a time."
+    parser.add_argument("--volume", type=str, required=True)
+    parser.add_argument("--mask", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument(
+        "--crop",
+        type=str2bool,
+        default=True,
+        help="Sample only a window around the masks of each batch.",
+    )
+    parser.add_argument("--crop_margin", type=int, default=16)
+    return parser
+
+
+def main():
+    args = create_inpaint_volume_argparser().parse_args()
+    dist_util.setup_dist()
+
+    model, diffusion = create_model_and_diffusion(
+        **args_to_dict(args, model_and_diffusion_defaults().keys())
+    )
+    model.load_state_dict(
+        dist_util.load_state_dict(args.model_path, map_location="cpu")
+    )
+    model.to(dist_util.dev())
+    if args.use_fp16:
+        model.convert_to_fp16()
+    model.eval()
+
+    inpainter = VolumeInpainter(
+        model,
+        diffusion,
+        batch_size=args.batch_size,
+        image_size=args.image_size,
+        use_ddim=args.use_ddim,
+        eta=args.eta,
+        clip_denoised=args.clip_denoised,
+        progress=True,
+        crop=args.crop,
+        crop_margin=args.crop_margin,
+        replace_known=args.replace_known,
+        resample_steps=args.resample_steps,
+    )
+    stats = inpainter.inpaint_file(args.volume, args.mask, args.output)
+    print(
+        f"Inpainted {stats['slices']} slices in {stats['batches']} batches in {stats['seconds']:.1f}s, "
+        f"{stats['slices_per_second']:.2f} slices/s, peak memory {stats['peak_memory_mb']:.0f} MB"
+    )
+    print(
+        f"Skipped {stats['slices_skipped']} slices with an empty mask, "
+        f"the model processed {stats['pixels_avoided']} pixels less"
+    )
+
+
+if __name__ == "__main__":
+    main()
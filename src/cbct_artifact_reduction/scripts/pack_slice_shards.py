@@ -0,0 +1,22 @@
+import os
+
+import cbct_artifact_reduction.config as cfg
+import cbct_artifact_reduction.lakefs_own as lakefs_own
+import numpy as np
+from cbct_artifact_reduction.sliceshard import pack_specification_into_shards
+from cbct_artifact_reduction.utils import OUTPUT_DIR
+
+RES = 256
+data_specification_path = os.path.join(cfg.ROOT_DIR, "training_data.csv")
+slice_directory_path = f"processed_data/frames/{RES}x{RES}"
+output_folder_path = os.path.join(OUTPUT_DIR, "shards", f"{RES}x{RES}")
+
+client = lakefs_own.CustomBoto3Client(f"{cfg.LAKEFS_DATA_REPOSITORY}")
+pack_specification_into_shards(
+    client,
+    data_specification_path,
+    slice_directory_path,
+    output_folder_path,
+    shard_size=1024,
+    dtype=np.float32,
+)
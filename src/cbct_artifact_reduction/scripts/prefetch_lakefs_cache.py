@@ -0,0 +1,52 @@
+import argparse
+import os
+
+import cbct_artifact_reduction.config as cfg
+import cbct_artifact_reduction.lakefs_own as lakefs_own
+
+
+def create_prefetch_argparser():
+    parser = argparse.ArgumentParser(
+        description="Download a training split or a prefix from LakeFS into the local cache."
+    )
+    parser.add_argument("--data_csv", type=str, default="")
+    parser.add_argument(
+        "--slice_directory", type=str, default="processed_data/frames/256x256"
+    )
+    parser.add_argument("--prefix", type=str, default="")
+    parser.add_argument("--max_workers", type=int, default=8)
+    parser.add_argument("--max_concurrency", type=int, default=1)
+    return parser
+
+
+def main():
+    args = create_prefetch_argparser().parse_args()
+    client = lakefs_own.CustomBoto3Client(f"{cfg.LAKEFS_DATA_REPOSITORY}")
+
+    if args.data_csv:
+        result = client.prefetch_specification(
+            os.path.join(cfg.ROOT_DIR, args.data_csv),
+            args.slice_directory,
+            max_workers=args.max_workers,
+            max_concurrency=args.max_concurrency,
+        )
+    elif args.prefix:
+        result = client.prefetch_prefix(
+            args.prefix,
+            max_workers=args.max_workers,
+            max_concurrency=args.max_concurrency,
+        )
+    else:
+        raise ValueError("Specify either --data_csv or --prefix")
+
+    print(
+        f"{result['requested']} objects: {result['cached']} already cached, "
+        f"{result['downloaded']} downloaded, {result['failed']} failed. "
+        f"{result['bytes'] / 1e6:.1f} MB in {result['seconds']:.1f}s"
+    )
+    for object_name in result["failed_object_names"]:
+        print(f"Failed: {object_name}")
+
+
+if __name__ == "__main__":
+    main()
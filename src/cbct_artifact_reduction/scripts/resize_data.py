@@ -5,8 +5,9 @@ from cbct_artifact_reduction.utils import OUTPUT_DIR
 
 data_path = os.path.join(OUTPUT_DIR, "rotated")
 output_folder_path = os.path.join(OUTPUT_DIR, "resized")
-new_dimensions = (256, 256)
-overwrite_files = True
+# Every volume is decoded once and written to resized/<H>x<W> for each resolution
+new_dimensions = [(128, 128), (256, 256), (512, 512)]
+overwrite_files = False
 preserve_range = False
 
 df = NiftiDataFolder(data_path)
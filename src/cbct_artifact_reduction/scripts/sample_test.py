@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from functools import partial
 
 import cbct_artifact_reduction.config as cfg
 import cbct_artifact_reduction.pigjawdataset as dataset
@@ -18,6 +19,9 @@ from torch.utils.data import DataLoader
 
 def main():
     args = create_sample_argparser().parse_args()
+    assert not args.use_ddim or (not args.replace_known and args.resample_steps == 1), (
+        "--replace_known and --resample_steps only apply to ancestral sampling, not to --use_ddim"
+    )
     dist_util.setup_dist()
     logger.configure(os.path.expanduser("~/logs/"))
 
@@ -36,9 +40,11 @@ def main():
     inpaintingSliceDataset = dataset.InpaintingSliceDataset(
         client,
         os.path.join(cfg.ROOT_DIR, args.data_csv),
-        "processed_data/frames/256x256",
+        args.frames_directory,
         random_masks=args.random_masks,
         return_info=args.return_item_info,
+        mask_bank_path=args.mask_bank or None,
+        resolution=args.image_size,
     )
 
     dataloader = DataLoader(
@@ -64,7 +70,17 @@ def main():
 
         model_kwargs = {}
 
-        sample_fn = diffusion.p_sample_loop_inpainting
+        if args.use_ddim:
+            sample_fn = partial(
+                diffusion.ddim_sample_loop_inpainting, eta=args.eta, in_place=True
+            )
+        else:
+            sample_fn = partial(
+                diffusion.p_sample_loop_inpainting,
+                in_place=True,
+                replace_known=args.replace_known,
+                resample_steps=args.resample_steps,
+            )
 
         sample, _ = sample_fn(
             model,
@@ -5,6 +5,7 @@ import cbct_artifact_reduction.config as cfg
 import cbct_artifact_reduction.lakefs_own as lakefs_own
 import cbct_artifact_reduction.pigjawdataset as dataset
 from cbct_artifact_reduction.argparser_config import create_train_argparser
+from cbct_artifact_reduction.batchprocessing import BatchPreprocessor
 from cbct_artifact_reduction.guided_diffusion import dist_util, logger
 from cbct_artifact_reduction.guided_diffusion.resample import (
     create_named_schedule_sampler,
@@ -15,7 +16,9 @@ from cbct_artifact_reduction.guided_diffusion.script_util import (
     model_and_diffusion_defaults,
 )
 from cbct_artifact_reduction.guided_diffusion.train_util import TrainLoop
-from torch.utils.data import DataLoader
+from cbct_artifact_reduction.readahead import ReadAheadSampler
+from cbct_artifact_reduction.rng import worker_init_fn
+from torch.utils.data import DataLoader, RandomSampler
 
 
 def main():
@@ -43,8 +46,19 @@ def main():
     inpaintingSliceDataset = dataset.InpaintingSliceDataset(
         client,
         os.path.join(cfg.ROOT_DIR, args.data_csv),
-        "processed_data/frames/256x256",
+        args.frames_directory,
         random_masks=args.random_masks,
+        normalization_stats_path=args.normalization_stats or None,
+        normalization=args.normalization,
+        batch_preprocessing=args.batch_preprocessing,
+        dtype=args.data_dtype,
+        seed=args.data_seed if args.data_seed >= 0 else None,
+        resolution=args.image_size,
+    )
+    batch_preprocessor = (
+        BatchPreprocessor(resolution=args.image_size)
+        if args.batch_preprocessing
+        else None
     )
 
     num_epochs = args.num_epochs
@@ -52,9 +66,28 @@ def main():
     step = 0
     for epoch in range(num_epochs):
         logger.log(f"epoch {epoch + 1}/{num_epochs}")
-        dataloader = DataLoader(
-            inpaintingSliceDataset, batch_size=args.batch_size, shuffle=True
-        )
+        if args.read_ahead > 0:
+            sampler = ReadAheadSampler(
+                RandomSampler(inpaintingSliceDataset),
+                inpaintingSliceDataset,
+                lookahead=args.read_ahead,
+            )
+            dataloader = DataLoader(
+                inpaintingSliceDataset,
+                batch_size=args.batch_size,
+                sampler=sampler,
+                num_workers=args.num_workers,
+                worker_init_fn=worker_init_fn,
+            )
+        else:
+            sampler = None
+            dataloader = DataLoader(
+                inpaintingSliceDataset,
+                batch_size=args.batch_size,
+                shuffle=True,
+                num_workers=args.num_workers,
+                worker_init_fn=worker_init_fn,
+            )
         data = iter(dataloader)
 
         step = TrainLoop(
@@ -74,7 +107,10 @@ def main():
             weight_decay=args.weight_decay,
             lr_anneal_steps=args.lr_anneal_steps,
             step=step if step else 0,
+            batch_preprocessor=batch_preprocessor,
         ).run_loop()
+        if sampler is not None:
+            logger.log(f"read-ahead: {sampler.stats()}")
         # Make sure to not resume checkpoint again after first epoch:
         args.resume_checkpoint = ""
 
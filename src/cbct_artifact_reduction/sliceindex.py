@@ -0,0 +1,253 @@
+import csv
+import os
+import re
+import warnings
+import zipfile
+
+import numpy as np
+
+from cbct_artifact_reduction.utils import DATA_CSV_PATH, get_datatable
+
+SCANNERS: tuple[str, ...] = ("axeos", "accuitomo", "planmeca", "x800")
+FOVS: tuple[str, ...] = ("small", "large")
+UNKNOWN_CODE = -1
+
+SLICE_FILENAME_PATTERN = re.compile(r"^(\d+)_(\d+)(\..+)?$")
+
+COLUMNS = ("volume_ids", "frames", "scanner_codes", "fov_codes")
+
+
+def encode(value, categories: tuple[str, ...]) -> int:
+    """Return the position of value in categories or UNKNOWN_CODE if it is not one of them."""
+    try:
+        return categories.index(value)
+    except ValueError:
+        return UNKNOWN_CODE
+
+
+def decode(code: int, categories: tuple[str, ...]) -> str | None:
+    """Inverse of encode. Returns None for UNKNOWN_CODE."""
+    if code == UNKNOWN_CODE:
+        return None
+    return categories[code]
+
+
+def parse_slice_filename(slice_filename: str) -> tuple[int, int]:
+    """Split a slice filename of the form '<volume id>_<frame>.nii.gz' into volume id and frame index.
+
+    Raises:
+        ValueError: If the filename does not match the expected format.
+    """
+    match = SLICE_FILENAME_PATTERN.match(os.path.basename(slice_filename))
+    if match is None:
+        raise ValueError(
+            f"Slice filename {slice_filename} does not match the expected format."
+        )
+    return int(match.group(1)), int(match.group(2))
+
+
+def sidecar_path(data_specification_path: str) -> str:
+    """Return the path of the .npz index file that belongs to a data specification csv."""
+    return os.path.splitext(data_specification_path)[0] + ".sliceindex.npz"
+
+
+def source_key(*paths: str) -> np.ndarray:
+    """Return the size and modification time of files, a sidecar built from them is rebuilt when one of them changes.
+
+    A missing file has size and modification time -1.
+    """
+    key = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            key += [stat.st_size, stat.st_mtime_ns]
+        else:
+            key += [-1, -1]
+    return np.array(key, dtype=np.int64)
+
+
+def mmap_npz(npz_path: str) -> dict[str, np.ndarray]:
+    """Memory-map the arrays of an uncompressed .npz file.
+
+    np.load ignores mmap_mode for .npz archives, so the offset of each stored member is looked up in the zip file and
+    mapped with np.memmap directly.
+    """
+    arrays = {}
+    with zipfile.ZipFile(npz_path) as archive, open(npz_path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{npz_path} is compressed and can't be memory-mapped")
+            # Skip the local file header, its length is not stored in the central directory.
+            f.seek(info.header_offset + 26)
+            name_length = int.from_bytes(f.read(2), "little")
+            extra_length = int.from_bytes(f.read(2), "little")
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            if np.lib.format.read_magic(f) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            arrays[info.filename.removesuffix(".npy")] = np.memmap(
+                npz_path,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def save_npz(npz_path: str, **arrays: np.ndarray):
+    """Atomically write arrays to an uncompressed .npz file, which can be memory-mapped by mmap_npz."""
+    tmp_path = f"{npz_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, npz_path)
+
+
+class SliceIndex:
+    """Columnar index of the slices listed in a data specification csv.
+
+    Each slice is described by one entry in a couple of small integer arrays instead of one Python object per slice,
+    so the index is cheap to build, to pickle into DataLoader workers and to share between forked processes.
+
+    Attributes:
+        volume_ids (np.ndarray): Scan id of the volume each slice belongs to.
+        frames (np.ndarray): Frame index of each slice within its volume.
+        scanner_codes (np.ndarray): Position of the scanner in SCANNERS, UNKNOWN_CODE if not in data.csv.
+        fov_codes (np.ndarray): Position of the field of view in FOVS, UNKNOWN_CODE if not in data.csv.
+    """
+
+    def __init__(
+        self,
+        volume_ids: np.ndarray,
+        frames: np.ndarray,
+        scanner_codes: np.ndarray,
+        fov_codes: np.ndarray,
+    ) -> None:
+        assert len(volume_ids) == len(frames) == len(scanner_codes) == len(fov_codes), (
+            "All columns of the slice index must have the same length."
+        )
+        self.volume_ids = volume_ids
+        self.frames = frames
+        self.scanner_codes = scanner_codes
+        self.fov_codes = fov_codes
+        self.npz_path: str | None = None
+
+    @classmethod
+    def from_specification(
+        cls, data_specification_path: str, datatable_path: str = DATA_CSV_PATH
+    ) -> "SliceIndex":
+        """Build the index from a csv file whose first column contains slice filenames, see from_slices."""
+        volume_ids = []
+        frames = []
+        with open(data_specification_path, "r", newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)  # Skip the header row
+            for row in reader:
+                if not row:
+                    continue
+                volume_id, frame = parse_slice_filename(row[0].strip())
+                volume_ids.append(volume_id)
+                frames.append(frame)
+
+        return cls.from_slices(volume_ids, frames, datatable_path)
+
+    @classmethod
+    def from_slices(
+        cls, volume_ids, frames, datatable_path: str = DATA_CSV_PATH
+    ) -> "SliceIndex":
+        """Build the index from volume ids and frame indices.
+
+        Scanner and fov are looked up once per volume in the data table at datatable_path, data.csv by default.
+        """
+        volume_ids = np.asarray(volume_ids, dtype=np.int32)
+        frames = np.asarray(frames, dtype=np.int32)
+
+        datatable = get_datatable(datatable_path)
+        unique_ids, inverse = np.unique(volume_ids, return_inverse=True)
+        unique_scanners = np.full(len(unique_ids), UNKNOWN_CODE, dtype=np.int8)
+        unique_fovs = np.full(len(unique_ids), UNKNOWN_CODE, dtype=np.int8)
+        for i, volume_id in enumerate(unique_ids):
+            if volume_id in datatable:
+                unique_scanners[i] = encode(
+                    datatable.get_value(volume_id, "scanner"), SCANNERS
+                )
+                unique_fovs[i] = encode(datatable.get_value(volume_id, "fov"), FOVS)
+
+        return cls(volume_ids, frames, unique_scanners[inverse], unique_fovs[inverse])
+
+    @classmethod
+    def load(cls, npz_path: str, mmap: bool = True) -> "SliceIndex":
+        """Load an index that was written with save. If mmap is True, the columns are memory-mapped."""
+        if mmap:
+            arrays = mmap_npz(npz_path)
+        else:
+            with np.load(npz_path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        index = cls(*(arrays[name] for name in COLUMNS))
+        if mmap:
+            index.npz_path = npz_path
+        return index
+
+    @classmethod
+    def from_specification_cached(
+        cls,
+        data_specification_path: str,
+        mmap: bool = True,
+        datatable_path: str = DATA_CSV_PATH,
+    ) -> "SliceIndex":
+        """Load the index from the sidecar file next to the specification csv, or build and save it.
+
+        The sidecar stores the size and modification time of the specification csv and of the data table the scanners
+        and fovs come from, see source_key. It is rebuilt if one of them changed. Failing to write it only raises a
+        warning.
+        """
+        npz_path = sidecar_path(data_specification_path)
+        key = source_key(data_specification_path, datatable_path)
+        if os.path.exists(npz_path):
+            stored_key = mmap_npz(npz_path).get("source_key")
+            if stored_key is not None and np.array_equal(stored_key, key):
+                return cls.load(npz_path, mmap=mmap)
+
+        index = cls.from_specification(data_specification_path, datatable_path)
+        try:
+            index.save(npz_path, source_key=key)
+        except OSError as e:
+            warnings.warn(f"Could not write slice index to {npz_path}: {e}")
+            return index
+        return cls.load(npz_path, mmap=mmap) if mmap else index
+
+    def save(self, npz_path: str, **extra: np.ndarray):
+        """Save the columns and extra arrays as an uncompressed .npz file, which can be memory-mapped by load."""
+        save_npz(npz_path, **self.columns(), **extra)
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """Return the columns of the index by name."""
+        return {name: np.asarray(getattr(self, name)) for name in COLUMNS}
+
+    def __getstate__(self):
+        # Memory-mapped columns are mapped again in the unpickling process instead of being copied.
+        if self.npz_path is not None:
+            return {"npz_path": self.npz_path}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if set(state) == {"npz_path"}:
+            state = SliceIndex.load(state["npz_path"], mmap=True).__dict__
+        self.__dict__.update(state)
+
+    def __len__(self) -> int:
+        return len(self.volume_ids)
+
+    def filename(self, idx: int, extension: str = ".nii.gz") -> str:
+        """Rebuild the filename of the idx-th slice."""
+        return f"{self.volume_ids[idx]}_{self.frames[idx]}{extension}"
+
+    def scanner(self, idx: int) -> str | None:
+        return decode(int(self.scanner_codes[idx]), SCANNERS)
+
+    def fov(self, idx: int) -> str | None:
+        return decode(int(self.fov_codes[idx]), FOVS)
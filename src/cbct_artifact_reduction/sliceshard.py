@@ -0,0 +1,270 @@
+import os
+from typing import Self
+
+import numpy as np
+
+from cbct_artifact_reduction.dataprocessing import single_nifti_to_numpy
+from cbct_artifact_reduction.lakefs_own import CustomBoto3Client
+from cbct_artifact_reduction.pigjawdataset import InpaintingSliceDataset
+from cbct_artifact_reduction.sliceindex import (
+    COLUMNS,
+    SliceIndex,
+    mmap_npz,
+    parse_slice_filename,
+    save_npz,
+)
+from cbct_artifact_reduction.utils import lookup_num_in_datatable
+
+SHARD_INDEX_FILENAME = "index.npz"
+
+
+def shard_filename(shard_number: int) -> str:
+    return f"shard_{shard_number:05d}.npz"
+
+
+class SliceShardWriter:
+    """Pack 2d slices into shards of fixed-shape arrays.
+
+    A shard is an uncompressed .npz file with a 'slices' array of shape (N, H, W) and the SliceIndex columns of its N
+    slices. Because every slice has the same shape, slice i of a shard starts at a fixed offset and can be read from a
+    memory-mapped shard without decoding anything. Next to the shards, index.npz holds the SliceIndex columns of all
+    slices and 'shard_offsets', the position of the first slice of every shard plus the total amount of slices.
+
+    Use as a context manager or call close() to write the last shard and the index. If the context exits with an
+    exception, the writer is aborted instead, see abort().
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        shard_size: int = 1024,
+        dtype: np.dtype | type = np.float32,
+    ) -> None:
+        """Initializes the writer.
+
+        Args:
+            output_dir (str): The directory the shards are written to. Is created if it doesn't exist.
+            shard_size (int): The maximum amount of slices per shard.
+            dtype (np.dtype): The dtype of the stored slices, float16 or float32.
+        """
+        assert np.dtype(dtype) in (
+            np.float16,
+            np.float32,
+        ), "Shards can only store float16 or float32 slices"
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.slice_shape: tuple[int, ...] | None = None
+
+        self._slices: list[np.ndarray] = []
+        self._volume_ids: list[int] = []
+        self._frames: list[int] = []
+        self._shard_indices: list[SliceIndex] = []
+        self._closed = False
+
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, np_array: np.ndarray, volume_id: int, frame: int):
+        """Add a single slice. All slices must have the same shape."""
+        assert not self._closed, "Can't add slices to a closed writer"
+        if self.slice_shape is None:
+            self.slice_shape = np_array.shape
+        assert np_array.shape == self.slice_shape, (
+            f"Slice of volume {volume_id} frame {frame} has shape {np_array.shape}, expected {self.slice_shape}"
+        )
+
+        with np.errstate(over="ignore"):
+            converted = np_array.astype(self.dtype)
+        if not np.isfinite(converted).all():
+            raise ValueError(
+                f"Slice of volume {volume_id} frame {frame} can't be represented as {self.dtype}"
+            )
+
+        self._slices.append(converted)
+        self._volume_ids.append(volume_id)
+        self._frames.append(frame)
+        if len(self._slices) == self.shard_size:
+            self._write_shard()
+
+    def _write_shard(self):
+        if not self._slices:
+            return
+        index = SliceIndex.from_slices(self._volume_ids, self._frames)
+        save_npz(
+            os.path.join(self.output_dir, shard_filename(len(self._shard_indices))),
+            slices=np.stack(self._slices),
+            **index.columns(),
+        )
+        self._shard_indices.append(index)
+        self._slices, self._volume_ids, self._frames = [], [], []
+
+    def close(self):
+        """Write the last shard and the shard index."""
+        if self._closed:
+            return
+        self._write_shard()
+        self._closed = True
+
+        index = SliceIndex(
+            *(
+                np.concatenate(
+                    [getattr(shard_index, name) for shard_index in self._shard_indices]
+                )
+                if self._shard_indices
+                else np.empty(0, dtype=dtype)
+                for name, dtype in zip(COLUMNS, (np.int32, np.int32, np.int8, np.int8))
+            )
+        )
+        shard_lengths = [len(shard_index) for shard_index in self._shard_indices]
+        save_npz(
+            os.path.join(self.output_dir, SHARD_INDEX_FILENAME),
+            shard_offsets=np.concatenate([[0], np.cumsum(shard_lengths)]).astype(
+                np.int64
+            ),
+            **index.columns(),
+        )
+
+    def abort(self):
+        """Drop the slices that are not written yet and remove the shard index, so the partial shards aren't used."""
+        self._closed = True
+        self._slices, self._volume_ids, self._frames = [], [], []
+        index_path = os.path.join(self.output_dir, SHARD_INDEX_FILENAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def pack_specification_into_shards(
+    lakefs_loader: CustomBoto3Client,
+    data_specification_path: str,
+    slice_directory_path: str,
+    output_dir: str,
+    shard_size: int = 1024,
+    dtype: np.dtype | type = np.float32,
+    progress_interval: int = 1000,
+):
+    """Pack all slices listed in a data specification csv into shards.
+
+    Args:
+        lakefs_loader (CustomBoto3Client): The client used to load the slices from LakeFS.
+        data_specification_path (str): The path to the data specification file.
+        slice_directory_path (str): The remote directory containing the slices.
+        output_dir (str): The local directory the shards are written to.
+        shard_size (int): The maximum amount of slices per shard.
+        dtype (np.dtype): The dtype of the stored slices, float16 or float32.
+        progress_interval (int): The progress is printed every progress_interval slices and after the last one.
+    """
+    index = SliceIndex.from_specification(data_specification_path)
+    with SliceShardWriter(output_dir, shard_size=shard_size, dtype=dtype) as writer:
+        for idx in range(len(index)):
+            relative_slice_path = os.path.join(
+                slice_directory_path, index.filename(idx)
+            )
+            slice_path = lakefs_loader.get_file(relative_slice_path)
+            volume_id, frame = parse_slice_filename(relative_slice_path)
+            writer.add(single_nifti_to_numpy(slice_path), volume_id, frame)
+            if (idx + 1) % progress_interval == 0 or idx + 1 == len(index):
+                print(f"Packed slice {idx + 1}/{len(index)}")
+
+
+class ShardSliceDataset(InpaintingSliceDataset):
+    """A dataset that reads slices from shards written by SliceShardWriter instead of one nifti file per slice.
+
+    Shards are fetched through the boto3client cache like any other file and memory-mapped, so reading a slice is a
+    copy from the page cache. Masks and preprocessing are the same as in InpaintingSliceDataset."""
+
+    def __init__(
+        self,
+        lakefs_loader: CustomBoto3Client,
+        shard_directory_path: str,
+        random_masks: bool = True,
+        return_info: bool = False,
+        normalization_stats_path: str | None = None,
+        normalization: str = "slice",
+        batch_preprocessing: bool = False,
+        dtype: np.dtype | type = np.float32,
+        mask_bank_path: str | None = None,
+        seed: int | None = None,
+        resolution: int | tuple[int, int] | None = None,
+    ) -> None:
+        """Initializes the dataset.
+
+        Args:
+            lakefs_loader (boto3client): The LakeFSLoader object used to load data from LakeFS.
+            shard_directory_path (str): The relative path to the remote/local directory containing the shards and index.npz.
+            random_masks (bool): Whether to generate random masks or use the random generated masks with the hash of the file name.
+            return_info (bool): Whether to return the info of the slices or not.
+            normalization_stats_path (str, optional): The path to precomputed normalization statistics, see InpaintingSliceDataset.
+            normalization (str): One of "slice", "volume" or "scanner", see InpaintingSliceDataset.
+            batch_preprocessing (bool): Whether to return raw slices for BatchPreprocessor, see InpaintingSliceDataset.
+            dtype (np.dtype): The dtype of the returned slices and masks, see InpaintingSliceDataset.
+            mask_bank_path (str, optional): The path to a mask bank for the fixed masks, see InpaintingSliceDataset.
+            seed (int, optional): The seed of the random masks, see InpaintingSliceDataset.
+            resolution (int | tuple[int, int], optional): The resolution of the slices and masks, see InpaintingSliceDataset.
+        """
+        self._shards: dict[int, np.ndarray] = {}
+        super().__init__(
+            lakefs_loader,
+            os.path.join(shard_directory_path, SHARD_INDEX_FILENAME),
+            shard_directory_path,
+            random_masks=random_masks,
+            return_info=return_info,
+            use_index_sidecar=False,
+            normalization_stats_path=normalization_stats_path,
+            normalization=normalization,
+            batch_preprocessing=batch_preprocessing,
+            dtype=dtype,
+            mask_bank_path=mask_bank_path,
+            seed=seed,
+            resolution=resolution,
+        )
+
+    def prepare_dataset(self) -> SliceIndex:
+        """Load the index of all slices in the shards from index.npz."""
+        index_path = self.lakefs_loader.get_file(self.data_specification_path)
+        self.shard_offsets = np.array(mmap_npz(index_path)["shard_offsets"])
+        return SliceIndex.load(index_path, mmap=True)
+
+    def _locate(self, idx: int) -> tuple[int, int]:
+        """Return the shard number and the row within the shard of the idx-th slice."""
+        shard_number = int(np.searchsorted(self.shard_offsets, idx, side="right")) - 1
+        return shard_number, idx - int(self.shard_offsets[shard_number])
+
+    def _relative_shard_path(self, shard_number: int) -> str:
+        return os.path.join(
+            self.relative_slice_directory_path, shard_filename(shard_number)
+        )
+
+    def _get_shard(self, shard_number: int) -> np.ndarray:
+        shard = self._shards.get(shard_number)
+        if shard is None:
+            relative_shard_path = self._relative_shard_path(shard_number)
+            shard_path = self.lakefs_loader.get_file(relative_shard_path)
+            shard = mmap_npz(shard_path)["slices"]
+            self._shards[shard_number] = shard
+        return shard
+
+    def remote_paths(self, idx: int) -> list[str]:
+        return [self._relative_shard_path(self._locate(idx)[0])]
+
+    def load_slice(self, idx: int) -> tuple[np.ndarray, dict | None, str]:
+        shard_number, row = self._locate(idx)
+        slice_np_array = np.array(
+            self._get_shard(shard_number)[row], dtype=self.read_dtype
+        )
+        item_info = lookup_num_in_datatable(int(self.dataset.volume_ids[idx]))
+        return slice_np_array, item_info, self.dataset.filename(idx)
+
+    def __getstate__(self):
+        # Don't copy the mapped shards into DataLoader workers, they map them again on first access.
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
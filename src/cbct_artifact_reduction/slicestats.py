@@ -0,0 +1,236 @@
+import os
+
+import numpy as np
+
+from cbct_artifact_reduction.sliceindex import (
+    SCANNERS,
+    UNKNOWN_CODE,
+    SliceIndex,
+    mmap_npz,
+    save_npz,
+)
+
+NORMALIZATIONS = ("slice", "volume", "scanner")
+STATS_COLUMNS = ("lower", "upper", "min", "max")
+
+
+def stats_path(data_specification_path: str) -> str:
+    """Return the default path of the normalization statistics of a data specification csv."""
+    return os.path.splitext(data_specification_path)[0] + ".slicestats.npz"
+
+
+def compute_stats(
+    np_array: np.ndarray,
+    lower_quantile: float = 0.001,
+    upper_quantile: float = 0.999,
+    overwrite_input: bool = False,
+) -> np.ndarray:
+    """Return the lower and upper quantile, the minimum and the maximum of an array.
+
+    Both quantiles are computed with a single call to np.quantile, which partitions the array only once. With
+    overwrite_input, the array is partitioned in place instead of a copy, which reorders its values.
+
+    Returns:
+        np.ndarray: The values in the order of STATS_COLUMNS.
+    """
+    minimum, maximum = np_array.min(), np_array.max()
+    lower, upper = np.quantile(
+        np_array, [lower_quantile, upper_quantile], overwrite_input=overwrite_input
+    )
+    return np.array([lower, upper, minimum, maximum], dtype=np.float64)
+
+
+def compute_slice_stats(
+    slices: np.ndarray, lower_quantile: float = 0.001, upper_quantile: float = 0.999
+) -> np.ndarray:
+    """Return the statistics of every slice of a stack of shape (N, H, W), like compute_stats, shape (N, 4).
+
+    The slices are partitioned in place, which reorders the values within every slice.
+    """
+    slices = slices.reshape(len(slices), -1)
+    minimum, maximum = slices.min(axis=1), slices.max(axis=1)
+    lower, upper = np.quantile(
+        slices, [lower_quantile, upper_quantile], axis=1, overwrite_input=True
+    )
+    return np.stack([lower, upper, minimum, maximum], axis=1).astype(np.float64)
+
+
+class SliceStats:
+    """Normalization statistics of every slice, volume and scanner of a dataset.
+
+    Each row of slice_stats, volume_stats and scanner_stats holds the values of STATS_COLUMNS. The rows of slice_stats
+    are in the order of the SliceIndex of the dataset, volume_stats has one row per entry of stats_volume_ids and
+    scanner_stats one row per entry of SCANNERS. Scanners without volumes have NaN rows.
+
+    Attributes:
+        volume_ids (np.ndarray): Volume id of each slice, used to check that the stats belong to a dataset.
+        frames (np.ndarray): Frame of each slice, used to check that the stats belong to a dataset.
+        slice_stats (np.ndarray): Statistics of every slice, shape (N, 4).
+        stats_volume_ids (np.ndarray): The sorted ids of all volumes.
+        volume_scanner_codes (np.ndarray): The scanner code of every volume, see SliceIndex.
+        volume_stats (np.ndarray): Statistics of the slices of every volume together, shape (V, 4).
+        scanner_stats (np.ndarray): Median of the volume statistics of every scanner, shape (len(SCANNERS), 4).
+        quantiles (np.ndarray): The lower and upper quantile the stats were computed with.
+    """
+
+    def __init__(
+        self,
+        volume_ids: np.ndarray,
+        frames: np.ndarray,
+        slice_stats: np.ndarray,
+        stats_volume_ids: np.ndarray,
+        volume_scanner_codes: np.ndarray,
+        volume_stats: np.ndarray,
+        scanner_stats: np.ndarray,
+        quantiles: np.ndarray,
+    ) -> None:
+        self.volume_ids = volume_ids
+        self.frames = frames
+        self.slice_stats = slice_stats
+        self.stats_volume_ids = stats_volume_ids
+        self.volume_scanner_codes = volume_scanner_codes
+        self.volume_stats = volume_stats
+        self.scanner_stats = scanner_stats
+        self.quantiles = quantiles
+
+    @classmethod
+    def compute(
+        cls,
+        dataset,
+        lower_quantile: float = 0.001,
+        upper_quantile: float = 0.999,
+        verbose: bool = True,
+        chunk_slices: int = 64,
+    ) -> "SliceStats":
+        """Compute the statistics of all slices of a dataset.
+
+        The slices are loaded once, volume by volume, with dataset.load_slice, so this works for every dataset that
+        is derived from InpaintingSliceDataset. The quantiles of a volume are computed over all its slices in the
+        dataset, the statistics of a scanner are the median of the statistics of its volumes.
+
+        The slices of a volume are loaded into one float32 array, chunk_slices at a time, and the quantiles of every
+        chunk of slices are computed together. The quantiles of the volume are then computed in place on that array,
+        so a volume is held in memory only once.
+
+        Args:
+            dataset (InpaintingSliceDataset): The dataset to compute the statistics for.
+            lower_quantile (float): The lower quantile, same as in remove_outliers.
+            upper_quantile (float): The upper quantile, same as in remove_outliers.
+            verbose (bool): Whether to print the progress.
+            chunk_slices (int): The number of slices whose statistics are computed at once.
+
+        Returns:
+            SliceStats: The statistics of the dataset.
+        """
+        index: SliceIndex = dataset.dataset
+        volume_ids = np.asarray(index.volume_ids)
+        stats_volume_ids, inverse = np.unique(volume_ids, return_inverse=True)
+
+        slice_stats = np.empty((len(index), len(STATS_COLUMNS)), dtype=np.float64)
+        volume_stats = np.empty(
+            (len(stats_volume_ids), len(STATS_COLUMNS)), dtype=np.float64
+        )
+        volume_scanner_codes = np.empty(len(stats_volume_ids), dtype=np.int8)
+        for v, volume_id in enumerate(stats_volume_ids):
+            slice_indices = np.flatnonzero(inverse == v)
+            volume = None
+            for start in range(0, len(slice_indices), chunk_slices):
+                chunk_indices = slice_indices[start : start + chunk_slices]
+                for i, idx in enumerate(chunk_indices, start=start):
+                    slice_np_array = dataset.load_slice(int(idx))[0]
+                    if volume is None:
+                        volume = np.empty(
+                            (len(slice_indices), *slice_np_array.shape),
+                            dtype=np.float32,
+                        )
+                    volume[i] = slice_np_array
+                slice_stats[chunk_indices] = compute_slice_stats(
+                    volume[start : start + len(chunk_indices)],
+                    lower_quantile,
+                    upper_quantile,
+                )
+            volume_stats[v] = compute_stats(
+                volume, lower_quantile, upper_quantile, overwrite_input=True
+            )
+            volume_scanner_codes[v] = index.scanner_codes[slice_indices[0]]
+            if verbose:
+                print(
+                    f"Computed stats of volume {volume_id} ({v + 1}/{len(stats_volume_ids)})"
+                )
+
+        scanner_stats = np.full((len(SCANNERS), len(STATS_COLUMNS)), np.nan)
+        for code in range(len(SCANNERS)):
+            if (volume_scanner_codes == code).any():
+                scanner_stats[code] = np.median(
+                    volume_stats[volume_scanner_codes == code], axis=0
+                )
+
+        return cls(
+            volume_ids,
+            np.asarray(index.frames),
+            slice_stats,
+            stats_volume_ids,
+            volume_scanner_codes,
+            volume_stats,
+            scanner_stats,
+            np.array([lower_quantile, upper_quantile]),
+        )
+
+    @classmethod
+    def load(cls, npz_path: str) -> "SliceStats":
+        """Load statistics that were written with save. The arrays are memory-mapped."""
+        arrays = mmap_npz(npz_path)
+        return cls(
+            arrays["volume_ids"],
+            arrays["frames"],
+            arrays["slice_stats"],
+            arrays["stats_volume_ids"],
+            arrays["volume_scanner_codes"],
+            arrays["volume_stats"],
+            arrays["scanner_stats"],
+            np.array(arrays["quantiles"]),
+        )
+
+    def save(self, npz_path: str):
+        """Save the statistics as an uncompressed .npz file."""
+        save_npz(
+            npz_path,
+            volume_ids=np.asarray(self.volume_ids),
+            frames=np.asarray(self.frames),
+            slice_stats=np.asarray(self.slice_stats),
+            stats_volume_ids=np.asarray(self.stats_volume_ids),
+            volume_scanner_codes=np.asarray(self.volume_scanner_codes),
+            volume_stats=np.asarray(self.volume_stats),
+            scanner_stats=np.asarray(self.scanner_stats),
+            quantiles=np.asarray(self.quantiles),
+        )
+
+    def matches(self, index: SliceIndex) -> bool:
+        """Check that the statistics were computed for the slices of index, in the same order."""
+        return np.array_equal(self.volume_ids, index.volume_ids) and np.array_equal(
+            self.frames, index.frames
+        )
+
+    def bounds(self, idx: int, normalization: str = "slice") -> tuple[float, float]:
+        """Return the lower and upper clipping bound of the idx-th slice.
+
+        Args:
+            idx (int): The index of the slice in the SliceIndex the stats were computed for.
+            normalization (str): One of NORMALIZATIONS. Whether to use the quantiles of the slice itself, of its
+                volume or of its scanner. Slices of volumes with an unknown scanner use the volume quantiles.
+
+        Returns:
+            tuple[float, float]: The lower and upper quantile.
+        """
+        assert normalization in NORMALIZATIONS, (
+            f"normalization must be one of {NORMALIZATIONS}"
+        )
+        if normalization == "slice":
+            row = self.slice_stats[idx]
+        else:
+            v = int(np.searchsorted(self.stats_volume_ids, self.volume_ids[idx]))
+            row = self.volume_stats[v]
+            scanner_code = int(self.volume_scanner_codes[v])
+            if normalization == "scanner" and scanner_code != UNKNOWN_CODE:
+                row = self.scanner_stats[scanner_code]
+        return float(row[0]), float(row[1])
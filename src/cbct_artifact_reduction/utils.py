@@ -1,5 +1,6 @@
 import os
 import random
+import threading
 
 import pandas as pd
 
@@ -13,25 +14,137 @@ OUTPUT_DIR = os.path.join(ROOT_DIR, "output")
 FRAME_DIR = os.path.join(ROOT_DIR, "output", "frames")
 
 
+class DataTable:
+    """In-memory, id-indexed view of a data.csv file.
+
+    The csv file is read once and every row is stored in a dictionary keyed by its scan id, so lookups don't touch the disk.
+
+    Attributes:
+        csv_path (str): Path to the csv file the table was loaded from.
+        columns (list[str]): Column names of the csv file.
+    """
+
+    def __init__(self, csv_path: str) -> None:
+        """Loads the csv file into memory.
+
+        Args:
+            csv_path (str): Path to the csv file. Must contain an 'id' column.
+        """
+        self.csv_path = csv_path
+        df = pd.read_csv(csv_path)
+        self.columns: list[str] = list(df.columns)
+        self._rows: dict[int, dict] = {
+            int(row["id"]): row for row in df.to_dict(orient="records")
+        }
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, num) -> bool:
+        return int(num) in self._rows
+
+    def ids(self) -> list[int]:
+        """Return all scan ids in the order of the csv file."""
+        return list(self._rows.keys())
+
+    def lookup(self, num: int | str) -> dict | None:
+        """Look up a single row.
+
+        Args:
+            num (int | str): The id of the row to look up.
+
+        Returns:
+            dict | None: The row in the format of DataFrame.to_dict(orient="list"), or None if the id is not in the table.
+        """
+        row = self._rows.get(int(num))
+        if row is None:
+            return None
+        return {key: [value] for key, value in row.items()}
+
+    def lookup_many(self, nums) -> list[dict | None]:
+        """Look up many rows at once. See lookup for the format of a single row."""
+        return [self.lookup(num) for num in nums]
+
+    def get_value(self, num: int | str, column: str):
+        """Return a single value of a row. Raises KeyError if the id or column doesn't exist."""
+        return self._rows[int(num)][column]
+
+
+DATA_CSV_PATH = os.path.join(ROOT_DIR, "data.csv")
+
+_datatables: dict[str, DataTable] = {}
+_datatables_lock = threading.Lock()
+
+
+def get_datatable(csv_path: str = DATA_CSV_PATH) -> DataTable:
+    """Return the process-wide DataTable for csv_path. The csv file is only read on the first call.
+
+    Args:
+        csv_path (str, optional): Path to the csv file. Defaults to data.csv in the project root.
+
+    Returns:
+        DataTable: The cached table.
+    """
+    key = os.path.abspath(csv_path)
+    table = _datatables.get(key)
+    if table is None:
+        with _datatables_lock:
+            table = _datatables.get(key)
+            if table is None:
+                table = DataTable(key)
+                _datatables[key] = table
+    return table
+
+
+def reload_datatable(csv_path: str = DATA_CSV_PATH) -> DataTable:
+    """Read csv_path from disk again and replace the cached table."""
+    key = os.path.abspath(csv_path)
+    table = DataTable(key)
+    with _datatables_lock:
+        _datatables[key] = table
+    return table
+
+
+def invalidate_datatable(csv_path: str | None = None):
+    """Drop cached tables so the next get_datatable call reads the csv file again.
+
+    Args:
+        csv_path (str, optional): The table to drop. Drops all cached tables if None.
+    """
+    with _datatables_lock:
+        if csv_path is None:
+            _datatables.clear()
+        else:
+            _datatables.pop(os.path.abspath(csv_path), None)
+
+
 def lookup_num_in_datatable(num: int):
     """Looks up a row in the data.csv file and returns it as a dictionary.
 
+    The data.csv file is only read once per process, see get_datatable.
+
     Args:
         num (int): The id of the row to look up.
 
     Returns:
-        dict: The row as a dictionary.
-
-    Throws:
-        KeyError: If the id is not found in the data.csv file.
+        dict: The row as a dictionary, or None if the id is not found in the data.csv file.
     """
-    df = pd.read_csv(os.path.join(ROOT_DIR, "data.csv"))
-    try:
-        match = df.loc[df["id"] == num]
-        return match.to_dict(orient="list")
-    except KeyError:
+    match = get_datatable().lookup(num)
+    if match is None:
         print(f"Could not find id {num} in data.csv")
-        return None
+    return match
+
+
+def lookup_nums_in_datatable(nums) -> list[dict | None]:
+    """Looks up many rows in the data.csv file at once.
+
+    Args:
+        nums (Iterable[int]): The ids of the rows to look up.
+
+    Returns:
+        list[dict | None]: One row dictionary per id, None for ids that are not found in the data.csv file.
+    """
+    return get_datatable().lookup_many(nums)
 
 
 def get_scanner_from_num(num: int):
@@ -89,6 +202,18 @@ def generate_random_integers(N, A, B):
     return [random.randint(A, B) for _ in range(N)]
 
 
+def _getIDsWhere(column: str, value, exludeIDs: list[int] | None) -> list[str]:
+    """Find all scan ID's of the CBCT pig jaw data whose column in data.csv equals value."""
+    datatable = get_datatable()
+    return [
+        f"{id}"
+        for id in range(1, 401)
+        if id in datatable
+        and (exludeIDs is None or id not in exludeIDs)
+        and datatable.get_value(id, column) == value
+    ]
+
+
 def getAllControlIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
     """Find all scan ID's that correspond to control images without implants in the CBCT pig jaw data.
 
@@ -100,18 +225,7 @@ def getAllControlIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
         list[str]: List of scan ID's that correspond to control images without implants.
     """
 
-    if exludeIDs is None:
-        possibleIDs = [f"{f}" for f in range(1, 401)]
-    else:
-        possibleIDs = [f"{f}" for f in range(1, 401) if f not in exludeIDs]
-
-    controlIDs: list[str] = []
-    for id in possibleIDs:
-        scanner = get_scanner_from_num(int(id))
-        if scanner[3] == 0:
-            controlIDs.append(id)
-
-    return controlIDs
+    return _getIDsWhere("implants", 0, exludeIDs)
 
 
 def getAllAxeosIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
@@ -125,18 +239,7 @@ def getAllAxeosIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
         list[str]: List of scan ID's that correspond to Axeos images.
     """
 
-    if exludeIDs is None:
-        possibleIDs = [f"{f}" for f in range(1, 401)]
-    else:
-        possibleIDs = [f"{f}" for f in range(1, 401) if f not in exludeIDs]
-
-    axeosIDs: list[str] = []
-    for id in possibleIDs:
-        scanner = get_scanner_from_num(int(id))
-        if scanner[1] == "axeos":
-            axeosIDs.append(id)
-
-    return axeosIDs
+    return _getIDsWhere("scanner", "axeos", exludeIDs)
 
 
 def getAllAccuitomoIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
@@ -150,18 +253,7 @@ def getAllAccuitomoIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
         list[str]: List of scan ID's that correspond to Accuitomo images.
     """
 
-    if exludeIDs is None:
-        possibleIDs = [f"{f}" for f in range(1, 401)]
-    else:
-        possibleIDs = [f"{f}" for f in range(1, 401) if f not in exludeIDs]
-
-    accuitomoIDs: list[str] = []
-    for id in possibleIDs:
-        scanner = get_scanner_from_num(int(id))
-        if scanner[1] == "accuitomo":
-            accuitomoIDs.append(id)
-
-    return accuitomoIDs
+    return _getIDsWhere("scanner", "accuitomo", exludeIDs)
 
 
 def getAllplanmecaIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
@@ -175,18 +267,7 @@ def getAllplanmecaIDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
         list[str]: List of scan ID's that correspond to Planmeca images.
     """
 
-    if exludeIDs is None:
-        possibleIDs = [f"{f}" for f in range(1, 401)]
-    else:
-        possibleIDs = [f"{f}" for f in range(1, 401) if f not in exludeIDs]
-
-    planmecaIDs: list[str] = []
-    for id in possibleIDs:
-        scanner = get_scanner_from_num(int(id))
-        if scanner[1] == "planmeca":
-            planmecaIDs.append(id)
-
-    return planmecaIDs
+    return _getIDsWhere("scanner", "planmeca", exludeIDs)
 
 
 def getAllx800IDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
@@ -200,15 +281,4 @@ def getAllx800IDs(exludeIDs: list[int] | None = [41, 208]) -> list[str]:
         list[str]: List of scan ID's that correspond to x800 images.
     """
 
-    if exludeIDs is None:
-        possibleIDs = [f"{f}" for f in range(1, 401)]
-    else:
-        possibleIDs = [f"{f}" for f in range(1, 401) if f not in exludeIDs]
-
-    x800IDs: list[str] = []
-    for id in possibleIDs:
-        scanner = get_scanner_from_num(int(id))
-        if scanner[1] == "x800":
-            x800IDs.append(id)
-
-    return x800IDs
+    return _getIDsWhere("scanner", "x800", exludeIDs)
@@ -0,0 +1,130 @@
+import os
+import warnings
+
+import nibabel as nib
+import numpy as np
+
+from cbct_artifact_reduction.lakefs_own import CustomBoto3Client
+from cbct_artifact_reduction.pigjawdataset import InpaintingSliceDataset
+from cbct_artifact_reduction.utils import lookup_num_in_datatable
+
+VOLUME_EXTENSIONS = (".npy", ".nii", ".nii.gz")
+
+
+def open_volume(volume_path: str):
+    """Open a volume without reading its data.
+
+    .npy files are memory-mapped, nifti files are opened through the nibabel dataobj proxy, which is memory-mapped for
+    uncompressed .nii files. In both cases vol[:, :, i] only reads the i-th frame.
+
+    Args:
+        volume_path (str): Path to a .npy, .nii or .nii.gz volume.
+
+    Returns:
+        np.ndarray | nib.arrayproxy.ArrayProxy: The lazily loaded volume.
+    """
+    assert os.path.exists(volume_path), f"{volume_path} does not exist"
+    if volume_path.endswith(".npy"):
+        return np.load(volume_path, mmap_mode="r")
+    if volume_path.endswith(".nii.gz"):
+        warnings.warn(
+            f"{volume_path} is compressed, every frame access decompresses the volume"
+        )
+    return nib.nifti1.Nifti1Image.from_filename(volume_path, mmap=True).dataobj
+
+
+class VolumeSliceDataset(InpaintingSliceDataset):
+    """A dataset that slices frames on demand from one uncompressed volume per scan id.
+
+    Instead of one file per frame, only one .npy or .nii file per volume is fetched through the boto3client cache.
+    Volumes are memory-mapped, so DataLoader workers share them through the page cache. The slices to use are specified
+    with the same csv files as for InpaintingSliceDataset, '<volume id>_<frame>.nii.gz' selects frame <frame> of
+    volume <volume id>."""
+
+    def __init__(
+        self,
+        lakefs_loader: CustomBoto3Client,
+        data_specification_path: str,
+        volume_directory_path: str,
+        volume_extension: str = ".npy",
+        random_masks: bool = True,
+        return_info: bool = False,
+        use_index_sidecar: bool = True,
+        normalization_stats_path: str | None = None,
+        normalization: str = "slice",
+        batch_preprocessing: bool = False,
+        dtype: np.dtype | type = np.float32,
+        mask_bank_path: str | None = None,
+        seed: int | None = None,
+        resolution: int | tuple[int, int] | None = None,
+    ) -> None:
+        """Initializes the dataset.
+
+        Args:
+            lakefs_loader (boto3client): The LakeFSLoader object used to load data from LakeFS.
+            data_specification_path (str): The path to the data specification file.
+            volume_directory_path (str): The relative path to the remote/local directory containing the volumes.
+            volume_extension (str): The extension of the volumes, one of .npy, .nii or .nii.gz.
+            random_masks (bool): Whether to generate random masks or use the random generated masks with the hash of the file name.
+            return_info (bool): Whether to return the info of the slices or not.
+            normalization_stats_path (str, optional): The path to precomputed normalization statistics, see InpaintingSliceDataset.
+            normalization (str): One of "slice", "volume" or "scanner", see InpaintingSliceDataset.
+            batch_preprocessing (bool): Whether to return raw slices for BatchPreprocessor, see InpaintingSliceDataset.
+            dtype (np.dtype): The dtype of the returned slices and masks, see InpaintingSliceDataset.
+            mask_bank_path (str, optional): The path to a mask bank for the fixed masks, see InpaintingSliceDataset.
+            seed (int, optional): The seed of the random masks, see InpaintingSliceDataset.
+            resolution (int | tuple[int, int], optional): The resolution of the slices and masks, see InpaintingSliceDataset.
+            use_index_sidecar (bool): Whether to store the slice index in a memory-mapped .npz file next to the data specification file.
+        """
+        assert volume_extension in VOLUME_EXTENSIONS, (
+            f"volume_extension must be one of {VOLUME_EXTENSIONS}"
+        )
+        self.volume_extension = volume_extension
+        self._volumes: dict[int, np.ndarray] = {}
+        super().__init__(
+            lakefs_loader,
+            data_specification_path,
+            volume_directory_path,
+            random_masks=random_masks,
+            return_info=return_info,
+            use_index_sidecar=use_index_sidecar,
+            normalization_stats_path=normalization_stats_path,
+            normalization=normalization,
+            batch_preprocessing=batch_preprocessing,
+            dtype=dtype,
+            mask_bank_path=mask_bank_path,
+            seed=seed,
+            resolution=resolution,
+        )
+
+    def _relative_volume_path(self, volume_id: int) -> str:
+        return os.path.join(
+            self.relative_slice_directory_path, f"{volume_id}{self.volume_extension}"
+        )
+
+    def _get_volume(self, volume_id: int):
+        volume = self._volumes.get(volume_id)
+        if volume is None:
+            relative_volume_path = self._relative_volume_path(volume_id)
+            volume_path = self.lakefs_loader.get_file(relative_volume_path)
+            volume = open_volume(volume_path)
+            self._volumes[volume_id] = volume
+        return volume
+
+    def remote_paths(self, idx: int) -> list[str]:
+        return [self._relative_volume_path(int(self.dataset.volume_ids[idx]))]
+
+    def load_slice(self, idx: int) -> tuple[np.ndarray, dict | None, str]:
+        volume_id = int(self.dataset.volume_ids[idx])
+        frame = int(self.dataset.frames[idx])
+        slice_np_array = np.asarray(
+            self._get_volume(volume_id)[:, :, frame], dtype=self.read_dtype
+        )
+        item_info = lookup_num_in_datatable(volume_id)
+        return slice_np_array, item_info, self.dataset.filename(idx)
+
+    def __getstate__(self):
+        # Don't copy the mapped volumes into DataLoader workers, they map them again on first access.
+        state = self.__dict__.copy()
+        state["_volumes"] = {}
+        return state
@@ -0,0 +1,367 @@
+import resource
+import time
+
+import nibabel as nib
+import numpy as np
+import torch as th
+
+from cbct_artifact_reduction.batchprocessing import (
+    as_resolution,
+    batch_quantiles,
+    resize_batch,
+)
+from cbct_artifact_reduction.dataprocessing import save_nifti
+
+
+def peak_memory_mb(device: th.device) -> float:
+    """Return the peak memory in MB, allocated by torch on a CUDA device and the peak RSS of the process otherwise."""
+    if device.type == "cuda":
+        return th.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def normalize_slices(
+    batch: th.Tensor, lower_quantile: float = 0.001, upper_quantile: float = 0.999
+) -> tuple[th.Tensor, th.Tensor, th.Tensor]:
+    """Clip every slice of a batch of shape (N, 1, H, W) to its quantiles and scale it to [0, 1].
+
+    Same normalization as BatchPreprocessor without scanner processing, but the bounds are returned as well, so that
+    the samples can be scaled back to the intensities of the volume.
+
+    Returns:
+        tuple[th.Tensor, th.Tensor, th.Tensor]: The normalized batch and the lower and upper bounds of shape
+            (N, 1, 1, 1).
+    """
+    x = batch.flatten(1)
+    quantiles = th.tensor(
+        [lower_quantile, upper_quantile], dtype=x.dtype, device=x.device
+    )
+    lower, upper = batch_quantiles(x, quantiles)
+    # Constant slices, e.g. padding or air, would divide by zero
+    scale = (upper - lower).clamp(min=th.finfo(x.dtype).eps)
+    x = (th.clamp(x, lower, upper) - lower) / scale
+    return x.view(batch.shape), lower.view(-1, 1, 1, 1), scale.view(-1, 1, 1, 1)
+
+
+def unet_downsampling_factor(model: th.nn.Module) -> int:
+    """Return the factor the UNet downsamples its input by, crops must be a multiple of it. 1 for other models."""
+    channel_mult = getattr(model, "channel_mult", None)
+    if not channel_mult:
+        return 1
+    return 2 ** (len(channel_mult) - 1)
+
+
+def crop_windows(
+    masks: th.Tensor, margin: int = 16, multiple: int = 1
+) -> tuple[tuple[int, int], list[tuple[int, int]]]:
+    """Find one crop size for a batch of masks and the position of each slice's crop.
+
+    The crops cover the bounding box of every mask plus margin pixels on each side, rounded up to a multiple of the
+    downsampling factor of the model. All crops of a batch have the same size, so that they can be sampled together,
+    and are centered on their mask as far as the slice allows.
+
+    Args:
+        masks (th.Tensor): Masks of shape (N, 1, H, W), none of them empty.
+        margin (int): The context around the bounding boxes in pixels.
+        multiple (int): The crop height and width are rounded up to a multiple of it.
+
+    Returns:
+        tuple[tuple[int, int], list[tuple[int, int]]]: The crop height and width and the top left corner of each crop.
+    """
+    height, width = masks.shape[-2:]
+    rows = masks[:, 0].any(dim=2).cpu().numpy()
+    cols = masks[:, 0].any(dim=1).cpu().numpy()
+    # First and one past the last masked row and column of every mask
+    y0, y1 = rows.argmax(axis=1), height - rows[:, ::-1].argmax(axis=1)
+    x0, x1 = cols.argmax(axis=1), width - cols[:, ::-1].argmax(axis=1)
+
+    def crop_size(extent: int, size: int) -> int:
+        extent = -(-(extent + 2 * margin) // multiple) * multiple
+        return min(size, extent)
+
+    crop_height = crop_size(int((y1 - y0).max()), height)
+    crop_width = crop_size(int((x1 - x0).max()), width)
+    corners = [
+        (
+            int(np.clip((top + bottom - crop_height) // 2, 0, height - crop_height)),
+            int(np.clip((left + right - crop_width) // 2, 0, width - crop_width)),
+        )
+        for top, bottom, left, right in zip(y0, y1, x0, x1)
+    ]
+    return (crop_height, crop_width), corners
+
+
+class VolumeInpainter:
+    """Inpaint the masked voxels of a whole volume with a diffusion model, many slices per sampler run.
+
+    The frames of the volume, its last axis like in NiftiDataFolder, are normalized like the training slices,
+    resampled to the image size of the model and inpainted batch_size at a time with one run of the sampler. The last
+    batch is padded to batch_size by repeating its last slice, so every run has the same shape. The samples are
+    scaled back to the intensities of the volume and only replace the masked voxels.
+
+    Slices with an empty mask are returned as they are without running the sampler, and with crop the sampler only
+    sees a window around the masks of each batch, see crop_windows. The saved work is reported as the number of
+    skipped slices and the number of pixels the model didn't have to process, at the image size of the model.
+
+    Usage:
+        inpainter = VolumeInpainter(model, diffusion, batch_size=32, image_size=256, use_ddim=True)
+        stats = inpainter.inpaint_file("volume.nii.gz", "mask.nii.gz", "inpainted.nii.gz")
+        print(f"{stats['slices_per_second']:.2f} slices/s, {stats['peak_memory_mb']:.0f} MB")
+    """
+
+    def __init__(
+        self,
+        model: th.nn.Module,
+        diffusion,
+        batch_size: int = 16,
+        image_size: int | tuple[int, int] | None = None,
+        use_ddim: bool = False,
+        eta: float = 0.0,
+        clip_denoised: bool = True,
+        lower_quantile: float = 0.001,
+        upper_quantile: float = 0.999,
+        device: th.device | None = None,
+        progress: bool = False,
+        crop: bool = True,
+        crop_margin: int = 16,
+        downsampling_factor: int | None = None,
+        replace_known: bool = False,
+        resample_steps: int = 1,
+    ) -> None:
+        """Initializes the inpainter.
+
+        Args:
+            model (th.nn.Module): The inpainting model, in eval mode.
+            diffusion (GaussianDiffusion): The diffusion to sample with, e.g. a SpacedDiffusion with ddim50.
+            batch_size (int): The number of slices per sampler run.
+            image_size (int | tuple[int, int], optional): The resolution of the model. Defaults to None, which samples
+                the slices at the resolution of the volume.
+            use_ddim (bool): Whether to sample with ddim_sample_loop_inpainting instead of p_sample_loop_inpainting.
+            eta (float): The noise of the DDIM steps.
+            clip_denoised (bool): Whether to clip the predicted x_start to [-1, 1].
+            lower_quantile (float): The lower quantile the slices are clipped to.
+            upper_quantile (float): The upper quantile the slices are clipped to.
+            device (th.device, optional): The device to sample on. Defaults to the device of the model.
+            progress (bool): Whether to show a progress bar for every sampler run.
+            crop (bool): Whether to sample only a window around the masks instead of the whole slices.
+            crop_margin (int): The context around the masks in the windows in pixels, at the image size of the model.
+            downsampling_factor (int, optional): The windows are a multiple of it. Defaults to the factor of the UNet,
+                see unet_downsampling_factor.
+            replace_known (bool): Whether to replace the known region in every ancestral step, see
+                p_sample_loop_progressive_inpainting. Not supported with use_ddim.
+            resample_steps (int): The number of times each ancestral step is sampled, needs replace_known.
+        """
+        assert not use_ddim or (not replace_known and resample_steps == 1), (
+            "replace_known and resample_steps only apply to ancestral sampling, not to DDIM"
+        )
+        self.model = model
+        self.diffusion = diffusion
+        self.batch_size = batch_size
+        self.image_size = None if image_size is None else as_resolution(image_size)
+        self.use_ddim = use_ddim
+        self.eta = eta
+        self.clip_denoised = clip_denoised
+        self.lower_quantile = lower_quantile
+        self.upper_quantile = upper_quantile
+        self.device = device or next(model.parameters()).device
+        self.progress = progress
+        self.crop = crop
+        self.crop_margin = crop_margin
+        self.downsampling_factor = downsampling_factor or unet_downsampling_factor(
+            model
+        )
+        self.replace_known = replace_known
+        self.resample_steps = resample_steps
+
+    def sample(self, masked_image: th.Tensor, mask: th.Tensor) -> th.Tensor:
+        """Run the sampler once on a batch of normalized masked slices and masks at the image size of the model."""
+        kwargs = {
+            "clip_denoised": self.clip_denoised,
+            "model_kwargs": {},
+            "device": self.device,
+            "progress": self.progress,
+            "in_place": True,
+        }
+        if self.use_ddim:
+            sample, _ = self.diffusion.ddim_sample_loop_inpainting(
+                self.model, masked_image, mask, eta=self.eta, **kwargs
+            )
+        else:
+            sample, _ = self.diffusion.p_sample_loop_inpainting(
+                self.model,
+                masked_image,
+                mask,
+                replace_known=self.replace_known,
+                resample_steps=self.resample_steps,
+                **kwargs,
+            )
+        return sample
+
+    def model_pixels(self, slice_shape: tuple[int, int]) -> int:
+        """Return the number of pixels the model processes for a whole slice of slice_shape."""
+        height, width = self.image_size or slice_shape
+        return height * width
+
+    def inpaint_batch(
+        self, slices: th.Tensor, masks: th.Tensor
+    ) -> tuple[th.Tensor, dict[str, int]]:
+        """Inpaint a batch of raw slices.
+
+        Slices with an empty mask are left out of the sampler run, which is skipped if all masks are empty.
+
+        Args:
+            slices (th.Tensor): Raw slices of shape (N, 1, H, W) with N <= batch_size.
+            masks (th.Tensor): The masks of the slices, same shape, nonzero where the slices are inpainted.
+
+        Returns:
+            tuple[th.Tensor, dict[str, int]]: The slices in float32 with the masked pixels replaced by the samples, and
+                the number of skipped slices and of pixels the model didn't process.
+        """
+        num_slices = len(slices)
+        assert num_slices <= self.batch_size, "a batch holds at most batch_size slices"
+        slices = slices.to(self.device, th.float32)
+        masks = (masks.to(self.device) != 0).to(th.float32)
+        selected = masks.flatten(1).any(dim=1).nonzero()[:, 0]
+        model_pixels = self.model_pixels(tuple(slices.shape[-2:]))
+        stats = {
+            "slices_skipped": num_slices - len(selected),
+            "pixels_avoided": (num_slices - len(selected)) * model_pixels,
+        }
+        if len(selected) == 0:
+            return slices, stats
+
+        num_selected = len(selected)
+        x_raw, masks = slices[selected], masks[selected]
+        if num_selected < self.batch_size:
+            padding = self.batch_size - num_selected
+            x_raw = th.cat([x_raw, x_raw[-1:].expand(padding, -1, -1, -1)])
+            masks = th.cat([masks, masks[-1:].expand(padding, -1, -1, -1)])
+
+        x, lower, scale = normalize_slices(
+            x_raw, self.lower_quantile, self.upper_quantile
+        )
+        model_masks = masks
+        if self.image_size is not None:
+            x = resize_batch(x, self.image_size)
+            # Every model pixel that a masked voxel contributes to is masked, so no mask vanishes and the masked
+            # voxels are resampled back from generated pixels only
+            model_masks = (resize_batch(masks, self.image_size) > 0).to(th.float32)
+
+        if self.crop:
+            (crop_height, crop_width), corners = crop_windows(
+                model_masks, self.crop_margin, self.downsampling_factor
+            )
+            windows = [
+                (
+                    slice(None),
+                    slice(top, top + crop_height),
+                    slice(left, left + crop_width),
+                )
+                for top, left in corners
+            ]
+            x_crops = th.stack([x[i][window] for i, window in enumerate(windows)])
+            mask_crops = th.stack(
+                [model_masks[i][window] for i, window in enumerate(windows)]
+            )
+            sample_crops = self.sample(x_crops * (1 - mask_crops), mask_crops)
+            sample = x.clone()
+            for i, window in enumerate(windows):
+                sample[i][window] = sample_crops[i].to(sample.dtype)
+            stats["pixels_avoided"] += num_selected * (
+                model_pixels - crop_height * crop_width
+            )
+        else:
+            sample = self.sample(x * (1 - model_masks), model_masks)
+
+        sample = resize_batch(sample.to(th.float32), slices.shape[-2:])
+        inpainted = slices.clone()
+        inpainted[selected] = th.where(masks > 0, sample * scale + lower, x_raw)[
+            :num_selected
+        ]
+        return inpainted, stats
+
+    @th.no_grad()
+    def inpaint_volume(
+        self, volume: np.ndarray, mask: np.ndarray
+    ) -> tuple[np.ndarray, dict[str, float]]:
+        """Inpaint all frames of a volume.
+
+        Only the frames with a nonempty mask are tiled into batches, the others are copied.
+
+        Args:
+            volume (np.ndarray): The volume of shape (H, W, T).
+            mask (np.ndarray): The mask of the volume, same shape, nonzero where the volume is inpainted.
+
+        Returns:
+            tuple[np.ndarray, dict[str, float]]: The inpainted volume in float32 and the number of slices, skipped
+                slices and batches, the number of pixels the model didn't process, the time it took in seconds, the
+                throughput in slices/s over all slices and the peak memory in MB, see peak_memory_mb.
+        """
+        assert volume.ndim == 3, "the volume must have three dimensions"
+        assert volume.shape == mask.shape, (
+            "the volume and the mask must have the same shape"
+        )
+        if self.device.type == "cuda":
+            th.cuda.reset_peak_memory_stats(self.device)
+
+        num_slices = volume.shape[2]
+        start_time = time.perf_counter()
+        output = volume.astype(np.float32)
+        frames = np.flatnonzero(mask.reshape(-1, num_slices).any(axis=0))
+        slices_skipped = num_slices - len(frames)
+        pixels_avoided = slices_skipped * self.model_pixels(volume.shape[:2])
+        num_batches = 0
+        for start in range(0, len(frames), self.batch_size):
+            batch_frames = frames[start : start + self.batch_size]
+            # (H, W, n) -> (n, 1, H, W)
+            slices = th.from_numpy(volume[:, :, batch_frames].transpose(2, 0, 1).copy())
+            masks = th.from_numpy(mask[:, :, batch_frames].transpose(2, 0, 1).copy())
+            inpainted, batch_stats = self.inpaint_batch(slices[:, None], masks[:, None])
+            output[:, :, batch_frames] = (
+                inpainted[:, 0].cpu().numpy().transpose(1, 2, 0)
+            )
+            pixels_avoided += batch_stats["pixels_avoided"]
+            num_batches += 1
+        if self.device.type == "cuda":
+            th.cuda.synchronize(self.device)
+        seconds = time.perf_counter() - start_time
+
+        return output, {
+            "slices": num_slices,
+            "slices_skipped": slices_skipped,
+            "pixels_avoided": pixels_avoided,
+            "batches": num_batches,
+            "seconds": seconds,
+            "slices_per_second": num_slices / seconds if seconds > 0 else float("inf"),
+            "peak_memory_mb": peak_memory_mb(self.device),
+        }
+
+    def inpaint_file(
+        self,
+        volume_path: str,
+        mask_path: str,
+        output_path: str,
+        compresslevel: int | None = None,
+    ) -> dict[str, float]:
+        """Inpaint a nifti volume and save the result with the affine and header of the volume.
+
+        Args:
+            volume_path (str): The nifti volume.
+            mask_path (str): The nifti mask of the volume.
+            output_path (str): Where the inpainted volume is saved, as float32.
+            compresslevel (int, optional): The gzip level, see save_nifti.
+
+        Returns:
+            dict[str, float]: The stats of inpaint_volume.
+        """
+        image = nib.load(volume_path)
+        volume = image.get_fdata(dtype=np.float32)
+        mask = np.asanyarray(nib.load(mask_path).dataobj) != 0
+        output, stats = self.inpaint_volume(volume, mask)
+
+        header = image.header.copy()
+        header.set_data_dtype(np.float32)
+        output_image = nib.nifti1.Nifti1Image(output, image.affine, header)
+        save_nifti(output_image, output_path, compresslevel)
+        return stats
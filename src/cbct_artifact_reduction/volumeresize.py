@@ -0,0 +1,346 @@
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nibabel as nib
+import numpy as np
+import torch
+from PIL import Image
+from skimage import transform as skTrans
+
+from cbct_artifact_reduction.batchprocessing import resize_batch
+from cbct_artifact_reduction.dataprocessing import (
+    filename_without_extension,
+    iter_frame_chunks,
+    save_nifti,
+)
+from cbct_artifact_reduction.frameextraction import (
+    EXTRACTION_ERRORS,
+    append_manifest,
+    is_current,
+    read_manifest,
+    source_signature,
+)
+
+RESIZE_BACKENDS = ("skimage", "torch", "pil")
+
+
+def manifest_path_for(output_dir: str) -> str:
+    """Return the manifest of a resize output directory, next to the directory so that it only holds nifti files."""
+    return os.path.normpath(output_dir) + ".manifest.jsonl"
+
+
+def create_nifti_memmap(
+    nifti_path: str, shape: tuple[int, ...], dtype: np.dtype
+) -> np.memmap:
+    """Create an uncompressed .nii file without affine and memory-map its data for writing.
+
+    The file is the same as nib.save(nib.Nifti1Image(np_array, None), nifti_path) of an array of shape and dtype, but
+    the data can be written piecewise without ever holding the array in memory.
+    """
+    header = nib.nifti1.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_data_offset(352)
+    dtype = header.get_data_dtype()
+    with open(nifti_path, "wb") as f:
+        header.write_to(f)
+        # No header extensions
+        f.write(b"\0" * 4)
+        f.truncate(352 + int(np.prod(shape)) * dtype.itemsize)
+    return np.memmap(
+        nifti_path, dtype=dtype, mode="r+", offset=352, shape=shape, order="F"
+    )
+
+
+def resize_frames(
+    np_array: np.ndarray,
+    new_dimensions: tuple[int, int],
+    backend: str = "skimage",
+    preserve_range: bool = False,
+) -> np.ndarray:
+    """Resize the first two axes of a 2d frame or a chunk of frames of shape (H, W, T).
+
+    Args:
+        np_array (np.ndarray): The frames.
+        new_dimensions (tuple[int, int]): The new height and width.
+        backend (str): One of RESIZE_BACKENDS. "skimage" is skimage.transform.resize in float64 like
+            resize_single_file. "torch" is an antialiased bilinear F.interpolate of all frames at once and "pil" a
+            bilinear PIL resize of every frame, both in float32.
+        preserve_range (bool): Passed on to skimage.transform.resize.
+
+    Returns:
+        np.ndarray: The resized frames, float64 for skimage and float32 otherwise.
+    """
+    assert backend in RESIZE_BACKENDS, f"backend must be one of {RESIZE_BACKENDS}"
+    if backend == "skimage":
+        # Integer frames would be rescaled by skimage, resize_single_file reads them as float64
+        frames = np_array.astype(np.float64, copy=False)
+        return skTrans.resize(frames, new_dimensions, preserve_range=preserve_range)
+
+    frames = np_array.astype(np.float32, copy=False)
+    if frames.ndim == 2:
+        return resize_frames(frames[:, :, None], new_dimensions, backend)[:, :, 0]
+
+    if backend == "torch":
+        # The frames become the channels of a single image
+        tensor = torch.from_numpy(np.ascontiguousarray(frames.transpose(2, 0, 1)))
+        resized = resize_batch(tensor[None], new_dimensions)[0]
+        return resized.numpy().transpose(1, 2, 0)
+
+    height, width = new_dimensions
+    return np.stack(
+        [
+            np.asarray(
+                Image.fromarray(frames[:, :, i], mode="F").resize(
+                    (width, height), Image.Resampling.BILINEAR
+                )
+            )
+            for i in range(frames.shape[2])
+        ],
+        axis=2,
+    )
+
+
+def resize_volume(
+    nifti_path: str,
+    output_paths: dict[tuple[int, int], str],
+    backend: str = "skimage",
+    preserve_range: bool = False,
+    chunk_frames: int = 64,
+    compresslevel: int | None = None,
+):
+    """Resize a nifti file to several resolutions while decoding it only once.
+
+    Volumes are read chunk_frames frames at a time, see iter_frame_chunks, and every chunk is resized to all
+    resolutions and written straight into a memory-mapped uncompressed .nii file per resolution, see
+    create_nifti_memmap. Only one chunk of the source and its resized versions are in memory, .nii.gz outputs are
+    compressed from the .nii file afterwards with save_nifti.
+
+    Args:
+        nifti_path (str): The 2d frame or 3d volume to resize.
+        output_paths (dict[tuple[int, int], str]): The file each resolution is saved to.
+        backend (str): The interpolation backend, see resize_frames.
+        preserve_range (bool): Passed on to skimage.transform.resize.
+        chunk_frames (int): The number of frames that are read and resized at once.
+        compresslevel (int, optional): The gzip level of .nii.gz outputs, see save_nifti.
+    """
+    image = nib.load(nifti_path, keep_file_open=True)
+    if len(image.shape) == 2:
+        num_frames = 1
+        chunks = [(0, np.asanyarray(image.dataobj)[:, :, None])]
+    else:
+        num_frames = image.shape[2]
+        chunks = iter_frame_chunks(image, chunk_frames)
+
+    dtype = np.float64 if backend == "skimage" else np.float32
+    # Written under temporary names, so a crash never leaves a truncated file behind
+    tmp_paths = {
+        resolution: os.path.join(
+            os.path.dirname(output_path),
+            f".{os.getpid()}.{filename_without_extension(os.path.basename(output_path))}.nii",
+        )
+        for resolution, output_path in output_paths.items()
+    }
+    resized = {
+        resolution: create_nifti_memmap(
+            tmp_paths[resolution],
+            (*resolution, num_frames) if len(image.shape) == 3 else resolution,
+            dtype,
+        )
+        for resolution in output_paths
+    }
+    try:
+        for start, chunk in chunks:
+            for resolution, np_array in resized.items():
+                frames = resize_frames(chunk, resolution, backend, preserve_range)
+                if np_array.ndim == 2:
+                    np_array[:, :] = frames[:, :, 0]
+                else:
+                    np_array[:, :, start : start + chunk.shape[2]] = frames
+        for np_array in resized.values():
+            np_array.flush()
+        del resized
+
+        for resolution, output_path in output_paths.items():
+            tmp_path = tmp_paths[resolution]
+            if output_path.endswith(".gz"):
+                compressed_path = f"{tmp_path}.gz"
+                save_nifti(nib.load(tmp_path), compressed_path, compresslevel)
+                os.remove(tmp_path)
+                tmp_path = compressed_path
+            os.replace(tmp_path, output_path)
+    finally:
+        for tmp_path in tmp_paths.values():
+            for path in (tmp_path, f"{tmp_path}.gz"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def resize_task(
+    tasks: list[tuple[str, dict[tuple[int, int], str]]],
+    backend: str,
+    preserve_range: bool,
+    chunk_frames: int,
+    compresslevel: int | None = None,
+) -> tuple[list[tuple[str, list[tuple[int, int]]]], list[tuple[str, str]]]:
+    """Resize a chunk of files in a worker process of resize_all_volumes.
+
+    Returns:
+        tuple: The resized files with their resolutions, and the files that failed with their error.
+    """
+    resized = []
+    failed = []
+    for nifti_path, output_paths in tasks:
+        try:
+            resize_volume(
+                nifti_path,
+                output_paths,
+                backend,
+                preserve_range,
+                chunk_frames,
+                compresslevel,
+            )
+        except EXTRACTION_ERRORS as error:
+            failed.append((nifti_path, repr(error)))
+            continue
+        resized.append((nifti_path, list(output_paths)))
+    return resized, failed
+
+
+def resize_all_volumes(
+    nifti_paths: list[str],
+    output_dirs: dict[tuple[int, int], str],
+    backend: str = "skimage",
+    preserve_range: bool = False,
+    num_workers: int | None = None,
+    files_per_task: int = 1,
+    chunk_frames: int = 64,
+    overwrite: bool = False,
+    verbose: bool = True,
+    extension: str | None = None,
+    compresslevel: int | None = None,
+) -> dict[str, float]:
+    """Resize many nifti files to one or more resolutions in parallel.
+
+    Every file is decoded once and resized to all of its missing resolutions, see resize_volume. Files are handed to
+    the worker processes in chunks of files_per_task, which keeps the overhead low for many small 2d frames. Every
+    resized file is recorded in the manifest of its output directory, see manifest_path_for, and skipped by a rerun as
+    long as the source file, the backend and the extension didn't change.
+
+    Args:
+        nifti_paths (list[str]): The files to resize.
+        output_dirs (dict[tuple[int, int], str]): The directory the files of each resolution are written to, under
+            their original filename or with extension.
+        backend (str): The interpolation backend, one of RESIZE_BACKENDS.
+        preserve_range (bool): Passed on to skimage.transform.resize.
+        num_workers (int, optional): The number of processes. 0 resizes in this process. Defaults to the number of
+            CPUs.
+        files_per_task (int): The number of files per task.
+        chunk_frames (int): The number of frames that are read and resized at once.
+        overwrite (bool): Whether to resize the files in the manifests again.
+        verbose (bool): Whether to print the progress.
+        extension (str, optional): ".nii" or ".nii.gz" for the resized files. Defaults to the extension of each
+            source file.
+        compresslevel (int, optional): The gzip level of .nii.gz files, see save_nifti.
+
+    A file that fails is reported with a warning and left out of the manifests, the other files are still resized and
+    recorded.
+
+    Returns:
+        dict[str, float]: The number of resized, skipped and failed files, the number of written files and the time it
+            took in seconds.
+    """
+    assert backend in RESIZE_BACKENDS, f"backend must be one of {RESIZE_BACKENDS}"
+    assert extension in (None, ".nii", ".nii.gz"), "extension must be .nii or .nii.gz"
+    # Files written with another extension are in the manifest under another format
+    manifest_format = backend if extension is None else f"{backend} {extension}"
+    manifests = {}
+    for resolution, output_dir in output_dirs.items():
+        os.makedirs(output_dir, exist_ok=True)
+        manifests[resolution] = read_manifest(manifest_path_for(output_dir))
+
+    pending = []
+    for nifti_path in nifti_paths:
+        volume_id = filename_without_extension(os.path.basename(nifti_path))
+        filename = (
+            os.path.basename(nifti_path)
+            if extension is None
+            else f"{volume_id}{extension}"
+        )
+        output_paths = {
+            resolution: os.path.join(output_dir, filename)
+            for resolution, output_dir in output_dirs.items()
+            if overwrite
+            or not is_current(
+                manifests[resolution].get(volume_id), nifti_path, manifest_format
+            )
+        }
+        if output_paths:
+            pending.append((nifti_path, output_paths))
+    tasks = [
+        pending[start : start + files_per_task]
+        for start in range(0, len(pending), files_per_task)
+    ]
+
+    if verbose and len(pending) < len(nifti_paths):
+        print(f"Skipping {len(nifti_paths) - len(pending)} files in the manifests")
+
+    start_time = time.perf_counter()
+    resized_files = 0
+    written_files = 0
+    failed_files = 0
+
+    def record(
+        results: tuple[list[tuple[str, list[tuple[int, int]]]], list[tuple[str, str]]],
+    ):
+        nonlocal resized_files, written_files, failed_files
+        resized, failed = results
+        for nifti_path, error in failed:
+            warnings.warn(f"Could not resize {nifti_path}: {error}")
+            failed_files += 1
+        for nifti_path, resolutions in resized:
+            entry = {
+                "volume_id": filename_without_extension(os.path.basename(nifti_path)),
+                "format": manifest_format,
+                **source_signature(nifti_path),
+            }
+            for resolution in resolutions:
+                append_manifest(manifest_path_for(output_dirs[resolution]), entry)
+            resized_files += 1
+            written_files += len(resolutions)
+        if verbose:
+            print(f"Resized file {resized_files + failed_files}/{len(pending)}")
+
+    if num_workers == 0:
+        for task in tasks:
+            record(
+                resize_task(task, backend, preserve_range, chunk_frames, compresslevel)
+            )
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(
+                    resize_task,
+                    task,
+                    backend,
+                    preserve_range,
+                    chunk_frames,
+                    compresslevel,
+                )
+                for task in tasks
+            ]
+            for future in as_completed(futures):
+                record(future.result())
+
+    seconds = time.perf_counter() - start_time
+    if verbose and resized_files:
+        print(f"Resized {resized_files} files in {seconds:.1f}s")
+    return {
+        "files": resized_files,
+        "skipped": len(nifti_paths) - len(pending),
+        "failed": failed_files,
+        "written": written_files,
+        "seconds": seconds,
+    }
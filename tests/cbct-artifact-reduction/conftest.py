@@ -0,0 +1,47 @@
+import os
+
+import pytest
+import torch as th
+
+from cbct_artifact_reduction.lakefs_own import ObjectNotFoundError
+
+
+class LocalLoader:
+    """Stand-in for CustomBoto3Client that serves files from a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_file(self, object_name):
+        path = os.path.join(self.root, object_name)
+        if not os.path.exists(path):
+            raise ObjectNotFoundError(object_name, f"{object_name} not found")
+        return path
+
+
+class ZeroEpsModel(th.nn.Module):
+    """Predicts zero noise for the first channel and records its inputs."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.weight = th.nn.Parameter(th.zeros(1))
+        self.inputs = []
+
+    @property
+    def shapes(self):
+        return [tuple(x.shape) for x, _ in self.inputs]
+
+    def forward(self, x, t):
+        self.inputs.append((x.clone(), t.clone()))
+        return th.zeros_like(x[:, 0:1]) * self.weight
+
+
+@pytest.fixture
+def local_loader(tmp_path):
+    """A LocalLoader that serves the files in tmp_path."""
+    return LocalLoader(tmp_path)
+
+
+@pytest.fixture
+def zero_eps_model():
+    return ZeroEpsModel()
@@ -0,0 +1,84 @@
+import numpy as np
+import torch as th
+
+import cbct_artifact_reduction.dataprocessing as dp
+import cbct_artifact_reduction.batchprocessing as bp
+from cbct_artifact_reduction.batchprocessing import (
+    BatchPreprocessor,
+    batch_quantiles,
+    resize_batch,
+)
+from cbct_artifact_reduction.sliceindex import FOVS, SCANNERS, UNKNOWN_CODE
+
+
+def test_batch_preprocessor_matches_per_sample_processing():
+    batch = np.random.default_rng(0).random((4, 1, 16, 16)) * 1000 + 1
+    expected = [dp.min_max_normalize(dp.remove_outliers(sample)) for sample in batch]
+
+    result = BatchPreprocessor()(th.from_numpy(batch))
+    assert result.shape == (4, 1, 16, 16)
+    assert result.dtype == th.float32
+    assert np.allclose(result.numpy(), np.stack(expected), atol=1e-5)
+
+
+def test_batch_preprocessor_scanner_transform():
+    batch = np.random.default_rng(0).random((3, 1, 16, 16)) * 1000 + 1
+    scanners = [("planmeca", "large"), ("axeos", "small"), ("x800", "small")]
+    expected = []
+    for sample, (scanner, fov) in zip(batch, scanners):
+        scale = dp.scanner_log_scale(scanner, fov)
+        if scale is not None:
+            sample = -np.log(sample / scale)
+        expected.append(dp.min_max_normalize(dp.remove_outliers(sample)))
+
+    scanner_codes = th.tensor([SCANNERS.index(scanner) for scanner, _ in scanners])
+    fov_codes = th.tensor([FOVS.index(fov) for _, fov in scanners])
+    preprocessor = BatchPreprocessor(scanner_processing=True, dtype=th.float64)
+    result = preprocessor(th.from_numpy(batch), scanner_codes, fov_codes)
+    assert np.allclose(result.numpy(), np.stack(expected))
+
+    # Samples with an unknown scanner are not transformed
+    unknown = th.tensor([UNKNOWN_CODE] * 3)
+    result = preprocessor(th.from_numpy(batch), unknown, fov_codes)
+    assert np.allclose(result[2].numpy(), expected[2])
+    assert np.allclose(
+        result[0].numpy(), dp.min_max_normalize(dp.remove_outliers(batch[0]))
+    )
+
+
+def test_batch_preprocessor_above_the_quantile_limit():
+    batch = th.rand(64, 1, 512, 512)
+    batch[:, :, 0, 0] = 10
+    result = BatchPreprocessor()(batch)
+    assert result.shape == batch.shape
+    assert float(result.min()) == 0 and float(result.max()) == 1
+    assert (result[:, :, 0, 0] == 1).all()
+
+
+def test_batch_quantiles_match_torch_quantile(monkeypatch):
+    x = th.rand(7, 100, dtype=th.float64)
+    quantiles = th.tensor([0.001, 0.5, 0.999], dtype=th.float64)
+    expected = th.quantile(x, quantiles, dim=1, keepdim=True)
+
+    # Chunks of 2 rows
+    monkeypatch.setattr(bp, "QUANTILE_MAX_ELEMENTS", 250)
+    assert th.allclose(batch_quantiles(x, quantiles), expected)
+    # Rows above the limit
+    monkeypatch.setattr(bp, "QUANTILE_MAX_ELEMENTS", 50)
+    assert th.allclose(batch_quantiles(x, quantiles), expected)
+
+
+def test_resize_batch():
+    batch = th.rand(2, 1, 16, 16)
+    assert resize_batch(batch, 16) is batch
+    assert resize_batch(batch, (8, 12)).shape == (2, 1, 8, 12)
+    assert resize_batch(batch, 32).shape == (2, 1, 32, 32)
+
+    # Constant images stay constant and the range of the batch is kept
+    assert th.allclose(resize_batch(th.full((1, 1, 16, 16), 0.5), 5), th.tensor(0.5))
+    downsampled = resize_batch(batch, 5)
+    assert downsampled.min() >= batch.min() and downsampled.max() <= batch.max()
+
+    normalized = BatchPreprocessor(resolution=8)(batch)
+    assert normalized.shape == (2, 1, 8, 8)
+    assert th.allclose(normalized, resize_batch(BatchPreprocessor()(batch), 8))
@@ -109,3 +109,61 @@ def test_numpy_to_nifti(tmp_path):
 def test_min_max_normalize():
     data = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
     assert (dp.min_max_normalize(data) == np.array([0.0, 0.25, 0.5, 0.75, 1.0])).all()
+
+
+def test_nifti_bytes_to_numpy():
+    nifti_path = os.path.join(ROOT_DIR, "sample_data", "80_0.nii.gz")
+    with open(nifti_path, "rb") as f:
+        data = f.read()
+    assert np.array_equal(
+        dp.nifti_bytes_to_numpy(data), single_nifti_to_numpy(nifti_path)
+    )
+
+
+def test_clip_and_scale():
+    img = np.random.default_rng(0).normal(size=(32, 32))
+    lower, upper = np.quantile(img, 0.001), np.quantile(img, 0.999)
+    expected = dp.min_max_normalize(dp.remove_outliers(img))
+    assert np.allclose(dp.clip_and_scale(img, lower, upper), expected)
+    assert dp.clip_and_scale(img.astype(np.float32), lower, upper).dtype == np.float32
+
+
+def test_single_nifti_to_numpy_dtype(tmp_path):
+    numpy_data = np.random.default_rng(0).random((8, 8)).astype(np.float32)
+    nib.save(nib.Nifti1Image(numpy_data, np.eye(4)), tmp_path / "slice.nii")
+    nib.save(nib.Nifti1Image(numpy_data, np.eye(4)), tmp_path / "slice.nii.gz")
+
+    # Uncompressed float32 data is memory-mapped instead of copied
+    np_array = dp.single_nifti_to_numpy(tmp_path / "slice.nii", dtype=np.float32)
+    assert isinstance(np_array, np.memmap)
+    assert np.array_equal(np_array, numpy_data)
+
+    np_array = dp.single_nifti_to_numpy(tmp_path / "slice.nii.gz", dtype=np.float16)
+    assert np_array.dtype == np.float16
+    assert np.allclose(np_array, numpy_data, atol=1e-3)
+    assert dp.single_nifti_to_numpy(tmp_path / "slice.nii.gz").dtype == np.float64
+
+
+@pytest.mark.parametrize("compresslevel", [None, 0, 9])
+def test_save_nifti_compression(tmp_path, compresslevel):
+    np_array = np.random.default_rng(0).random((16, 16, 3)).astype(np.float32)
+    dp.numpy_to_nifti(np_array, tmp_path / "test.nii.gz", compresslevel)
+    with open(tmp_path / "test.nii.gz", "rb") as f:
+        assert f.read(2) == b"\x1f\x8b"
+    assert np.array_equal(
+        dp.single_nifti_to_numpy(tmp_path / "test.nii.gz", np.float32), np_array
+    )
+
+    dp.numpy_to_nifti(np_array, tmp_path / "test.nii", compresslevel)
+    np_array = dp.single_nifti_to_numpy(tmp_path / "test.nii", np.float32)
+    assert isinstance(np_array, np.memmap)
+
+
+def test_nifti_vol_to_frames_uncompressed(tmp_path):
+    numpy_data = np.random.rand(10, 10, 3)
+    nib.save(nib.Nifti1Image(numpy_data, np.eye(4)), tmp_path / "test.nii.gz")
+    nifti_vol_to_frames(tmp_path / "test.nii.gz", tmp_path, extension=".nii")
+    for i in range(3):
+        assert np.array_equal(
+            single_nifti_to_numpy(tmp_path / f"test_{i}.nii"), numpy_data[:, :, i]
+        )
@@ -0,0 +1,92 @@
+import pytest
+import torch as th
+
+from cbct_artifact_reduction.guided_diffusion.script_util import (
+    create_gaussian_diffusion,
+)
+
+
+@pytest.mark.parametrize("eta", [0.0, 1.0])
+def test_ddim_sample_loop_inpainting(eta, zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim10")
+    model = zero_eps_model
+    masked_image = th.rand(2, 1, 8, 8)
+    mask = (th.rand(2, 1, 8, 8) > 0.5).float()
+
+    sample, x_noisy = diffusion.ddim_sample_loop_inpainting(
+        model, masked_image, mask, clip_denoised=False, eta=eta
+    )
+    assert sample.shape == (2, 1, 8, 8)
+    assert x_noisy.shape == (2, 3, 8, 8)
+    assert len(model.inputs) == 10
+
+    # Every step sees the conditioning and the original timesteps of the spaced diffusion
+    for x, _ in model.inputs:
+        assert th.equal(x[:, 1:2], masked_image)
+        assert th.equal(x[:, 2:3], mask)
+    assert [int(t[0]) for _, t in model.inputs] == list(range(90, -1, -10))
+
+    if eta == 0.0:
+        # With zero noise predictions, deterministic DDIM ends at x_0 = x_T / sqrt(alpha_bar_T)
+        scale = 1 / th.sqrt(th.tensor(diffusion.alphas_cumprod[-1]))
+        assert th.allclose(sample, x_noisy[:, 0:1] * scale.float(), rtol=1e-4)
+
+
+@pytest.mark.parametrize("use_ddim", [False, True])
+def test_in_place_sampling_matches_concatenation(use_ddim, zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim10")
+    sample_fn = (
+        diffusion.ddim_sample_loop_inpainting
+        if use_ddim
+        else diffusion.p_sample_loop_inpainting
+    )
+    masked_image = th.rand(2, 1, 8, 8)
+    mask = (th.rand(2, 1, 8, 8) > 0.5).float()
+
+    samples = []
+    for in_place in [False, True]:
+        th.manual_seed(0)
+        sample, x_noisy = sample_fn(
+            zero_eps_model,
+            masked_image,
+            mask,
+            clip_denoised=False,
+            in_place=in_place,
+        )
+        samples.append((sample, x_noisy.clone()))
+        # The initial input is returned as it was
+        assert th.equal(x_noisy[:, 1:2], masked_image)
+
+    assert th.allclose(samples[0][0], samples[1][0])
+    assert th.equal(samples[0][1], samples[1][1])
+
+
+def test_replace_known_and_resampling(zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="10")
+    model = zero_eps_model
+    masked_image = th.rand(2, 1, 8, 8)
+    mask = (th.rand(2, 1, 8, 8) > 0.5).float()
+    masked_image = masked_image * (1 - mask)
+
+    steps = list(
+        diffusion.p_sample_loop_progressive_inpainting(
+            model,
+            masked_image.shape,
+            noise=th.cat((th.randn_like(masked_image), masked_image, mask), dim=1),
+            clip_denoised=False,
+            in_place=True,
+            replace_known=True,
+            resample_steps=3,
+        )
+    )
+
+    # One sample per step, every step but the last one is sampled 3 times
+    assert len(steps) == 10
+    assert len(model.inputs) == 9 * 3 + 1
+    assert th.equal(steps[-1]["sample"] * (1 - mask), masked_image)
+    with pytest.raises(AssertionError):
+        next(
+            diffusion.p_sample_loop_progressive_inpainting(
+                model, masked_image.shape, resample_steps=2
+            )
+        )
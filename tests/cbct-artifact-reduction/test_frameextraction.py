@@ -0,0 +1,126 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import cbct_artifact_reduction.frameextraction as fe
+from cbct_artifact_reduction.dataprocessing import NiftiDataFolder
+from cbct_artifact_reduction.sliceshard import ShardSliceDataset
+
+
+@pytest.fixture
+def volumes(tmp_path):
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / "volumes")
+    volumes = {}
+    for volume_id, num_frames in [(12, 5), (3, 7)]:
+        numpy_data = rng.random((6, 4, num_frames)).astype(np.float32)
+        nib.save(
+            nib.Nifti1Image(numpy_data, np.eye(4)),
+            tmp_path / "volumes" / f"{volume_id}.nii.gz",
+        )
+        volumes[volume_id] = numpy_data
+    return tmp_path, volumes
+
+
+def volume_paths(tmp_path):
+    return sorted(str(path) for path in (tmp_path / "volumes").iterdir())
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_extract_all_frames_nifti(volumes, num_workers):
+    tmp_path, numpy_data = volumes
+    stats = fe.extract_all_frames(
+        volume_paths(tmp_path),
+        fe.NiftiFrameWriter(str(tmp_path / "frames")),
+        num_workers=num_workers,
+        chunk_frames=2,
+        verbose=False,
+    )
+    assert stats["volumes"] == 2 and stats["frames"] == 12
+    for volume_id, volume in numpy_data.items():
+        for frame in range(volume.shape[2]):
+            nifti = nib.load(tmp_path / "frames" / f"{volume_id}_{frame}.nii.gz")
+            assert np.array_equal(nifti.get_fdata(), volume[:, :, frame])
+
+
+def test_extract_all_frames_resumes_from_manifest(volumes):
+    tmp_path, numpy_data = volumes
+    writer = fe.NpyFrameWriter(str(tmp_path / "npy"))
+    fe.extract_all_frames(volume_paths(tmp_path), writer, num_workers=0, verbose=False)
+    for volume_id, volume in numpy_data.items():
+        np_array = np.load(tmp_path / "npy" / f"{volume_id}.npy", mmap_mode="r")
+        assert np_array.flags.f_contiguous
+        assert np.array_equal(np_array, volume)
+
+    stats = fe.extract_all_frames(
+        volume_paths(tmp_path), writer, num_workers=0, verbose=False
+    )
+    assert stats["volumes"] == 0 and stats["skipped"] == 2
+
+    # A changed source file is extracted again
+    nib.save(
+        nib.Nifti1Image(np.zeros((6, 4, 2), dtype=np.float32), np.eye(4)),
+        tmp_path / "volumes" / "3.nii.gz",
+    )
+    stats = fe.extract_all_frames(
+        volume_paths(tmp_path), writer, num_workers=0, verbose=False
+    )
+    assert stats["volumes"] == 1 and stats["frames"] == 2
+    assert np.load(tmp_path / "npy" / "3.npy").shape == (6, 4, 2)
+
+    # A line cut off by a crash is ignored
+    with open(tmp_path / "npy" / fe.MANIFEST_FILENAME, "a") as f:
+        f.write('{"volume_id": "12", "for')
+    assert set(fe.read_manifest(str(tmp_path / "npy" / fe.MANIFEST_FILENAME))) == {
+        "3",
+        "12",
+    }
+
+    # The next entry after a cut off line is not lost
+    fe.append_manifest(
+        str(tmp_path / "npy" / fe.MANIFEST_FILENAME), {"volume_id": "7", "frames": 1}
+    )
+    assert "7" in fe.read_manifest(str(tmp_path / "npy" / fe.MANIFEST_FILENAME))
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_extract_all_frames_records_volumes_next_to_a_failure(volumes, num_workers):
+    tmp_path, _ = volumes
+    with open(tmp_path / "volumes" / "5.nii.gz", "wb") as f:
+        f.write(b"not a volume")
+    writer = fe.NpyFrameWriter(str(tmp_path / "npy"))
+    with pytest.warns(UserWarning, match="5.nii.gz"):
+        stats = fe.extract_all_frames(
+            volume_paths(tmp_path), writer, num_workers=num_workers, verbose=False
+        )
+    assert stats["volumes"] == 2 and stats["failed"] == 1
+    assert set(fe.read_manifest(str(tmp_path / "npy" / fe.MANIFEST_FILENAME))) == {
+        "3",
+        "12",
+    }
+
+
+def test_extract_all_frames_shards(volumes, local_loader):
+    tmp_path, numpy_data = volumes
+    NiftiDataFolder(str(tmp_path / "volumes")).split_all_volumes_into_frames(
+        str(tmp_path / "shards"), output_format="shards", num_workers=2
+    )
+    dataset = ShardSliceDataset(
+        local_loader, "shards", random_masks=False, return_info=True
+    )
+    assert len(dataset) == 12
+    assert list(dataset.dataset.volume_ids) == [3] * 7 + [12] * 5
+    assert np.array_equal(dataset.load_slice(8)[0], numpy_data[12][:, :, 1])
+
+
+def test_split_all_volumes_into_uncompressed_frames(volumes):
+    tmp_path, numpy_data = volumes
+    NiftiDataFolder(str(tmp_path / "volumes")).split_all_volumes_into_frames(
+        str(tmp_path / "frames"), num_workers=0, extension=".nii"
+    )
+    assert np.array_equal(
+        nib.load(tmp_path / "frames" / "12_1.nii").get_fdata(),
+        numpy_data[12][:, :, 1],
+    )
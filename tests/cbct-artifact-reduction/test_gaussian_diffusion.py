@@ -0,0 +1,64 @@
+import pytest
+import torch as th
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from cbct_artifact_reduction.guided_diffusion.gaussian_diffusion import (
+    SCHEDULE_ARRAYS,
+    _extract_into_tensor,
+)
+from cbct_artifact_reduction.guided_diffusion.script_util import (
+    create_gaussian_diffusion,
+)
+
+
+class Float64OpRecorder(TorchDispatchMode):
+    """Records the aten ops that get a float64 tensor, like the numpy schedule arrays."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.ops = []
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        inputs = tree_flatten((args, kwargs or {}))[0]
+        if any(isinstance(x, th.Tensor) and x.dtype == th.float64 for x in inputs):
+            self.ops.append(func)
+        return func(*args, **(kwargs or {}))
+
+
+@pytest.mark.parametrize("learn_sigma", [False, True])
+def test_extract_matches_extract_into_tensor(learn_sigma):
+    diffusion = create_gaussian_diffusion(
+        steps=100, learn_sigma=learn_sigma, timestep_respacing="25"
+    )
+    t = th.tensor([0, 3, 24, 11])
+
+    for name in SCHEDULE_ARRAYS:
+        expected = _extract_into_tensor(getattr(diffusion, name), t, (4, 1, 2, 2))
+        assert th.equal(diffusion._extract(name, t, (4, 1, 2, 2)), expected), name
+
+    betas, alphas_cumprod = diffusion._extract(
+        ("betas", "alphas_cumprod"), t, (4, 1, 2, 2)
+    )
+    assert betas.shape == alphas_cumprod.shape == (4, 1, 2, 2)
+    assert betas.dtype == th.float32
+
+
+def test_sampling_doesnt_touch_the_numpy_schedule(zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="10")
+    model = zero_eps_model
+    masked_image = th.rand(2, 1, 8, 8)
+    mask = (th.rand(2, 1, 8, 8) > 0.5).float()
+
+    # The first run converts the schedule to the table of the device
+    diffusion.p_sample_loop_inpainting(model, masked_image, mask)
+    recorder = Float64OpRecorder()
+    with recorder:
+        diffusion.p_sample_loop_inpainting(
+            model, masked_image, mask, replace_known=True, resample_steps=2
+        )
+        diffusion.ddim_sample_loop_inpainting(model, masked_image, mask)
+
+    assert recorder.ops == []
+    assert list(diffusion._schedule_tables) == [th.device("cpu")]
+    assert len(diffusion._timestep_map_tensors) == 1
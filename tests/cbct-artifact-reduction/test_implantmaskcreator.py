@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import cbct_artifact_reduction.implantmaskcreator as imc
+
+
+@pytest.mark.parametrize(
+    "height, width, angle, x, y",
+    [(128, 16, 0, 100, 128), (120, 12, 23, 5, 127), (135, 20, -41, 250, 128)],
+)
+def test_rasterize_implants_matches_generate_mask(
+    monkeypatch, height, width, angle, x, y
+):
+    monkeypatch.setattr(imc, "generateRandomHeight", lambda *args, **kwargs: height)
+    monkeypatch.setattr(imc, "generateRandomWidth", lambda *args, **kwargs: width)
+    monkeypatch.setattr(imc, "generateRotationAngle", lambda *args, **kwargs: angle)
+    monkeypatch.setattr(imc, "generateCoordinates", lambda *args, **kwargs: (x, y))
+
+    expected = imc.ImplantMaskCreator((256, 256)).generate_mask()
+    rasterized = imc.rasterize_implants(
+        (256, 256),
+        np.array([height]),
+        np.array([width]),
+        np.array([angle]),
+        np.array([x]),
+        np.array([y]),
+    )
+    assert np.array_equal(rasterized[0], expected.astype(bool))
+
+
+@pytest.mark.parametrize(
+    "height, width, angle, x, y",
+    [(123, 13, -30, 23, 128), (101, 7, 60, 185, 37), (128, 1, 45, 82, 127)],
+)
+def test_rasterize_implants_differs_only_on_the_edge(
+    monkeypatch, height, width, angle, x, y
+):
+    monkeypatch.setattr(imc, "generateRandomHeight", lambda *args, **kwargs: height)
+    monkeypatch.setattr(imc, "generateRandomWidth", lambda *args, **kwargs: width)
+    monkeypatch.setattr(imc, "generateRotationAngle", lambda *args, **kwargs: angle)
+    monkeypatch.setattr(imc, "generateCoordinates", lambda *args, **kwargs: (x, y))
+
+    expected = imc.ImplantMaskCreator((256, 256)).generate_mask().astype(bool)
+    rasterized = imc.rasterize_implants(
+        (256, 256),
+        np.array([height]),
+        np.array([width]),
+        np.array([angle]),
+        np.array([x]),
+        np.array([y]),
+    )[0]
+    extra = rasterized & ~expected
+    assert not (expected & ~rasterized).any()
+    assert extra.any()
+    assert not (extra & ndimage.binary_erosion(rasterized, border_value=1)).any()
+
+
+def test_generate_batch_matches_distribution():
+    creator = imc.ImplantMaskCreator((64, 64))
+    masks = creator.generate_batch(400, 1, 4, rng=0)
+    assert masks.shape == (400, 64, 64)
+    assert masks.dtype == bool
+
+    np.random.seed(0)
+    reference = np.stack(
+        [creator.generate_mask_with_random_amount_of_implants(1, 4) for _ in range(400)]
+    )
+    assert masks.mean() == pytest.approx(reference.mean(), rel=0.1)
+    assert masks.mean(axis=(0, 1)) == pytest.approx(
+        reference.mean(axis=(0, 1)), abs=0.05
+    )
+    assert np.array_equal(masks, creator.generate_batch(400, 1, 4, rng=0))
+
+
+def test_generate_batch_without_implants():
+    masks = imc.ImplantMaskCreator((32, 32)).generate_batch(20, 0, 2, rng=1)
+    assert masks.shape == (20, 32, 32)
+    empty = ~masks.any(axis=(1, 2))
+    assert empty.any() and not empty.all()
@@ -1,8 +1,14 @@
-import hashlib
+import io
 import os
+import pickle
 
+import boto3
 import cbct_artifact_reduction.config as cfg
 import cbct_artifact_reduction.lakefs_own as lakefs_own
+import moto
+import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
 
 
 def test_lakefs_connection():
@@ -20,12 +26,7 @@ def testCustomBoto3ClientListFolder():
 def testCustomBoto3ClientGetFileNoCache(tmp_path):
     client = lakefs_own.CustomBoto3Client(f"{cfg.LAKEFS_DATA_REPOSITORY}")
     client.cache_path = tmp_path
-    local_name = (
-        hashlib.md5(
-            "processed_data/frames/256x256/100_0.nii.gz".encode("utf-8")
-        ).hexdigest()
-        + ".nii.gz"
-    )
+    local_name = client.local_filename("processed_data/frames/256x256/100_0.nii.gz")
     client.get_file("processed_data/frames/256x256/100_0.nii.gz")
 
     assert os.path.exists(tmp_path / local_name)
@@ -33,19 +34,14 @@ def testCustomBoto3ClientGetFileNoCache(tmp_path):
 
 
 def testCustomBoto3ClientGetFileFromCache(tmp_path):
-    filename = (
-        hashlib.md5(
-            "processed_data/frames/256x256/100_0.nii.gz".encode("utf-8")
-        ).hexdigest()
-        + ".nii.gz"
-    )
+    client = lakefs_own.CustomBoto3Client(f"{cfg.LAKEFS_DATA_REPOSITORY}")
+    client.cache_path = tmp_path
+
+    filename = client.local_filename("processed_data/frames/256x256/100_0.nii.gz")
     with open(tmp_path / filename, "w") as f:
         f.write("test")
         f.close()
 
-    client = lakefs_own.CustomBoto3Client(f"{cfg.LAKEFS_DATA_REPOSITORY}")
-    client.cache_path = tmp_path
-
     local_path = client.get_file("processed_data/frames/256x256/100_0.nii.gz")
 
     assert os.path.join(tmp_path, filename) == local_path
@@ -59,6 +55,223 @@ def test_lakefs_caching():
     pass
 
 
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    """A local S3 stand-in with a bucket containing three slices."""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(cfg, "LAKEFS_HOST", None)
+    monkeypatch.setattr(cfg, "LAKEFS_USERNAME", None)
+    monkeypatch.setattr(cfg, "LAKEFS_PASSWORD", None)
+    monkeypatch.setattr(cfg, "LAKEFS_SSL_CA_CERT", None)
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="test-repo")
+        for frame in range(3):
+            s3.put_object(
+                Bucket="test-repo",
+                Key=f"processed_data/frames/10_{frame}.nii.gz",
+                Body=b"x" * 100,
+            )
+        yield "test-repo"
+
+
+def testCustomBoto3ClientPrefetch(s3_bucket, tmp_path):
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+    object_names = [f"processed_data/frames/10_{frame}.nii.gz" for frame in range(3)]
+
+    result = client.prefetch(object_names[:1], show_progress=False)
+    assert result["downloaded"] == 1
+
+    result = client.prefetch(
+        object_names + ["processed_data/frames/missing.nii.gz"], show_progress=False
+    )
+    assert result["requested"] == 4
+    assert result["cached"] == 1
+    assert result["downloaded"] == 2
+    assert result["failed_object_names"] == ["processed_data/frames/missing.nii.gz"]
+    assert result["bytes"] == 200
+    for object_name in object_names:
+        assert client.is_cached(object_name)
+    assert client.cache.entries()[0].stat().st_size == 100
+
+
+def testCustomBoto3ClientPrefetchSpecification(s3_bucket, tmp_path):
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path / "cache"
+    (tmp_path / "spec.csv").write_text("slice\n10_0.nii.gz\n10_2.nii.gz\n")
+
+    result = client.prefetch_specification(
+        tmp_path / "spec.csv", "processed_data/frames", show_progress=False
+    )
+    assert result["downloaded"] == 2
+    assert client.is_cached("processed_data/frames/10_2.nii.gz")
+    assert not client.is_cached("processed_data/frames/10_1.nii.gz")
+
+    result = client.prefetch_prefix("processed_data/frames/", show_progress=False)
+    assert result["requested"] == 3
+    assert result["downloaded"] == 1
+
+
+def testCustomBoto3ClientGetFileRaisesTypedErrors(s3_bucket, tmp_path):
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+
+    with pytest.raises(lakefs_own.ObjectNotFoundError) as e:
+        client.get_file("processed_data/frames/missing.nii.gz")
+    assert e.value.object_name == "processed_data/frames/missing.nii.gz"
+    assert client.cache.entries() == []
+
+
+def testCustomBoto3ClientIsCreatedPerProcess(s3_bucket, tmp_path):
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+    s3 = client.client
+    assert client.client is s3
+    assert s3.meta.config.retries["mode"] == "adaptive"
+
+    # Simulate a forked DataLoader worker
+    client._client_pid = -1
+    assert client.client is not s3
+
+    unpickled = pickle.loads(pickle.dumps(client))
+    assert unpickled._client is None
+    assert unpickled.get_file("processed_data/frames/10_0.nii.gz") is not None
+    assert unpickled.latency_stats()["count"] == 1
+
+
+def testTranslateError():
+    def client_error(code):
+        return ClientError({"Error": {"Code": code}}, "GetObject")
+
+    assert isinstance(
+        lakefs_own.translate_error(client_error("SlowDown"), "a"),
+        lakefs_own.ThrottlingError,
+    )
+    assert isinstance(
+        lakefs_own.translate_error(client_error("NoSuchKey"), "a"),
+        lakefs_own.ObjectNotFoundError,
+    )
+    assert isinstance(
+        lakefs_own.translate_error(client_error("AccessDenied"), "a"),
+        lakefs_own.DownloadError,
+    )
+
+
+def testLatencyHistogram():
+    histogram = lakefs_own.LatencyHistogram()
+    for seconds in [0.0005, 0.003, 0.003, 0.003, 0.2]:
+        histogram.record(seconds)
+    summary = histogram.summary()
+    assert summary["count"] == 5
+    assert summary["p50_ms"] == 5
+    assert summary["p99_ms"] == 200
+    assert summary["buckets"]["<=1ms"] == 1
+
+
+def testCustomBoto3ClientGetBytes(s3_bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "MEMORY_CACHE_MAX_BYTES", 150)
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+
+    assert client.get_bytes("processed_data/frames/10_0.nii.gz") == b"x" * 100
+    assert client.get_bytes("processed_data/frames/10_0.nii.gz") == b"x" * 100
+    assert client.cache.entries() == []
+    assert client.latency_stats()["count"] == 1
+    assert client.memory_cache_stats()["hits"] == 1
+
+    # Only one 100 byte object fits into the in-memory cache
+    client.get_bytes("processed_data/frames/10_1.nii.gz")
+    assert client.memory_cache_stats()["evictions"] == 1
+    assert client.memory_cache_stats()["bytes"] == 100
+
+
+def testCustomBoto3ClientGetBytesTouchesDiskEntries(s3_bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "MEMORY_CACHE_MAX_BYTES", None)
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+    path = client.get_file("processed_data/frames/10_0.nii.gz")
+    os.utime(path, (0, 0))
+
+    assert client.get_bytes("processed_data/frames/10_0.nii.gz") == b"x" * 100
+    assert os.stat(path).st_mtime > 0
+    assert client.cache_stats()["hits"] == 1
+
+
+def testCustomBoto3ClientCacheIsKeyedByCommit(s3_bucket, tmp_path):
+    object_name = "processed_data/frames/10_0.nii.gz"
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+    client.branch = "commit_a"
+    path_a = client.get_file(object_name)
+
+    # The object did not change, the entry of the new commit is linked to the same content
+    client.branch = "commit_b"
+    assert not client.is_cached(object_name)
+    path_b = client.get_file(object_name)
+    assert path_a != path_b
+    assert os.path.samefile(path_a, path_b)
+    assert client.latency_stats()["count"] == 1
+    assert client.cache_stats()["deduplicated"] == 1
+
+    # A changed object is downloaded again for the new commit only
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key=object_name, Body=b"y" * 100)
+    client.branch = "commit_c"
+    path_c = client.get_file(object_name)
+    with open(path_c, "rb") as f:
+        assert f.read() == b"y" * 100
+    with open(path_a, "rb") as f:
+        assert f.read() == b"x" * 100
+    assert client.latency_stats()["count"] == 2
+    assert len(client.content_cache.entries()) == 2
+
+
+def testCustomBoto3ClientMissIsASingleGet(s3_bucket, tmp_path):
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+    operations = []
+    client.client.meta.events.register(
+        "before-call.s3", lambda model, **kwargs: operations.append(model.name)
+    )
+
+    client.get_file("processed_data/frames/10_0.nii.gz")
+    assert operations == ["GetObject"]
+
+    # The unchanged object of another commit is linked after reading the ETag of the GET, without the body
+    client.branch = "commit_b"
+    client.get_file("processed_data/frames/10_0.nii.gz")
+    assert operations == ["GetObject"] * 2
+    assert client.cache_stats()["deduplicated"] == 1
+    assert client.latency_stats()["count"] == 1
+
+
+def testCustomBoto3ClientRejectsCorruptedBody(s3_bucket, tmp_path, monkeypatch):
+    client = lakefs_own.CustomBoto3Client(s3_bucket)
+    client.cache_path = tmp_path
+    s3 = client.client
+    get_object = s3.get_object
+
+    def truncated_get_object(**kwargs):
+        response = get_object(**kwargs)
+        response["Body"] = StreamingBody(io.BytesIO(b"x" * 50), 50)
+        return response
+
+    monkeypatch.setattr(s3, "get_object", truncated_get_object)
+    with pytest.raises(lakefs_own.DownloadError, match="does not match ETag"):
+        client.get_file("processed_data/frames/10_0.nii.gz")
+    assert not client.is_cached("processed_data/frames/10_0.nii.gz")
+    assert client.content_cache.entries() == []
+    assert not any(
+        name.endswith(".tmp") for _, _, names in os.walk(tmp_path) for name in names
+    )
+
+    monkeypatch.undo()
+    with open(client.get_file("processed_data/frames/10_0.nii.gz"), "rb") as f:
+        assert f.read() == b"x" * 100
+
+
 if __name__ == "__main__":
     test_lakefs_connection()
     testCustomBoto3ClientListFolder()
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+import pytest
+
+from cbct_artifact_reduction.localcache import LocalFileCache, MemoryCache
+
+
+def write(content):
+    def fetch(tmp_path):
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+
+    return fetch
+
+
+def test_get_fetches_only_on_miss(tmp_path):
+    cache = LocalFileCache(tmp_path)
+    calls = []
+
+    def fetch(tmp_path):
+        calls.append(tmp_path)
+        write(b"data")(tmp_path)
+
+    path = cache.get("a.nii.gz", fetch)
+    assert path == os.path.join(tmp_path, "a.nii.gz")
+    assert cache.get("a.nii.gz", fetch) == path
+    assert len(calls) == 1
+    assert calls[0] != path
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "evicted_bytes": 0}
+
+
+def test_failed_fetch_leaves_no_file(tmp_path):
+    cache = LocalFileCache(tmp_path)
+
+    def fetch(tmp_path):
+        write(b"partial")(tmp_path)
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        cache.get("a.nii.gz", fetch)
+    assert cache.entries() == []
+
+
+def test_concurrent_misses_fetch_once(tmp_path):
+    cache = LocalFileCache(tmp_path)
+    calls = []
+
+    def fetch(tmp_path):
+        calls.append(tmp_path)
+        time.sleep(0.1)
+        write(b"data")(tmp_path)
+
+    threads = [
+        threading.Thread(target=cache.get, args=("a.nii.gz", fetch)) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert cache.stats()["hits"] == 3
+
+
+def test_lru_eviction(tmp_path):
+    cache = LocalFileCache(tmp_path, max_bytes=25)
+    cache.get("a", write(b"a" * 10))
+    cache.get("b", write(b"b" * 10))
+    os.utime(tmp_path / "a", (0, 0))
+    os.utime(tmp_path / "b", (1, 1))
+    # Using a makes b the least recently used file
+    cache.get("a", write(b""))
+    cache.get("c", write(b"c" * 10))
+
+    assert sorted(entry.name for entry in cache.entries()) == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["evicted_bytes"] == 10
+    assert cache.size() <= 25
+
+
+def test_eviction_skips_locked_entries(tmp_path):
+    cache = LocalFileCache(tmp_path, max_bytes=25)
+    cache.get("a", write(b"a" * 10))
+    cache.get("b", write(b"b" * 10))
+    os.utime(tmp_path / "a", (0, 0))
+    os.utime(tmp_path / "b", (1, 1))
+    # a is the least recently used file, but another reader holds its lock
+    with cache.lock("a"):
+        cache.get("c", write(b"c" * 10))
+
+    assert sorted(entry.name for entry in cache.entries()) == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_cache_lru():
+    cache = MemoryCache(max_bytes=10)
+    cache.put("a", b"a" * 4)
+    cache.put("b", b"b" * 4)
+    assert cache.get("a") == b"a" * 4
+    cache.put("c", b"c" * 4)
+
+    assert cache.get("b") is None
+    assert cache.get("c") == b"c" * 4
+    cache.put("too_large", b"x" * 11)
+    assert cache.get("too_large") is None
+    assert cache.stats() == {"hits": 2, "misses": 2, "evictions": 1, "bytes": 8}
+
+
+def test_evict_prunes_unlinked_content(tmp_path):
+    content_cache = LocalFileCache(tmp_path / "objects")
+    cache = LocalFileCache(tmp_path, max_bytes=150, content_cache=content_cache)
+
+    for name in ("a", "b"):
+        cache.get(
+            f"{name}.bin",
+            lambda path, name=name: content_cache.get_linked(
+                f"{name}-content", path, write(b"x" * 100)
+            ),
+        )
+    assert [entry.name for entry in cache.entries()] == ["b.bin"]
+    assert [entry.name for entry in content_cache.entries()] == ["b-content"]
+
+
+def test_copied_content_counts_against_the_budget(tmp_path, monkeypatch):
+    def no_hardlinks(src, dst):
+        raise OSError("hardlinks are not supported")
+
+    monkeypatch.setattr(os, "link", no_hardlinks)
+    content_cache = LocalFileCache(tmp_path / "objects")
+    cache = LocalFileCache(tmp_path, max_bytes=250, content_cache=content_cache)
+
+    for name in ("a", "b"):
+        cache.get(
+            f"{name}.bin",
+            lambda path, name=name: content_cache.get_linked(
+                f"{name}-content", path, write(b"x" * 100)
+            ),
+        )
+    # The entries are copies, so the content files would double the size of the cache
+    assert sorted(entry.name for entry in cache.entries()) == ["a.bin", "b.bin"]
+    assert cache.size() + content_cache.size() <= 250
@@ -0,0 +1,39 @@
+import pickle
+
+import numpy as np
+
+from cbct_artifact_reduction.maskbank import MaskBank, bank_index
+
+
+def test_mask_bank_roundtrip(tmp_path):
+    bank = MaskBank.create(10, (16, 20), seed=3, batch_size=4)
+    assert len(bank) == 10
+    assert bank.packed.shape == (10, 16, 3)
+    assert bank[0].shape == (16, 20)
+    assert bank[0].dtype == bool
+
+    bank.save(str(tmp_path / "bank.npz"))
+    loaded = MaskBank.load(str(tmp_path / "bank.npz"))
+    assert isinstance(loaded.packed, np.memmap)
+    assert loaded.resolution == (16, 20)
+    for i in range(len(bank)):
+        assert np.array_equal(loaded[i], bank[i])
+    assert np.array_equal(
+        MaskBank.create(10, (16, 20), seed=3, batch_size=4).packed,
+        np.asarray(bank.packed),
+    )
+
+    unpickled = pickle.loads(pickle.dumps(loaded))
+    assert isinstance(unpickled.packed, np.memmap)
+    assert np.array_equal(
+        unpickled.mask_for("10_3.nii.gz"), bank.mask_for("10_3.nii.gz")
+    )
+
+
+def test_bank_index_is_deterministic():
+    np.random.seed(0)
+    index = bank_index("10_3.nii.gz", 1000)
+    np.random.seed(1)
+    assert bank_index("10_3.nii.gz", 1000) == index
+    assert 0 <= index < 1000
+    assert len({bank_index(f"10_{i}.nii.gz", 1000) for i in range(100)}) > 90
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import torch
+from torch.utils.data import RandomSampler
+
+from cbct_artifact_reduction.readahead import ReadAheadSampler
+
+
+class RecordingLoader:
+    def __init__(self):
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def get_file(self, object_name):
+        time.sleep(0.001)
+        with self.lock:
+            self.fetched.append(object_name)
+        return object_name
+
+
+class FakeDataset:
+    def __init__(self, n):
+        self.n = n
+        self.lakefs_loader = RecordingLoader()
+
+    def __len__(self):
+        return self.n
+
+    def remote_paths(self, idx):
+        # Two slices share one file, like slices in a shard or volume
+        return [f"file_{idx // 2}"]
+
+
+def test_read_ahead_follows_sampler_order():
+    dataset = FakeDataset(20)
+    generator = torch.Generator().manual_seed(0)
+    expected = list(RandomSampler(dataset, generator=generator))
+
+    generator = torch.Generator().manual_seed(0)
+    sampler = ReadAheadSampler(
+        RandomSampler(dataset, generator=generator), dataset, lookahead=4
+    )
+    assert len(sampler) == 20
+
+    consumed = []
+    for idx in sampler:
+        consumed.append(idx)
+        if len(consumed) == 5:
+            assert sampler.stats()["ahead"] == 4
+    assert consumed == expected
+
+    time.sleep(0.1)
+    stats = sampler.stats()
+    assert stats["yielded"] == 20
+    # A file is only fetched once while both of its slices are in the window
+    assert 10 <= stats["submitted"] <= 20
+    assert stats["completed"] == stats["submitted"]
+    assert set(dataset.lakefs_loader.fetched) == {f"file_{i}" for i in range(10)}
+
+
+def test_release_keeps_only_the_window():
+    done, running = Future(), Future()
+    done.set_result(None)
+    in_flight = {"a": done, "b": running, "c": done}
+    window_refs = Counter({"a": 1, "b": 1, "c": 2})
+    released = set()
+
+    ReadAheadSampler._release(["a", "b", "c"], in_flight, window_refs, released)
+    # c is still needed by an index in the window, b is still downloading
+    assert set(in_flight) == {"b", "c"} and released == {"b"}
+
+    running.set_result(None)
+    ReadAheadSampler._release(["c"], in_flight, window_refs, released)
+    assert in_flight == {} and released == set() and not window_refs
@@ -0,0 +1,73 @@
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from cbct_artifact_reduction.implantmaskcreator import ImplantMaskCreator
+from cbct_artifact_reduction.rng import ThreadLocalRNG, worker_init_fn
+
+
+class RandomDataset(Dataset):
+    def __init__(self) -> None:
+        self.rng = ThreadLocalRNG(0)
+
+    def reseed(self, seed):
+        self.rng.reseed(seed)
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, idx):
+        return self.rng.generator.integers(2**31)
+
+
+def draw_in_threads(rng: ThreadLocalRNG, num_threads: int) -> list[int]:
+    draws = [None] * num_threads
+    for i in range(num_threads):
+        # Threads are started one after another, so they spawn their generators in a fixed order
+        thread = threading.Thread(
+            target=lambda i=i: draws.__setitem__(i, rng.generator.integers(2**31))
+        )
+        thread.start()
+        thread.join()
+    return draws
+
+
+def test_thread_local_rng_is_per_thread_and_reproducible():
+    draws = draw_in_threads(ThreadLocalRNG(0), 4)
+    assert len(set(draws)) == 4
+    assert draws == draw_in_threads(ThreadLocalRNG(0), 4)
+    assert draws != draw_in_threads(ThreadLocalRNG(1), 4)
+
+
+def test_worker_init_fn_gives_every_worker_its_own_stream():
+    torch.manual_seed(0)
+    dataloader = DataLoader(
+        RandomDataset(), batch_size=1, num_workers=2, worker_init_fn=worker_init_fn
+    )
+    draws = [int(batch) for batch in dataloader]
+    # Without worker_init_fn both workers would copy the seeded dataset and draw the same values
+    assert len(set(draws)) == 4
+
+    torch.manual_seed(0)
+    assert draws == [int(batch) for batch in dataloader]
+
+
+def test_mask_generation_does_not_touch_global_rng():
+    creator = ImplantMaskCreator((64, 64))
+    np.random.seed(0)
+    state = np.random.get_state()[1].copy()
+    creator.generate_mask_with_random_amount_of_implants(1, 4)
+    creator.generate_mask_with_random_amount_of_implants(1, 4, random_state=3)
+    creator.generate_batch(2, 1, 4, rng=ThreadLocalRNG(0).generator)
+    assert np.array_equal(np.random.get_state()[1], state)
+
+
+def test_integer_seeded_masks_are_reproducible():
+    creator = ImplantMaskCreator((64, 64))
+    mask = creator.generate_mask_with_random_amount_of_implants(1, 4, random_state=7)
+    np.random.seed(123)
+    assert np.array_equal(
+        mask, creator.generate_mask_with_random_amount_of_implants(1, 4, random_state=7)
+    )
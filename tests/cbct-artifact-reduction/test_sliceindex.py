@@ -0,0 +1,74 @@
+import pickle
+import shutil
+
+import numpy as np
+import pytest
+
+import cbct_artifact_reduction.sliceindex as si
+
+
+@pytest.fixture
+def specification(tmp_path):
+    csv_path = tmp_path / "training_data.csv"
+    csv_path.write_text(
+        "slice,mask\n10_0.nii.gz,mask_1.nii.gz\n10_1.nii.gz,mask_2.nii.gz\n300_5.nii.gz,mask_3.nii.gz\n999_2.nii.gz,mask_4.nii.gz\n"
+    )
+    return csv_path
+
+
+def test_parse_slice_filename():
+    assert si.parse_slice_filename("10_1528.nii.gz") == (10, 1528)
+    assert si.parse_slice_filename("frames/256x256/3_4.nii") == (3, 4)
+    with pytest.raises(ValueError):
+        si.parse_slice_filename("mask_3.nii.gz")
+
+
+def test_from_specification(specification):
+    index = si.SliceIndex.from_specification(specification)
+
+    assert len(index) == 4
+    assert index.filename(0) == "10_0.nii.gz"
+    assert index.filename(2, ".nii") == "300_5.nii"
+    assert index.scanner(0) == "axeos"
+    assert index.fov(0) == "small"
+    assert index.scanner(2) == "planmeca"
+    assert index.fov(2) == "large"
+    assert index.scanner(3) is None
+    assert index.scanner_codes.dtype == np.int8
+
+
+def test_sidecar_is_memory_mapped(specification):
+    index = si.SliceIndex.from_specification_cached(specification)
+
+    assert (specification.parent / "training_data.sliceindex.npz").exists()
+    assert isinstance(index.volume_ids, np.memmap)
+
+    loaded = si.SliceIndex.from_specification_cached(specification)
+    for column in ("volume_ids", "frames", "scanner_codes", "fov_codes"):
+        assert np.array_equal(getattr(loaded, column), getattr(index, column))
+
+    unpickled = pickle.loads(pickle.dumps(loaded))
+    assert isinstance(unpickled.frames, np.memmap)
+    assert unpickled.filename(1) == "10_1.nii.gz"
+
+
+def test_sidecar_is_rebuilt_when_the_data_table_changes(specification, tmp_path):
+    datatable_path = tmp_path / "data.csv"
+    shutil.copyfile(si.DATA_CSV_PATH, datatable_path)
+    npz_path = specification.parent / "training_data.sliceindex.npz"
+
+    si.SliceIndex.from_specification_cached(
+        specification, datatable_path=str(datatable_path)
+    )
+    inode = npz_path.stat().st_ino
+    si.SliceIndex.from_specification_cached(
+        specification, datatable_path=str(datatable_path)
+    )
+    assert npz_path.stat().st_ino == inode
+
+    with open(datatable_path, "a") as f:
+        f.write("\n")
+    si.SliceIndex.from_specification_cached(
+        specification, datatable_path=str(datatable_path)
+    )
+    assert npz_path.stat().st_ino != inode
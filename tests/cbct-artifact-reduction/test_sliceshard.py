@@ -0,0 +1,79 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import cbct_artifact_reduction.sliceshard as ss
+
+
+@pytest.fixture
+def slices():
+    rng = np.random.default_rng(0)
+    return [(rng.random((8, 8)), 10, frame) for frame in range(5)]
+
+
+def test_shard_writer(tmp_path, slices):
+    with ss.SliceShardWriter(tmp_path / "shards", shard_size=2) as writer:
+        for np_array, volume_id, frame in slices:
+            writer.add(np_array, volume_id, frame)
+
+    assert sorted(os.listdir(tmp_path / "shards")) == [
+        "index.npz",
+        "shard_00000.npz",
+        "shard_00001.npz",
+        "shard_00002.npz",
+    ]
+    index = np.load(tmp_path / "shards" / "index.npz")
+    assert list(index["shard_offsets"]) == [0, 2, 4, 5]
+    assert list(index["frames"]) == [0, 1, 2, 3, 4]
+
+
+def test_shard_writer_skips_the_index_after_an_error(tmp_path, slices):
+    with ss.SliceShardWriter(tmp_path / "shards", shard_size=2) as writer:
+        for np_array, volume_id, frame in slices:
+            writer.add(np_array, volume_id, frame)
+
+    with (
+        pytest.raises(ValueError),
+        ss.SliceShardWriter(tmp_path / "shards", shard_size=2) as writer,
+    ):
+        for np_array, volume_id, frame in slices:
+            writer.add(np_array, volume_id, frame)
+        raise ValueError()
+
+    assert "index.npz" not in os.listdir(tmp_path / "shards")
+
+
+def test_shard_writer_rejects_different_shapes(tmp_path):
+    writer = ss.SliceShardWriter(tmp_path)
+    writer.add(np.zeros((4, 4)), 1, 0)
+    with pytest.raises(AssertionError):
+        writer.add(np.zeros((4, 5)), 1, 1)
+
+
+def test_shard_writer_rejects_float16_overflow(tmp_path):
+    writer = ss.SliceShardWriter(tmp_path, dtype=np.float16)
+    with pytest.raises(ValueError):
+        writer.add(np.full((4, 4), 1e6), 1, 0)
+
+
+def test_shard_slice_dataset(tmp_path, slices, local_loader):
+    with ss.SliceShardWriter(tmp_path / "shards", shard_size=2) as writer:
+        for np_array, volume_id, frame in slices:
+            writer.add(np_array, volume_id, frame)
+
+    dataset = ss.ShardSliceDataset(
+        local_loader, "shards", random_masks=False, return_info=True
+    )
+    assert len(dataset) == 5
+
+    slice_np_array, _, info = dataset[3]
+    assert slice_np_array.shape == (1, 8, 8)
+    assert info["scanner"] == ["axeos"]
+    expected = dataset.dataprocessing(slices[3][0].astype(np.float32))
+    assert np.allclose(slice_np_array[0], expected)
+
+    unpickled = pickle.loads(pickle.dumps(dataset))
+    assert unpickled._shards == {}
+    assert np.allclose(unpickled[3][0], slice_np_array)
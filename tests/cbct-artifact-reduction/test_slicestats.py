@@ -0,0 +1,100 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from cbct_artifact_reduction.sliceindex import SCANNERS
+from cbct_artifact_reduction.slicestats import (
+    SliceStats,
+    compute_slice_stats,
+    compute_stats,
+    stats_path,
+)
+from cbct_artifact_reduction.volumedataset import VolumeSliceDataset
+
+
+@pytest.fixture
+def stats_dataset(tmp_path, local_loader):
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / "volumes")
+    volumes = {}
+    # Volumes 10 and 11 are axeos scans
+    for volume_id in (10, 11):
+        volumes[volume_id] = (rng.random((6, 7, 4)) * volume_id).astype(np.float32)
+        nib.save(
+            nib.Nifti1Image(volumes[volume_id], np.eye(4)),
+            tmp_path / "volumes" / f"{volume_id}.nii",
+        )
+    (tmp_path / "spec.csv").write_text("slice\n10_0.nii.gz\n11_2.nii.gz\n10_3.nii.gz\n")
+
+    def create(**kwargs):
+        return VolumeSliceDataset(
+            local_loader,
+            str(tmp_path / "spec.csv"),
+            "volumes",
+            volume_extension=".nii",
+            use_index_sidecar=False,
+            **kwargs,
+        )
+
+    return tmp_path, volumes, create
+
+
+def test_compute_and_load_stats(stats_dataset):
+    tmp_path, volumes, create = stats_dataset
+    stats = SliceStats.compute(create(), verbose=False)
+    stats.save(stats_path(str(tmp_path / "spec.csv")))
+    stats = SliceStats.load(str(tmp_path / "spec.slicestats.npz"))
+
+    assert stats.bounds(1) == (
+        np.quantile(volumes[11][:, :, 2], 0.001),
+        np.quantile(volumes[11][:, :, 2], 0.999),
+    )
+    assert stats.slice_stats[2][3] == volumes[10][:, :, 3].max()
+
+    volume_10 = np.stack([volumes[10][:, :, 0], volumes[10][:, :, 3]])
+    assert stats.bounds(2, "volume") == (
+        np.quantile(volume_10, 0.001),
+        np.quantile(volume_10, 0.999),
+    )
+
+    axeos = SCANNERS.index("axeos")
+    assert np.allclose(stats.scanner_stats[axeos], np.median(stats.volume_stats, 0))
+    assert stats.bounds(0, "scanner") == stats.bounds(1, "scanner")
+    assert np.isnan(stats.scanner_stats[SCANNERS.index("planmeca")]).all()
+
+    # The stats don't depend on how many slices are computed at once
+    chunked = SliceStats.compute(create(), verbose=False, chunk_slices=1)
+    assert np.array_equal(chunked.slice_stats, stats.slice_stats)
+    assert np.array_equal(chunked.volume_stats, stats.volume_stats)
+
+
+def test_compute_slice_stats_matches_compute_stats():
+    slices = np.random.default_rng(0).normal(size=(3, 5, 6)).astype(np.float32)
+    expected = np.stack([compute_stats(slice_np_array) for slice_np_array in slices])
+    assert np.allclose(compute_slice_stats(slices.copy()), expected)
+
+
+def test_dataset_with_precomputed_stats(stats_dataset):
+    tmp_path, _, create = stats_dataset
+    SliceStats.compute(create(), verbose=False).save(str(tmp_path / "stats.npz"))
+
+    reference = create(random_masks=False)
+    dataset = create(
+        random_masks=False, normalization_stats_path=str(tmp_path / "stats.npz")
+    )
+    for idx in range(len(dataset)):
+        assert np.allclose(dataset[idx][0], reference[idx][0])
+
+    dataset = create(
+        normalization_stats_path=str(tmp_path / "stats.npz"), normalization="volume"
+    )
+    assert dataset[0][0].min() >= 0 and dataset[0][0].max() <= 1
+
+    with pytest.raises(AssertionError):
+        create(normalization="volume")
+
+    (tmp_path / "spec.csv").write_text("slice\n10_0.nii.gz\n")
+    with pytest.raises(AssertionError, match="different slices"):
+        create(normalization_stats_path=str(tmp_path / "stats.npz"))
@@ -10,3 +10,38 @@ def testGetAllControlIDs():
     control_list = [f"{f}" for f in range(0, 401) if f % 10 == 0]
 
     assert controlIDs == control_list
+
+
+def testLookupNumInDatatable():
+    row = utils.lookup_num_in_datatable(1)
+    assert row["scanner"] == ["axeos"]
+    assert row["fov"] == ["small"]
+    assert row["frames"] == [1529]
+    assert utils.lookup_num_in_datatable(41) is None
+
+
+def testLookupNumsInDatatable():
+    rows = utils.lookup_nums_in_datatable([1, 41, 10])
+    assert rows[0] == utils.lookup_num_in_datatable(1)
+    assert rows[1] is None
+    assert rows[2]["implants"] == [0]
+
+
+def testDatatableIsCachedAndReloadable(tmp_path):
+    csv_path = tmp_path / "data.csv"
+    csv_path.write_text("id,scanner,frames\n1,axeos,3\n")
+
+    table = utils.get_datatable(csv_path)
+    assert utils.get_datatable(csv_path) is table
+    assert table.lookup(1) == {"id": [1], "scanner": ["axeos"], "frames": [3]}
+
+    csv_path.write_text("id,scanner,frames\n1,planmeca,3\n2,x800,5\n")
+    assert utils.get_datatable(csv_path).get_value(1, "scanner") == "axeos"
+
+    table = utils.reload_datatable(csv_path)
+    assert utils.get_datatable(csv_path) is table
+    assert table.get_value(1, "scanner") == "planmeca"
+    assert len(table) == 2
+
+    utils.invalidate_datatable(csv_path)
+    assert utils.get_datatable(csv_path) is not table
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import pickle
+
+import nibabel as nib
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+import cbct_artifact_reduction.dataprocessing as dp
+from cbct_artifact_reduction.batchprocessing import BatchPreprocessor, resize_batch
+from cbct_artifact_reduction.implantmaskcreator import ImplantMaskCreator
+from cbct_artifact_reduction.maskbank import MaskBank
+from cbct_artifact_reduction.sliceindex import SCANNERS
+from cbct_artifact_reduction.volumedataset import VolumeSliceDataset, open_volume
+
+
+@pytest.fixture
+def volume_dir(tmp_path):
+    numpy_data = np.random.default_rng(0).random((6, 7, 4))
+    os.makedirs(tmp_path / "volumes")
+    nib.save(nib.Nifti1Image(numpy_data, np.eye(4)), tmp_path / "volumes" / "10.nii")
+    dp.nifti_to_npy(tmp_path / "volumes" / "10.nii", tmp_path / "volumes" / "10.npy")
+    (tmp_path / "spec.csv").write_text("slice\n10_0.nii.gz\n10_3.nii.gz\n")
+    return tmp_path, numpy_data
+
+
+def test_nifti_to_npy(volume_dir):
+    tmp_path, numpy_data = volume_dir
+    volume = open_volume(str(tmp_path / "volumes" / "10.npy"))
+    assert isinstance(volume, np.memmap)
+    assert volume.flags.f_contiguous
+    assert np.allclose(volume, numpy_data)
+
+
+@pytest.mark.parametrize("volume_extension", [".npy", ".nii"])
+def test_volume_slice_dataset(volume_dir, volume_extension, local_loader):
+    tmp_path, numpy_data = volume_dir
+    dataset = VolumeSliceDataset(
+        local_loader,
+        str(tmp_path / "spec.csv"),
+        "volumes",
+        volume_extension=volume_extension,
+        return_info=True,
+        use_index_sidecar=False,
+    )
+    assert len(dataset) == 2
+
+    slice_np_array, mask_np_array, info = dataset[1]
+    assert slice_np_array.shape == (1, 6, 7)
+    # Without a resolution, the masks are generated at the size of the slices
+    assert mask_np_array.shape == (1, 6, 7)
+    assert info["scanner"] == ["axeos"]
+    expected = dataset.dataprocessing(numpy_data[:, :, 3])
+    assert np.allclose(slice_np_array[0], expected, atol=1e-6)
+
+    unpickled = pickle.loads(pickle.dumps(dataset))
+    assert unpickled._volumes == {}
+    assert np.allclose(unpickled[1][0], slice_np_array)
+
+
+def test_volume_slice_dataset_batch_preprocessing(volume_dir, local_loader):
+    tmp_path, numpy_data = volume_dir
+    dataset = VolumeSliceDataset(
+        local_loader,
+        str(tmp_path / "spec.csv"),
+        "volumes",
+        use_index_sidecar=False,
+        batch_preprocessing=True,
+    )
+    batch, _, codes = next(iter(DataLoader(dataset, batch_size=2)))
+    assert np.allclose(batch[1, 0].numpy(), numpy_data[:, :, 3])
+    assert codes["scanner_code"].tolist() == [SCANNERS.index("axeos")] * 2
+
+    normalized = BatchPreprocessor()(batch)
+    expected = dataset.dataprocessing(numpy_data[:, :, 3])
+    assert np.allclose(normalized[1, 0].numpy(), expected, atol=1e-5)
+
+
+def test_volume_slice_dataset_dtype(volume_dir, local_loader):
+    tmp_path, numpy_data = volume_dir
+    dataset = VolumeSliceDataset(
+        local_loader,
+        str(tmp_path / "spec.csv"),
+        "volumes",
+        use_index_sidecar=False,
+        dtype=np.float16,
+    )
+    slice_np_array, mask_np_array = dataset[1]
+    assert slice_np_array.dtype == np.float16
+    assert mask_np_array.dtype == np.float16
+    expected = dataset.dataprocessing(numpy_data[:, :, 3])
+    assert np.allclose(slice_np_array[0], expected, atol=1e-3)
+
+    batch, mask = next(iter(DataLoader(dataset, batch_size=2)))
+    assert batch.dtype == mask.dtype == torch.float16
+
+
+def test_volume_slice_dataset_resolution(volume_dir, local_loader):
+    tmp_path, numpy_data = volume_dir
+    dataset = VolumeSliceDataset(
+        local_loader,
+        str(tmp_path / "spec.csv"),
+        "volumes",
+        use_index_sidecar=False,
+        resolution=(12, 14),
+    )
+    slice_np_array, mask_np_array = dataset[1]
+    assert slice_np_array.shape == mask_np_array.shape == (1, 12, 14)
+    expected = resize_batch(
+        torch.from_numpy(dataset.dataprocessing(numpy_data[:, :, 3]))[None, None],
+        (12, 14),
+    )
+    assert np.allclose(slice_np_array[0], expected[0, 0].numpy(), atol=1e-6)
+
+    # With batch_preprocessing, the raw slices keep their size and the whole batch is resampled
+    dataset = VolumeSliceDataset(
+        local_loader,
+        str(tmp_path / "spec.csv"),
+        "volumes",
+        use_index_sidecar=False,
+        batch_preprocessing=True,
+        resolution=(12, 14),
+    )
+    batch, mask, _ = next(iter(DataLoader(dataset, batch_size=2)))
+    assert batch.shape == (2, 1, 6, 7)
+    assert mask.shape == (2, 1, 12, 14)
+    normalized = BatchPreprocessor(resolution=(12, 14))(batch)
+    assert np.allclose(normalized[1, 0].numpy(), slice_np_array[0], atol=1e-5)
+
+
+def test_volume_slice_dataset_mask_bank(volume_dir, local_loader):
+    tmp_path, _ = volume_dir
+    MaskBank.create(20, (256, 256)).save(str(tmp_path / "bank.npz"))
+    dataset = VolumeSliceDataset(
+        local_loader,
+        str(tmp_path / "spec.csv"),
+        "volumes",
+        random_masks=False,
+        use_index_sidecar=False,
+        mask_bank_path=str(tmp_path / "bank.npz"),
+        resolution=256,
+    )
+    mask_bank = MaskBank.load(str(tmp_path / "bank.npz"))
+    _, mask_np_array = dataset[1]
+    assert np.array_equal(mask_np_array[0], mask_bank.mask_for("10_3.nii.gz"))
+    assert mask_np_array.dtype == np.float32
+    assert np.array_equal(dataset[1][1], mask_np_array)
+
+
+def test_volume_slice_dataset_fixed_masks_are_seeded_with_the_filename(
+    volume_dir, local_loader
+):
+    tmp_path, _ = volume_dir
+    dataset = VolumeSliceDataset(
+        local_loader,
+        str(tmp_path / "spec.csv"),
+        "volumes",
+        random_masks=False,
+        use_index_sidecar=False,
+        resolution=256,
+    )
+    # The same seed as InpaintingSliceDataset uses for the slice file 10_3.nii.gz
+    seed = int.from_bytes(hashlib.sha256(b"10_3.nii.gz").digest()[:4], "little")
+    expected = ImplantMaskCreator(
+        (256, 256)
+    ).generate_mask_with_random_amount_of_implants(1, 4, random_state=seed)
+    assert np.array_equal(dataset[1][1][0], expected)
@@ -0,0 +1,161 @@
+import nibabel as nib
+import numpy as np
+import pytest
+import torch as th
+
+from cbct_artifact_reduction.guided_diffusion.script_util import (
+    create_gaussian_diffusion,
+)
+from cbct_artifact_reduction.volumeinference import (
+    VolumeInpainter,
+    crop_windows,
+    normalize_slices,
+)
+
+
+def test_inpaint_volume_batches_and_keeps_unmasked_voxels(zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim5")
+    model = zero_eps_model
+    rng = np.random.default_rng(0)
+    volume = rng.uniform(-1000, 3000, size=(12, 10, 5)).astype(np.float32)
+    mask = np.zeros(volume.shape, dtype=bool)
+    mask[3:7, 2:6, :] = True
+
+    inpainter = VolumeInpainter(
+        model, diffusion, batch_size=2, image_size=8, use_ddim=True
+    )
+    output, stats = inpainter.inpaint_volume(volume, mask)
+
+    assert output.shape == volume.shape
+    assert output.dtype == np.float32
+    np.testing.assert_array_equal(output[~mask], volume[~mask])
+    assert np.isfinite(output).all()
+    # 5 slices in 3 batches of 2, the last one padded, 5 steps each at the image size of the model
+    assert stats["slices"] == 5
+    assert stats["batches"] == 3
+    assert model.shapes == [(2, 3, 8, 8)] * 15
+    assert stats["slices_per_second"] > 0
+    assert stats["peak_memory_mb"] > 0
+
+
+def test_inpaint_file_keeps_affine(tmp_path, zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim2")
+    affine = np.diag([0.2, 0.2, 0.3, 1.0])
+    affine[:3, 3] = [10, -5, 2]
+    volume = np.arange(8 * 8 * 3, dtype=np.int16).reshape(8, 8, 3)
+    mask = np.zeros(volume.shape, dtype=np.uint8)
+    mask[2:4, 2:4, 1] = 1
+    nib.save(nib.nifti1.Nifti1Image(volume, affine), tmp_path / "volume.nii.gz")
+    nib.save(nib.nifti1.Nifti1Image(mask, affine), tmp_path / "mask.nii.gz")
+
+    inpainter = VolumeInpainter(zero_eps_model, diffusion, batch_size=4)
+    stats = inpainter.inpaint_file(
+        str(tmp_path / "volume.nii.gz"),
+        str(tmp_path / "mask.nii.gz"),
+        str(tmp_path / "inpainted.nii.gz"),
+    )
+
+    output = nib.load(tmp_path / "inpainted.nii.gz")
+    np.testing.assert_allclose(output.affine, affine)
+    assert output.get_data_dtype() == np.float32
+    data = output.get_fdata()
+    np.testing.assert_array_equal(data[mask == 0], volume[mask == 0])
+    assert stats["batches"] == 1
+
+
+def test_inpaint_volume_skips_empty_masks(zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim2")
+    model = zero_eps_model
+    volume = np.random.default_rng(0).uniform(size=(8, 8, 6)).astype(np.float32)
+    mask = np.zeros(volume.shape, dtype=bool)
+    mask[2:5, 2:5, [1, 4]] = True
+
+    inpainter = VolumeInpainter(model, diffusion, batch_size=4, crop=False)
+    output, stats = inpainter.inpaint_volume(volume, mask)
+
+    # Only the two masked frames are sampled, in a single batch
+    assert model.shapes == [(4, 3, 8, 8)] * 2
+    assert stats["slices_skipped"] == 4
+    assert stats["pixels_avoided"] == 4 * 64
+    assert stats["batches"] == 1
+    np.testing.assert_array_equal(
+        output[:, :, [0, 2, 3, 5]], volume[:, :, [0, 2, 3, 5]]
+    )
+
+    model.inputs.clear()
+    output, stats = inpainter.inpaint_volume(volume, np.zeros_like(mask))
+    assert model.shapes == []
+    assert stats["slices_skipped"] == 6
+    assert stats["batches"] == 0
+    np.testing.assert_array_equal(output, volume)
+
+
+def test_inpaint_batch_crops_around_masks(zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim2")
+    model = zero_eps_model
+    slices = th.rand(3, 1, 32, 32)
+    masks = th.zeros(3, 1, 32, 32)
+    masks[0, 0, 2:5, 3:6] = 1
+    masks[2, 0, 20:30, 25:28] = 1
+
+    inpainter = VolumeInpainter(
+        model, diffusion, batch_size=3, crop_margin=2, downsampling_factor=8
+    )
+    inpainted, stats = inpainter.inpaint_batch(slices, masks)
+
+    # The largest box is 10x3 pixels, 14x7 with the margin and 16x8 rounded to the downsampling factor
+    assert model.shapes == [(3, 3, 16, 8)] * 2
+    assert stats["slices_skipped"] == 1
+    assert stats["pixels_avoided"] == 32 * 32 + 2 * (32 * 32 - 16 * 8)
+    assert th.equal(inpainted[1], slices[1])
+    assert th.equal(inpainted[masks == 0], slices[masks == 0])
+
+
+def test_normalize_slices_above_the_quantile_limit():
+    batch = th.rand(64, 1, 512, 512)
+    batch[:, :, 0, 0] = 10
+    x, lower, scale = normalize_slices(batch)
+    assert x.shape == batch.shape
+    assert (x[:, :, 0, 0] == 1).all()
+    assert lower.shape == scale.shape == (64, 1, 1, 1)
+    assert th.allclose(
+        x * scale + lower, th.clamp(batch, lower, lower + scale), atol=1e-6
+    )
+
+
+def test_crop_windows_stay_inside_the_slices():
+    masks = th.zeros(2, 1, 16, 16, dtype=th.bool)
+    masks[0, 0, 0:2, 14:16] = True
+    masks[1, 0, 6:10, 6:10] = True
+
+    (height, width), corners = crop_windows(masks, margin=1, multiple=4)
+
+    assert (height, width) == (8, 8)
+    assert corners == [(0, 8), (4, 4)]
+
+
+def test_inpaint_batch_keeps_small_masks_when_resampled(zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim2")
+    model = zero_eps_model
+    slices = th.rand(2, 1, 32, 32)
+    masks = th.zeros(2, 1, 32, 32)
+    # A single voxel would cover a quarter of a pixel at the image size of the model
+    masks[0, 0, 5, 5] = 1
+    masks[1, 0, 10:20, 10:20] = 1
+
+    inpainter = VolumeInpainter(
+        model, diffusion, batch_size=2, image_size=16, crop_margin=1
+    )
+    inpainted, _ = inpainter.inpaint_batch(slices, masks)
+
+    # Both slices are cropped and the single voxel is masked for the model
+    assert all(shape[-2:] != (16, 16) for shape in model.shapes)
+    assert all(x[0, 2].count_nonzero() > 0 for x, _ in model.inputs)
+    assert inpainted[0, 0, 5, 5] != slices[0, 0, 5, 5]
+    assert th.equal(inpainted[masks == 0], slices[masks == 0])
+
+
+def test_known_region_options_need_ancestral_sampling(zero_eps_model):
+    diffusion = create_gaussian_diffusion(steps=100, timestep_respacing="ddim2")
+    with pytest.raises(AssertionError, match="ancestral"):
+        VolumeInpainter(zero_eps_model, diffusion, use_ddim=True, replace_known=True)
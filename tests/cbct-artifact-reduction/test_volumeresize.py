@@ -0,0 +1,145 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import cbct_artifact_reduction.volumeresize as vr
+from cbct_artifact_reduction.dataprocessing import NiftiDataFolder, resize_single_file
+
+
+@pytest.fixture
+def volumes(tmp_path):
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / "volumes")
+    for volume_id in (1, 2, 3):
+        nib.save(
+            nib.Nifti1Image(rng.random((16, 12, 5)), np.eye(4)),
+            tmp_path / "volumes" / f"{volume_id}.nii.gz",
+        )
+    return tmp_path
+
+
+def test_resize_volume_matches_resize_single_file(volumes):
+    nifti_path = str(volumes / "volumes" / "1.nii.gz")
+    resize_single_file(nifti_path, (8, 6), str(volumes / "expected.nii.gz"))
+    vr.resize_volume(
+        nifti_path,
+        {(8, 6): str(volumes / "8.nii.gz"), (4, 3): str(volumes / "4.nii.gz")},
+        chunk_frames=2,
+    )
+    expected = nib.load(volumes / "expected.nii.gz").get_fdata()
+    assert np.array_equal(nib.load(volumes / "8.nii.gz").get_fdata(), expected)
+    assert nib.load(volumes / "4.nii.gz").shape == (4, 3, 5)
+    # The memory-mapped temporary files are gone
+    assert sorted(os.listdir(volumes)) == [
+        "4.nii.gz",
+        "8.nii.gz",
+        "expected.nii.gz",
+        "volumes",
+    ]
+
+
+def test_resize_volume_of_integers_matches_resize_single_file(tmp_path):
+    np_array = np.random.default_rng(0).integers(-1000, 1000, (16, 12, 5))
+    nifti_path = str(tmp_path / "volume.nii.gz")
+    nib.save(nib.Nifti1Image(np_array.astype(np.int16), np.eye(4)), nifti_path)
+    resize_single_file(nifti_path, (8, 6), str(tmp_path / "expected.nii.gz"))
+    vr.resize_volume(nifti_path, {(8, 6): str(tmp_path / "8.nii.gz")}, chunk_frames=2)
+
+    expected = nib.load(tmp_path / "expected.nii.gz").get_fdata()
+    assert np.abs(expected).max() > 100
+    assert np.array_equal(nib.load(tmp_path / "8.nii.gz").get_fdata(), expected)
+
+
+def test_create_nifti_memmap_matches_nib_save(tmp_path):
+    np_array = np.random.default_rng(0).random((4, 5, 3))
+    nib.save(nib.Nifti1Image(np_array, None), tmp_path / "expected.nii")
+    memmap = vr.create_nifti_memmap(str(tmp_path / "memmap.nii"), (4, 5, 3), np.float64)
+    for i in range(3):
+        memmap[:, :, i] = np_array[:, :, i]
+    memmap.flush()
+    del memmap
+    assert (tmp_path / "memmap.nii").read_bytes() == (
+        tmp_path / "expected.nii"
+    ).read_bytes()
+
+
+def test_resize_backends_agree():
+    frames = np.random.default_rng(0).random((32, 24, 3))
+    torch_resized = vr.resize_frames(frames, (16, 12), backend="torch")
+    pil_resized = vr.resize_frames(frames, (16, 12), backend="pil")
+    assert torch_resized.shape == pil_resized.shape == (16, 12, 3)
+    assert torch_resized.dtype == np.float32
+    assert np.allclose(torch_resized, pil_resized, atol=1e-5)
+    assert vr.resize_frames(frames[:, :, 0], (8, 6), backend="torch").shape == (8, 6)
+
+
+def test_resize_all_files_multiple_resolutions(volumes):
+    folder = NiftiDataFolder(str(volumes / "volumes"))
+    stats = folder.resize_all_files(
+        str(volumes / "resized"), [(8, 6), (4, 4)], backend="torch", num_workers=2
+    )
+    assert stats["files"] == 3 and stats["written"] == 6
+    assert sorted(os.listdir(volumes / "resized" / "8x6")) == [
+        "1.nii.gz",
+        "2.nii.gz",
+        "3.nii.gz",
+    ]
+    assert nib.load(volumes / "resized" / "4x4" / "2.nii.gz").shape == (4, 4, 5)
+
+    # Only the resolution that is missing from the manifests is resized
+    stats = folder.resize_all_files(
+        str(volumes / "resized"), [(8, 6), (4, 4), (2, 2)], backend="torch"
+    )
+    assert stats["files"] == 3 and stats["written"] == 3
+    stats = folder.resize_all_files(
+        str(volumes / "resized"), [(8, 6), (2, 2)], backend="torch"
+    )
+    assert stats["files"] == 0 and stats["skipped"] == 3
+
+    # Another backend resizes the files again
+    stats = folder.resize_all_files(
+        str(volumes / "resized"), [(2, 2)], backend="pil", num_workers=0
+    )
+    assert stats["files"] == 3
+
+
+def test_resize_all_files_extension(volumes):
+    folder = NiftiDataFolder(str(volumes / "volumes"))
+    folder.resize_all_files(
+        str(volumes / "nii"), (8, 6), num_workers=0, extension=".nii"
+    )
+    assert sorted(os.listdir(volumes / "nii")) == ["1.nii", "2.nii", "3.nii"]
+    stats = folder.resize_all_files(
+        str(volumes / "nii"), (8, 6), num_workers=0, extension=".nii.gz"
+    )
+    assert stats["files"] == 3
+
+    folder.resize_all_files(
+        str(volumes / "gz9"), (8, 6), num_workers=0, compresslevel=9
+    )
+    assert np.array_equal(
+        nib.load(volumes / "gz9" / "1.nii.gz").get_fdata(),
+        nib.load(volumes / "nii" / "1.nii").get_fdata(),
+    )
+
+
+def test_resize_all_volumes_records_files_next_to_a_failure(volumes):
+    with open(volumes / "volumes" / "0.nii.gz", "wb") as f:
+        f.write(b"not a volume")
+    nifti_paths = sorted(str(path) for path in (volumes / "volumes").iterdir())
+    with pytest.warns(UserWarning, match="0.nii.gz"):
+        stats = vr.resize_all_volumes(
+            nifti_paths,
+            {(8, 6): str(volumes / "resized")},
+            num_workers=0,
+            files_per_task=4,
+            verbose=False,
+        )
+    assert stats["files"] == 3 and stats["failed"] == 1
+    assert set(vr.read_manifest(vr.manifest_path_for(str(volumes / "resized")))) == {
+        "1",
+        "2",
+        "3",
+    }